@@ -0,0 +1,251 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+import cdo
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Directory of the cache of cdo results across runs, None disables the cache
+cache_dir = None
+
+# Maximal size of the cache (in GB), the least recently used results are evicted beyond it
+max_size_gb = 100.
+
+# Whether input files are identified by a hash of their content, otherwise by their path, size and modification time
+hash_content = True
+
+# Version of the cache keys, bump when the output of the post-processing changes for the same command and input
+key_version = 1
+
+# Version of cdo, part of the cache keys. Determined from the cdo executable if not set.
+cdo_version = None
+
+# Extension of the cached results
+result_extension = ".nc"
+
+# Number of bytes read at once when hashing the input files
+chunk_size = 16 * 1024 * 1024
+
+# Name of the file in the cache directory that keeps the content hashes of the input files across runs
+identities_name = "identities.json"
+
+# File identities by path, size and modification time, and the files being hashed by other threads
+identities_ = None
+pending_ = {}
+lock_ = threading.Lock()
+
+# Total size of the cached results, counted at the first store and updated by every store and eviction
+size_ = None
+
+
+# Returns the cache key of the cdo command string on the input files, None if the cache is disabled or an input file
+# cannot be identified, such as a named pipe. The settings are the options of the post-processing that change the result
+# of the command. Without computing, None is returned as well for input files whose content has not been hashed before.
+def get_key(input_files, command_string, settings=None, compute=True):
+    if cache_dir is None or not any(input_files):
+        return None
+    identities = [get_identity(f, compute) for f in input_files]
+    if any([i is None for i in identities]):
+        return None
+    data = json.dumps([key_version, get_cdo_version(), command_string, settings, identities])
+    return hashlib.sha1(data).hexdigest()
+
+
+# Returns the identity of the input file, computed once per version of the file. Files that are left in place between
+# runs, such as reused filter output, keep their path, size and modification time and are not hashed again.
+def get_identity(path, compute=True):
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if not hash_content:
+        return "%s:%d:%f" % stamp
+    with lock_:
+        identity = load_identities().get(stamp, None)
+        if identity is not None or not compute:
+            return identity
+        pending = pending_.get(stamp, None)
+        if pending is None:
+            pending_[stamp] = threading.Event()
+    if pending is not None:
+        pending.wait()
+        with lock_:
+            return identities_.get(stamp, None)
+    sha1 = hashlib.sha1()
+    try:
+        with open(path, 'rb') as fin:
+            while True:
+                chunk = fin.read(chunk_size)
+                if not chunk:
+                    break
+                sha1.update(chunk)
+        with lock_:
+            identities_[stamp] = sha1.hexdigest()
+            return identities_[stamp]
+    finally:
+        with lock_:
+            pending_.pop(stamp).set()
+
+
+# Returns the file identities, read from the cache directory at first use. Must be called with the lock held.
+def load_identities():
+    global identities_
+    if identities_ is None:
+        identities_ = read_identities()
+    return identities_
+
+
+# Reads the file identities stored in the cache directory
+def read_identities():
+    path = os.path.join(cache_dir, identities_name) if cache_dir else None
+    if path is None or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as fin:
+            return {tuple(entry[:3]): entry[3] for entry in json.load(fin)}
+    except (IOError, ValueError, TypeError, IndexError) as e:
+        log.warning("Could not read file identities %s, reason: %s" % (path, str(e)))
+        return {}
+
+
+# Writes the identities of the files that still exist unchanged to the cache directory
+def save_identities():
+    if cache_dir is None or not hash_content:
+        return
+    path = os.path.join(cache_dir, identities_name)
+    with lock_:
+        entries = read_identities()
+        entries.update(load_identities())
+        result = []
+        for stamp, identity in entries.iteritems():
+            if os.path.isfile(stamp[0]):
+                stat = os.stat(stamp[0])
+                if (stat.st_size, stat.st_mtime) == stamp[1:]:
+                    result.append(list(stamp) + [identity])
+        tmp_path = path + ".%d.tmp" % os.getpid()
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(tmp_path, 'w') as fout:
+                json.dump(sorted(result), fout)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            log.warning("Could not write file identities %s, reason: %s" % (path, str(e)))
+
+
+# Forgets the file identities and the size of the cache directory
+def clear():
+    global identities_, size_
+    with lock_:
+        identities_, size_ = None, None
+
+
+# Returns the cdo version, determined once
+def get_cdo_version():
+    global cdo_version
+    if cdo_version is None:
+        try:
+            cdo_version = str(cdo.Cdo().version())
+        except Exception as e:
+            log.warning("Could not determine the cdo version for the result cache, reason: %s" % str(e))
+            cdo_version = "unknown"
+    return cdo_version
+
+
+# Returns the path of the cached result of the key
+def get_path(key):
+    return os.path.join(cache_dir, key + result_extension)
+
+
+# Returns whether the cache holds the result of the key
+def contains(key):
+    return key is not None and cache_dir is not None and os.path.isfile(get_path(key))
+
+
+# Places the cached result of the key at the output path, returns False if the cache does not hold the result
+def fetch(key, ofile):
+    if not contains(key):
+        return False
+    path = get_path(key)
+    try:
+        if os.path.exists(ofile):
+            os.remove(ofile)
+        link(path, ofile)
+        os.utime(path, None)
+    except (IOError, OSError) as e:
+        log.warning("Could not fetch cached cdo result %s, reason: %s" % (path, str(e)))
+        return False
+    log.info("Took cdo result %s from the cache" % ofile)
+    return True
+
+
+# Adds the result at the path to the cache and evicts the least recently used results beyond the maximal size
+def store(key, path):
+    if key is None or cache_dir is None or not os.path.isfile(path):
+        return
+    tmp_path = get_path(key) + ".%d.%d.tmp" % (os.getpid(), threading.current_thread().ident)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        link(path, tmp_path)
+        nbytes = os.path.getsize(tmp_path)
+        if os.path.isfile(get_path(key)):
+            nbytes -= os.path.getsize(get_path(key))
+        os.rename(tmp_path, get_path(key))
+    except (IOError, OSError) as e:
+        log.warning("Could not store cdo result %s in the cache, reason: %s" % (path, str(e)))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    if add_size(nbytes) > max_size_gb * 1.e9:
+        evict()
+
+
+# Adds the number of bytes to the total size of the cache, which is counted at first use, and returns the total
+def add_size(nbytes):
+    global size_
+    with lock_:
+        if size_ is None:
+            size_ = sum([e[1] for e in list_entries()])
+        else:
+            size_ += nbytes
+        return size_
+
+
+# Returns the modification time, size and name of the cached results
+def list_entries():
+    result = []
+    for f in os.listdir(cache_dir):
+        if f.endswith(result_extension):
+            stat = os.stat(os.path.join(cache_dir, f))
+            result.append((stat.st_mtime, stat.st_size, f))
+    return result
+
+
+# Removes the least recently used results until the cache fits within the maximal size. The directory is scanned
+# again, because other runs may share the cache.
+def evict():
+    global size_
+    with lock_:
+        entries = list_entries()
+        size = sum([e[1] for e in entries])
+        for mtime, nbytes, f in sorted(entries):
+            if size <= max_size_gb * 1.e9:
+                break
+            log.info("Evicting cdo result %s from the cache" % f)
+            os.remove(os.path.join(cache_dir, f))
+            size -= nbytes
+        size_ = size
+
+
+# Hard-links the file to the destination, copies it if it is on another file system
+def link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
@@ -82,6 +82,12 @@ class cdo_command:
             sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
         return " ".join([cdo_command.make_option(k, self.operators[k]) for k in keys])
 
+    # Returns the operators with their arguments in the order in which cdo applies them to the input
+    def get_chain(self):
+        keys = cdo_command.optimize_order(
+            sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
+        return [(k, tuple(self.operators[k])) for k in reversed(keys)]
+
     def merge(self, ifiles, ofile):
         if isinstance(ifiles, str):
             return self.app.merge(input=ifiles, output=ofile)
@@ -90,14 +96,18 @@ class cdo_command:
     def show_code(self, ifile):
         return self.app.showcode(input=ifile)
 
-    # Applies the current set of operators to the input file.
-    def apply(self, ifile, ofile=None, threads=4, grib_first=False):
+    # Applies the current set of operators to the input file. With grib_first, the result is written as grib and
+    # converted to netcdf afterwards, by the converter function if given and by cdo otherwise. With grib_output, the
+    # result is written as grib, packed with the given number of bits per value if given.
+    def apply(self, ifile, ofile=None, threads=4, grib_first=False, converter=None, grib_output=False, bits=None):
         global log
         keys = cdo_command.optimize_order(
             sorted(self.operators.keys(), key=lambda op: cdo_command.operator_ordering.index(op)))
         option_string = "-f nc" if threads < 2 else ("-f nc -P " + str(threads))
-        if grib_first:
+        if grib_first or grib_output:
             option_string = "" if threads < 2 else ("-P " + str(threads))
+        if grib_output and bits is not None:
+            option_string = " ".join([option_string, "-b " + str(bits)]).strip()
         func = getattr(self.app, keys[0], None)
         app_args = None
         if func:
@@ -119,8 +129,9 @@ class cdo_command:
             else:
                 f = func(input=input_string, options=option_string)
             if grib_first:
-                option_string = "-f nc"
-                self.app.copy(input=output_file, output=ofile, options=option_string)
+                if converter is None or converter(output_file, ofile) is None:
+                    option_string = "-f nc"
+                    self.app.copy(input=output_file, output=ofile, options=option_string)
                 os.remove(output_file)
         except cdo.CDOException as e:
             log.error(str(e))
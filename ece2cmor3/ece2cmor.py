@@ -40,8 +40,21 @@ def main(args=None):
     parser.add_argument("--tmpdir", metavar="DIR", type=str, default="/tmp/ece2cmor",
                         help="Temporary working directory")
     parser.add_argument("--npp", metavar="N", type=int, default=8, help="Number of post-processing threads")
+    parser.add_argument("--nfilter", metavar="N", type=int, default=1,
+                        help="Number of processes for filtering the grib files (requires --filter)")
+    parser.add_argument("--months", metavar="N", type=int, default=1,
+                        help="Number of consecutive months of IFS output to process, reusing the month-boundary "
+                             "records of the previous month")
+    parser.add_argument("--aggregate", action="store_true", default=False,
+                        help="Compute daily and monthly means while filtering the grib files (requires --filter)")
+    parser.add_argument("--pipes", action="store_true", default=False,
+                        help="Serve single-use filter output to CDO through named pipes (requires --filter)")
     parser.add_argument("--tmpsize", metavar="X", type=float, default=float("inf"),
                         help="Size of tempdir (in GB) that triggers flushing")
+    parser.add_argument("--cdocache", metavar="DIR", type=str, default=None,
+                        help="Directory of the cache of CDO results, reused when months are reprocessed")
+    parser.add_argument("--cdocachesize", metavar="X", type=float, default=100.,
+                        help="Size of the CDO result cache (in GB), least recently used results are evicted beyond it")
     parser.add_argument("--ncdo", metavar="N", type=int, default=4,
                         help="Number of available threads per CDO postprocessing task")
     parser.add_argument("--nomask", action="store_true", default=False, help="Disable masking of fields")
@@ -98,7 +111,13 @@ def main(args=None):
                                       tempdir=args.tmpdir,
                                       taskthreads=args.npp,
                                       cdothreads=args.ncdo,
-                                      maxsizegb=args.tmpsize)
+                                      maxsizegb=args.tmpsize,
+                                      filterprocs=args.nfilter,
+                                      nintervals=args.months,
+                                      aggregate=args.aggregate,
+                                      pipes=args.pipes,
+                                      cdocache=args.cdocache,
+                                      cdocachesizegb=args.cdocachesize)
     if model_active_flags["nemo"]:
         ece2cmorlib.perform_nemo_tasks(args.datadir, args.exp, startdate, length)
 #   if procNEWCOMPONENT:
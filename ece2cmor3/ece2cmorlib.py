@@ -1,7 +1,8 @@
 import cmor
+import copy
 import os
 import logging
-from ece2cmor3 import cmor_source, cmor_target, cmor_task, nemo2cmor, ifs2cmor, postproc
+from ece2cmor3 import cmor_source, cmor_target, cmor_task, nemo2cmor, ifs2cmor, postproc, grib_filter, cdo_cache
 
 # Logger instance
 log = logging.getLogger(__name__)
@@ -143,7 +144,13 @@ def perform_ifs_tasks(datadir, expname, startdate, interval, refdate=None,
                       cdothreads=4,
                       cleanup=True,
                       outputfreq=3,
-                      maxsizegb=float("inf")):
+                      maxsizegb=float("inf"),
+                      filterprocs=1,
+                      nintervals=1,
+                      aggregate=False,
+                      pipes=False,
+                      cdocache=None,
+                      cdocachesizegb=cdo_cache.max_size_gb):
     global log, tasks, table_dir, prefix, masks
     validate_setup_settings()
     validate_run_settings(datadir, expname)
@@ -155,13 +162,35 @@ def perform_ifs_tasks(datadir, expname, startdate, interval, refdate=None,
     else:
         ifs2cmor.masks = {}
     ofreq = -1 if auto_filter else outputfreq
-    if (not ifs2cmor.initialize(datadir, expname, tableroot, startdate, interval, refdate if refdate else startdate,
-                                outputfreq=ofreq, tempdir=tempdir, maxsizegb=maxsizegb, autofilter=auto_filter)):
-        return
     postproc.postproc_mode = postprocmode
     postproc.cdo_threads = cdothreads
     postproc.task_threads = taskthreads
-    ifs2cmor.execute(ifs_tasks, cleanup=cleanup, autofilter=auto_filter)
+    grib_filter.processes = filterprocs
+    grib_filter.aggregate_times = auto_filter and aggregate
+    grib_filter.pipe_streams = auto_filter and pipes
+    grib_filter.carry_boundary = auto_filter and nintervals > 1
+    cdo_cache.cache_dir = cdocache
+    cdo_cache.max_size_gb = cdocachesizegb
+    try:
+        for i in range(nintervals):
+            start = startdate + i * interval
+            if (not ifs2cmor.initialize(datadir, expname, tableroot, start, interval, refdate if refdate else startdate,
+                                        outputfreq=ofreq, tempdir=tempdir, maxsizegb=maxsizegb,
+                                        autofilter=auto_filter)):
+                return
+            interval_tasks = ifs_tasks if nintervals == 1 else [copy_task(t) for t in ifs_tasks]
+            ifs2cmor.execute(interval_tasks, cleanup=cleanup, autofilter=auto_filter)
+    finally:
+        grib_filter.clear_boundaries()
+        grib_filter.carry_boundary = False
+
+
+# Copies the task for processing another interval. The source is copied as well, because post-processing modifies it;
+# the target is shared.
+def copy_task(task):
+    result = copy.copy(task)
+    result.source = copy.deepcopy(task.source)
+    return result
 
 
 # Performs a NEMO cmorization processing:
@@ -0,0 +1,215 @@
+import datetime
+import logging
+import os
+import threading
+
+import netCDF4
+import numpy
+
+from ece2cmor3 import cdoapi, grib_file, grib_netcdf
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Whether the metadata is collected by scanning the files once, otherwise only the cdo probes are cached
+scan_files = True
+
+# Level types of the cdo vertical axes
+zaxes = {cdoapi.cdo_command.model_level: [grib_file.hybrid_level_code],
+         cdoapi.cdo_command.pressure: [grib_file.pressure_level_hPa_code, grib_file.pressure_level_Pa_code,
+                                       grib_file.pressure_level_Pa_grib1_code],
+         cdoapi.cdo_command.height: [grib_file.height_level_code],
+         cdoapi.cdo_command.surf_level: [grib_file.surface_level_code]}
+
+# Cdo grid types of the grib grid types
+grid_types = {"reduced_gg": "gaussian_reduced", "regular_gg": "gaussian", "regular_ll": "lonlat", "sh": "spectral"}
+
+# Header keys of the grib scan
+scan_keys = [grib_file.param_key, grib_file.levtype_key, grib_file.level_key, grib_netcdf.validity_date_key,
+             grib_netcdf.validity_time_key]
+
+# Catalogue entries by file path
+entries_ = {}
+entries_lock_ = threading.Lock()
+
+
+# Metadata of a file: the levels per code and level type, the cdo grid description and the time stamps, each None if it
+# could not be collected from the file. The results of cdo probes are kept as well.
+class file_entry(object):
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.levels = None
+        self.grid = None
+        self.timestamps = None
+        self.probes = {}
+
+
+# Returns the codes in the file
+def get_codes(path):
+    entry = get_entry(path)
+    if entry is not None and entry.levels is not None:
+        return sorted(entry.levels.keys())
+    return probe(entry, ("codes",), lambda: [int(c) for c in " ".join(cdoapi.cdo_command().show_code(path)).split()])
+
+
+# Returns the level types of the code in the file
+def get_z_axes(path, code):
+    entry = get_entry(path)
+    if entry is not None and entry.levels is not None and isinstance(code, int):
+        return sorted(entry.levels.get(code, {}).keys())
+    return probe(entry, ("zaxes", code), lambda: cdoapi.cdo_command().get_z_axes(path, code))
+
+
+# Returns the levels of the code on the cdo vertical axis in the file
+def get_levels(path, code, axis):
+    entry = get_entry(path)
+    if entry is not None and entry.levels is not None and isinstance(code, int) and axis in zaxes:
+        levels = set()
+        for levtype in zaxes[axis]:
+            levels.update(entry.levels.get(code, {}).get(levtype, []))
+        return sorted(levels)
+    return probe(entry, ("levels", code, axis), lambda: cdoapi.cdo_command().get_levels(path, code, axis))
+
+
+# Returns the cdo grid description of the (first grid in the) file
+def get_grid_descr(path):
+    entry = get_entry(path)
+    if entry is not None and entry.grid is not None:
+        return entry.grid
+    return probe(entry, ("grid",), lambda: cdoapi.cdo_command().get_grid_descr(path))
+
+
+# Returns the sorted time stamps in the file
+def get_timestamps(path):
+    entry = get_entry(path)
+    if entry is not None and entry.timestamps is not None:
+        return entry.timestamps
+    return probe(entry, ("timestamps",), lambda: sorted(set(
+        [datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S") for s in
+         " ".join(cdoapi.cdo_command().app.showtimestamp(input=path)).split()])))
+
+
+# Returns the result of the cdo probe, executed once per entry
+def probe(entry, key, func):
+    if entry is None:
+        return func()
+    if key not in entry.probes:
+        entry.probes[key] = func()
+    return entry.probes[key]
+
+
+# Empties the catalogue
+def clear():
+    global entries_
+    with entries_lock_:
+        entries_ = {}
+
+
+# Returns the catalogue entry of the file, scanning its metadata if the file is new or has changed since. Returns None
+# for files that cannot be catalogued, such as named pipes.
+def get_entry(path):
+    if not path or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    stamp = (stat.st_mtime, stat.st_size)
+    with entries_lock_:
+        entry = entries_.get(path, None)
+    if entry is not None and entry.stamp == stamp:
+        return entry
+    entry = file_entry(stamp)
+    if scan_files:
+        try:
+            with open(path, 'r') as fin:
+                magic = fin.read(4)
+            if magic == "GRIB":
+                scan_grib(path, entry)
+            elif magic[:3] == "CDF" or magic == "\x89HDF":
+                scan_netcdf(path, entry)
+        except Exception as e:
+            log.warning("Could not catalogue metadata of %s, reason: %s" % (path, str(e)))
+            entry = file_entry(stamp)
+    with entries_lock_:
+        entries_[path] = entry
+    return entry
+
+
+# Collects the levels, grid and validity times of the grib file in a single scan of the message headers
+def scan_grib(path, entry):
+    log.info("Cataloguing metadata of grib file %s" % path)
+    levels, timestamps, grid = {}, set(), None
+    with open(path, 'r') as fin:
+        gribfile = grib_file.create_library_file(fin)
+        while gribfile.read_next(headers_only=True):
+            try:
+                param, levtype, level, date, time = gribfile.get_fields(scan_keys)
+                if grid is None:
+                    grid = get_grib_grid(gribfile.record)
+            finally:
+                gribfile.release()
+            table, code = (param / 1000, param % 1000) if param >= 1000 else (128, param)
+            if levtype == grib_file.surface_level_code and table == 128 and code in grib_netcdf.surface_heights:
+                levtype, level = grib_file.height_level_code, grib_netcdf.surface_heights[code]
+            levels.setdefault(code, {}).setdefault(levtype, set()).add(grib_netcdf.get_level_value(levtype, level))
+            timestamps.add((date, time))
+    entry.levels = {code: {levtype: sorted(values) for levtype, values in levtypes.iteritems()}
+                    for code, levtypes in levels.iteritems()}
+    entry.timestamps = [datetime.datetime(d / 10000, (d / 100) % 100, d % 100, t / 100, t % 100)
+                        for d, t in sorted(timestamps)]
+    entry.grid = grid if grid else None
+
+
+# Returns the cdo grid description of the message header, an empty dictionary if the grid type has no cdo equivalent
+def get_grib_grid(record):
+    get_long, get_string, get_double = grib_file.get_message_functions(["get_long", "get_string", "get_double"])
+    gridtype = grid_types.get(get_string(record, "gridType"), None)
+    if gridtype is None:
+        return {}
+    result = {"gridtype": gridtype, "gridsize": get_long(record, "numberOfDataPoints")}
+    if gridtype in ["gaussian", "lonlat"]:
+        result["xsize"], result["ysize"] = get_long(record, "Ni"), get_long(record, "Nj")
+        result["xfirst"] = get_double(record, "longitudeOfFirstGridPointInDegrees")
+        result["xinc"] = get_double(record, "iDirectionIncrementInDegrees")
+        result["yfirst"] = get_double(record, "latitudeOfFirstGridPointInDegrees")
+        if gridtype == "lonlat":
+            result["yinc"] = get_double(record, "jDirectionIncrementInDegrees")
+    return result
+
+
+# Collects the grid and the time stamps of the netcdf file
+def scan_netcdf(path, entry):
+    log.info("Cataloguing metadata of netcdf file %s" % path)
+    dataset = netCDF4.Dataset(path, 'r')
+    try:
+        ncvars = dataset.variables
+        timevar = ncvars.get("time", None)
+        if timevar is not None and hasattr(timevar, "units"):
+            times = netCDF4.num2date(timevar[:], timevar.units, getattr(timevar, "calendar", "standard"))
+            entry.timestamps = sorted(set([datetime.datetime(*(t + datetime.timedelta(seconds=0.5)).timetuple()[:6])
+                                           for t in numpy.atleast_1d(times)]))
+        lats = [v for v in ncvars.values() if getattr(v, "standard_name", None) == "latitude" and v.ndim == 1]
+        lons = [v for v in ncvars.values() if getattr(v, "standard_name", None) == "longitude" and v.ndim == 1]
+        if any(lats) and any(lons):
+            entry.grid = get_netcdf_grid(numpy.array(lats[0][:], dtype=numpy.float64),
+                                         numpy.array(lons[0][:], dtype=numpy.float64))
+    finally:
+        dataset.close()
+
+
+# Returns the cdo grid description of the latitudes and longitudes: gaussian if the latitudes are the gaussian
+# latitudes, lonlat if they are equidistant and None otherwise
+def get_netcdf_grid(lats, lons):
+    nlat, nlon = len(lats), len(lons)
+    result = {"gridsize": nlat * nlon, "xsize": nlon, "ysize": nlat, "xfirst": lons[0], "yfirst": lats[0],
+              "xvals": lons, "yvals": lats}
+    if nlon > 1:
+        result["xinc"] = lons[1] - lons[0]
+    gaussian = numpy.degrees(numpy.arcsin(numpy.polynomial.legendre.leggauss(nlat)[0]))
+    if numpy.allclose(numpy.sort(lats), gaussian, atol=1.e-3):
+        result["gridtype"] = "gaussian"
+    elif nlat > 1 and numpy.allclose(numpy.diff(lats), lats[1] - lats[0]):
+        result["gridtype"] = "lonlat"
+        result["yinc"] = lats[1] - lats[0]
+    else:
+        return None
+    return result
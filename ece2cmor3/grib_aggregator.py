@@ -0,0 +1,78 @@
+import collections
+import logging
+
+import numpy
+
+from ece2cmor3 import grib_file
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Number of bits per value of the encoded aggregated messages
+encoded_bits = 24
+
+# Maximal memory (in GB) of the running sums of all aggregated streams. Streams that would exceed it are filtered
+# without aggregation and averaged by cdo.
+max_memory_gb = 8.
+
+# Bytes per value held for every field in its current window: the float64 sum, the int32 count and the template message
+bytes_per_value = 16
+
+# Supported time windows and reductions
+windows = ["day", "mon"]
+operators = ["mean"]
+
+
+# Returns the memory footprint (in bytes) of aggregating the given number of fields with the given number of values
+def get_footprint(nfields, nvalues):
+    return nfields * nvalues * bytes_per_value
+
+
+# Returns the window of the date, the date itself for daily windows and the month for monthly windows
+def get_window(window, date):
+    if window == "day":
+        return date
+    return date / 100
+
+
+# File-like object that averages the grib messages written to it over time windows, per field. The first message of
+# a window is the template of the averaged message, which is written to the output when the next window of the field
+# starts or when the aggregator is closed. Missing values are left out of the average of their grid point.
+class aggregator(object):
+
+    def __init__(self, output, window, operator="mean"):
+        if window not in windows or operator not in operators:
+            raise Exception("Unsupported time aggregation %s over window %s" % (operator, window))
+        self.output = output
+        self.window = window
+        self.fields = collections.OrderedDict()
+
+    def write(self, data):
+        record = grib_file.load_message(data)
+        field, date, values = grib_file.decode_message(record)
+        window = get_window(self.window, date)
+        entry = self.fields.get(field, None)
+        if entry is not None and entry[0] != window:
+            self.emit(field)
+            entry = None
+        valid = ~numpy.isnan(values)
+        if entry is None:
+            self.fields[field] = [window, record, numpy.where(valid, values, 0.), valid.astype(numpy.int32)]
+        else:
+            grib_file.release_message(record)
+            entry[2] += numpy.where(valid, values, 0.)
+            entry[3] += valid
+
+    # Writes the average of the field over its current window
+    def emit(self, field):
+        window, record, total, count = self.fields.pop(field)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            values = numpy.where(count > 0, total / count, numpy.nan)
+        try:
+            self.output.write(grib_file.encode_message(record, values, encoded_bits))
+        finally:
+            grib_file.release_message(record)
+
+    def close(self):
+        for field in list(self.fields.keys()):
+            self.emit(field)
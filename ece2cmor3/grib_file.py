@@ -1,13 +1,21 @@
 import os
 import csv
+import mmap
+import tempfile
 
-import gribapi
+import numpy
+
+try:
+    import gribapi
+except ImportError:
+    gribapi = None
 
 # Vertical axes codes
 surface_level_code = 1
 hybrid_level_code = 109
 pressure_level_hPa_code = 100
 pressure_level_Pa_code = 210
+pressure_level_Pa_grib1_code = 99
 height_level_code = 105
 depth_level_code = 111
 pv_level_code = 117
@@ -18,17 +26,232 @@ time_key = "dataTime"
 param_key = "paramId"
 levtype_key = "indicatorOfTypeOfLevel"
 level_key = "level"
-
+offset_key = "offset"
+length_key = "totalLength"
+
+# Header keys decoded at once for routing the messages
+header_keys = [param_key, levtype_key, level_key, date_key, time_key]
+
+# GRIB1 header octets (zero-based positions in the message) that can be patched in place
+grib1_section1_pos = 8
+grib1_centre_pos = 12
+grib1_levtype_pos = 17
+grib1_date_pos = 20
+grib1_time_pos = 23
+grib1_century_pos = 32
+grib1_localdef_pos = 48
+grib1_section1_min_length = 28
+grib1_ecmwf_centre = 98
+grib1_patch_localdefs = frozenset([1])
+grib1_layer_level_codes = frozenset([101, 104, 106, 108, 110, 112, 114, 116, 120, 121, 128, 141])
+grib1_table_pos = 11
+grib1_param_pos = 16
+grib1_level_pos = 18
+grib1_ecmwf_tables = frozenset(range(128, 255))
 
 test_mode = False
 
+# Whether the grib library creates message handles from binary strings
+load_from_memory = True
+
+# Grib backend: "gribapi" or "eccodes" for the grib libraries, "grib1" for the header scanner on top of gribapi
+backend = os.environ.get("ECE2CMOR3_GRIB_BACKEND", "gribapi")
+
 
 # Factory method
 def create_grib_file(file_object_):
     if test_mode:
         return csv_grib_mock(file_object_)
-    else:
+    elif backend == "grib1":
+        return grib1_scanner(file_object_)
+    return create_library_file(file_object_)
+
+
+# Factory method for the grib library backends
+def create_library_file(file_object_):
+    if backend in ["gribapi", "grib1"]:
         return ecmwf_grib_api(file_object_)
+    elif backend == "eccodes":
+        return eccodes_grib(file_object_)
+    else:
+        raise Exception("Unknown grib backend %s" % backend)
+
+
+# Factory method for reading message headers, scanning GRIB1 headers without the grib library
+def create_header_file(file_object_):
+    if test_mode:
+        return csv_grib_mock(file_object_)
+    return grib1_scanner(file_object_)
+
+
+# Returns the grib library functions with the given names, for decoding and encoding messages in memory
+def get_message_functions(names):
+    if backend == "eccodes":
+        import eccodes
+        return [getattr(eccodes, "codes_" + name) for name in names]
+    return [getattr(gribapi, "grib_" + name) for name in names]
+
+
+# Loads the message in memory into a grib library handle. Bindings that do not accept binary strings are detected at
+# the first message, after which the messages are passed through a temporary file.
+def load_message(message):
+    global load_from_memory
+    if load_from_memory:
+        try:
+            return get_message_functions(["new_from_message"])[0](bytes(message))
+        except (TypeError, UnicodeError):
+            load_from_memory = False
+    scratch = tempfile.TemporaryFile()
+    try:
+        scratch.write(message)
+        scratch.seek(0)
+        if backend == "eccodes":
+            import eccodes
+            return eccodes.codes_grib_new_from_file(scratch)
+        return gribapi.grib_new_from_file(scratch)
+    finally:
+        scratch.close()
+
+
+# Decodes the field (code, level type and level), the date and the values of the message handle, missing values
+# become NaN
+def decode_message(record):
+    get_long, get_double, get_values = get_message_functions(["get_long", "get_double", "get_values"])
+    field = tuple([get_long(record, name) for name in [param_key, levtype_key, level_key]])
+    values = numpy.array(get_values(record), dtype=numpy.float64)
+    if get_long(record, "bitmapPresent"):
+        values[values == get_double(record, "missingValue")] = numpy.nan
+    return field, get_long(record, date_key), values
+
+
+# Sets the values of the message handle, packed with the given number of bits per value, and returns the message
+def encode_message(record, values, bits=None):
+    get_double, set_long, set_values, get_message = get_message_functions(["get_double", "set_long", "set_values",
+                                                                           "get_message"])
+    if bits is not None:
+        set_long(record, "bitsPerValue", bits)
+    missing = numpy.isnan(values)
+    if missing.any():
+        set_long(record, "bitmapPresent", 1)
+        values = numpy.where(missing, get_double(record, "missingValue"), values)
+    set_values(record, values)
+    return get_message(record)
+
+
+# Releases the message handle
+def release_message(record):
+    get_message_functions(["release"])[0](record)
+
+
+# Memory-maps the file object for raw message access, returns None if the file cannot be mapped
+def map_file(file_object_):
+    try:
+        return mmap.mmap(file_object_.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        return None
+
+
+# Writes the raw bytes of a message from the memory-mapped buffer to the file object
+def write_raw(buf, offset, length, file_object_):
+    file_object_.write(buffer(buf, offset, length))
+
+
+# Returns whether the header fields of the message buffer can be patched in place
+def is_patchable(buf):
+    if len(buf) < grib1_section1_pos + grib1_section1_min_length or buf[0:4] != "GRIB" or buf[7] != 1:
+        return False
+    pos = grib1_section1_pos
+    length = (buf[pos] << 16) + (buf[pos + 1] << 8) + buf[pos + 2]
+    if length < grib1_section1_min_length:
+        return False
+    if length > grib1_localdef_pos - pos:
+        return buf[grib1_centre_pos] == grib1_ecmwf_centre and buf[grib1_localdef_pos] in grib1_patch_localdefs
+    return True
+
+
+# Reads a header field from the GRIB1 message buffer, returns None for fields that are not supported
+def get_grib1_field(buf, name):
+    if name == date_key:
+        year = 100 * (buf[grib1_century_pos] - 1) + buf[grib1_date_pos]
+        return 10000 * year + 100 * buf[grib1_date_pos + 1] + buf[grib1_date_pos + 2]
+    if name == time_key:
+        return 100 * buf[grib1_time_pos] + buf[grib1_time_pos + 1]
+    if name == levtype_key:
+        return buf[grib1_levtype_pos]
+    return None
+
+
+# Returns the offset of the trailing block of GRIB1 messages in the buffer whose headers satisfy the predicate, by
+# scanning message boundaries backwards from the end. Returns None if the messages cannot be delimited this way.
+def find_tail(buf, predicate):
+    end, limit = len(buf), len(buf)
+    while end > 0:
+        start = buf.rfind("GRIB", 0, limit)
+        if start < 0:
+            return None
+        header = bytearray(buf[start:min(start + grib1_localdef_pos + 1, end)])
+        length = (header[4] << 16) + (header[5] << 8) + header[6] if len(header) > 7 else 0
+        if len(header) < grib1_section1_pos + grib1_section1_min_length or header[7] != 1 or \
+                start + length != end or buf[end - 4:end] != "7777":
+            limit = start + 3
+            continue
+        if not predicate(header):
+            return end
+        end, limit = start, start + 3
+    return end
+
+
+# Decodes the header fields of the GRIB1 message buffer, returns None for messages that are not ECMWF GRIB1 messages
+# with a plain total length and a single level
+def decode_grib1_header(buf):
+    if len(buf) < grib1_section1_pos + grib1_section1_min_length or buf[0:4] != "GRIB" or buf[7] != 1 or buf[4] & 0x80:
+        return None
+    table, levtype = buf[grib1_table_pos], buf[grib1_levtype_pos]
+    if buf[grib1_centre_pos] != grib1_ecmwf_centre or table not in grib1_ecmwf_tables or \
+            levtype in grib1_layer_level_codes:
+        return None
+    code = buf[grib1_param_pos]
+    return {length_key: (buf[4] << 16) + (buf[5] << 8) + buf[6],
+            param_key: code if table == 128 else 1000 * table + code,
+            levtype_key: levtype,
+            level_key: (buf[grib1_level_pos] << 8) + buf[grib1_level_pos + 1],
+            date_key: get_grib1_field(buf, date_key),
+            time_key: get_grib1_field(buf, time_key)}
+
+
+# Patches a header field in the GRIB1 message buffer in place, returns False if the field or message layout is not
+# supported, in which case the buffer is left unchanged.
+def patch_grib1_field(buf, name, value):
+    if not is_patchable(buf):
+        return False
+    value = int(value)
+    if name == date_key:
+        year, month, day = value / 10000, (value / 100) % 100, value % 100
+        if year < 1 or not 1 <= month <= 12 or not 1 <= day <= 31:
+            return False
+        century = (year - 1) / 100 + 1
+        octets = {grib1_date_pos: year - 100 * (century - 1), grib1_date_pos + 1: month, grib1_date_pos + 2: day,
+                  grib1_century_pos: century}
+    elif name == time_key:
+        hour, minute = value / 100, value % 100
+        if not 0 <= hour < 24 or not 0 <= minute < 60:
+            return False
+        octets = {grib1_time_pos: hour, grib1_time_pos + 1: minute}
+    elif name == levtype_key:
+        if not 0 < value < 255 or value in grib1_layer_level_codes or \
+                buf[grib1_levtype_pos] in grib1_layer_level_codes:
+            return False
+        octets = {grib1_levtype_pos: value}
+    else:
+        return False
+    original = {pos: buf[pos] for pos in octets}
+    for pos, octet in octets.iteritems():
+        buf[pos] = octet
+    if get_grib1_field(buf, name) != value:
+        for pos, octet in original.iteritems():
+            buf[pos] = octet
+        return False
+    return True
 
 
 # Interface for grib file object
@@ -49,6 +272,9 @@ class grib_file(object):
     def get_field(self, name):
         pass
 
+    def get_fields(self, names):
+        return [self.get_field(name) for name in names]
+
     def release(self):
         pass
 
@@ -69,7 +295,7 @@ class ecmwf_grib_api(grib_file):
         return self.record is not None
 
     def write(self, file_object_):
-        gribapi.grib_write(self.record, file_object_)
+        file_object_.write(gribapi.grib_get_message(self.record))
 
     def set_field(self, name, value):
         gribapi.grib_set(self.record, name, value)
@@ -77,6 +303,10 @@ class ecmwf_grib_api(grib_file):
     def get_field(self, name):
         return gribapi.grib_get_long(self.record, name)
 
+    def get_fields(self, names):
+        get_long, record = gribapi.grib_get_long, self.record
+        return [get_long(record, name) for name in names]
+
     def release(self):
         gribapi.grib_release(self.record)
 
@@ -84,6 +314,119 @@ class ecmwf_grib_api(grib_file):
         return self.record is None
 
 
+# ecCodes implementation of grib file interface
+class eccodes_grib(grib_file):
+
+    def __init__(self, file_object_):
+        super(eccodes_grib, self).__init__(file_object_)
+        import eccodes
+        self.api = eccodes
+        self.record = None
+
+    def read_next(self, headers_only=False):
+        self.record = self.api.codes_grib_new_from_file(self.file_object, headers_only=headers_only)
+        return self.record is not None
+
+    def write(self, file_object_):
+        file_object_.write(self.api.codes_get_message(self.record))
+
+    def set_field(self, name, value):
+        self.api.codes_set(self.record, name, value)
+
+    def get_field(self, name):
+        if name == offset_key:
+            return self.api.codes_get_message_offset(self.record)
+        if name == length_key:
+            return self.api.codes_get_message_size(self.record)
+        return self.api.codes_get_long(self.record, name)
+
+    def get_fields(self, names):
+        get_long, record = self.api.codes_get_long, self.record
+        return [get_long(record, name) if name not in [offset_key, length_key] else self.get_field(name)
+                for name in names]
+
+    def release(self):
+        self.api.codes_release(self.record)
+
+    def eof(self):
+        return self.record is None
+
+
+# GRIB1 header scanner implementation of grib file interface. The header fields are decoded from the octets of the
+# memory-mapped file and unmodified messages are written as raw bytes. Other fields, modifications and messages that
+# cannot be decoded this way (GRIB2, large messages, layers, other centres) are handled by the grib library.
+class grib1_scanner(grib_file):
+
+    def __init__(self, file_object_):
+        super(grib1_scanner, self).__init__(file_object_)
+        self.buffer = map_file(file_object_)
+        self.message = create_library_file(file_object_)
+        self.fields = None
+        self.loaded = False
+        self.modified = False
+
+    def read_next(self, headers_only=False):
+        self.release()
+        if self.buffer is None:
+            self.loaded = self.message.read_next(headers_only)
+            return self.loaded
+        offset = self.buffer.find("GRIB", self.file_object.tell())
+        if offset < 0:
+            self.file_object.seek(0, os.SEEK_END)
+            return False
+        self.fields = decode_grib1_header(bytearray(self.buffer[offset:offset + grib1_localdef_pos + 1]))
+        if self.fields is None:
+            self.file_object.seek(offset)
+            self.loaded = self.message.read_next(headers_only)
+            if not self.loaded:
+                return False
+            self.fields = {offset_key: offset, length_key: self.message.get_field(length_key)}
+        else:
+            self.fields[offset_key] = offset
+        self.file_object.seek(offset + self.fields[length_key])
+        return True
+
+    def load(self):
+        if not self.loaded:
+            position = self.file_object.tell()
+            self.file_object.seek(self.fields[offset_key])
+            self.loaded = self.message.read_next()
+            self.file_object.seek(position)
+
+    def write(self, file_object_):
+        if self.modified or self.buffer is None:
+            self.message.write(file_object_)
+        else:
+            write_raw(self.buffer, self.fields[offset_key], self.fields[length_key], file_object_)
+
+    def set_field(self, name, value):
+        self.load()
+        self.message.set_field(name, value)
+        self.modified = True
+
+    def get_field(self, name):
+        if self.modified or self.fields is None or name not in self.fields:
+            self.load()
+            return self.message.get_field(name)
+        return self.fields[name]
+
+    def get_fields(self, names):
+        if self.modified or self.fields is None or any([name not in self.fields for name in names]):
+            return super(grib1_scanner, self).get_fields(names)
+        fields = self.fields
+        return [fields[name] for name in names]
+
+    def release(self):
+        if self.loaded:
+            self.message.release()
+            self.loaded = False
+        self.modified = False
+        self.fields = None
+
+    def eof(self):
+        return self.fields is None
+
+
 # CSV header-only implementation of grib file interface for testing purposes
 class csv_grib_mock(grib_file):
     columns = [date_key, time_key, param_key, levtype_key, level_key]
@@ -91,10 +434,13 @@ class csv_grib_mock(grib_file):
     def __init__(self, file_object_):
         super(csv_grib_mock, self).__init__(file_object_)
         self.row = []
-        self.reader = csv.reader(file_object_, delimiter=',')
+        self.offset, self.length = 0, 0
 
     def read_next(self, headers_only=False):
-        self.row = next(self.reader, None)
+        self.offset = self.file_object.tell()
+        line = self.file_object.readline()
+        self.length = len(line)
+        self.row = next(csv.reader([line], delimiter=','), None) if line else None
         return self.row is not None
 
     def write(self, file_object_):
@@ -105,8 +451,16 @@ class csv_grib_mock(grib_file):
         self.row[csv_grib_mock.columns.index(name)] = value
 
     def get_field(self, name):
+        if name == offset_key:
+            return self.offset
+        if name == length_key:
+            return self.length
         return int(self.row[csv_grib_mock.columns.index(name)])
 
+    def get_fields(self, names):
+        row, columns = self.row, csv_grib_mock.columns
+        return [int(row[columns.index(name)]) if name in columns else self.get_field(name) for name in names]
+
     def release(self):
         self.row = []
 
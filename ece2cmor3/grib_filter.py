@@ -1,12 +1,17 @@
+import hashlib
 import json
 import logging
 import datetime
+import errno
+import fcntl
 import os
-import resource
+import multiprocessing
+import shutil
 import threading
 from dateutil import relativedelta
 import numpy
-from ece2cmor3 import cmor_target, cmor_source, cmor_task, cmor_utils, grib_file
+from ece2cmor3 import cmor_target, cmor_source, cmor_task, cmor_utils, grib_file, grib_index, grib_aggregator, \
+    output_sinks, postproc
 
 # Log object.
 log = logging.getLogger(__name__)
@@ -21,36 +26,178 @@ accum_codes = []
 varsfreq = {}
 varstasks = {}
 varsfiles = {}
+varsroutes = {}
+varsselections = {}
+varsaggregations = {}
+varspipes = {}
+varsclusters = {}
+varsprefixes = {}
+varsgridsizes = {}
 spvar = None
+use_index = True
+processes = 1
+reuse_output = True
+manifest_name = "filter_manifest.json"
+manifest_version = 1
+select_times = True
+aggregate_times = False
+pipe_streams = False
+pipe_threads = []
+pipe_stop = threading.Event()
+pipe_poll_interval = 0.1
+pipe_join_timeout = 60.
+carry_boundary = False
+boundary_files = {}
+boundary_extension = ".next"
+use_catalogue = True
+catalogue_dir = None
+catalogue_extension = ".freqs.json"
+catalogue_version = 1
 
 
 # Initializes the module, looks up previous month files and inspects the first
 # day in the input files to set up an administration of the fields.
 def update_sp_key(fname):
     global spvar
-    for key in varsfreq:
-        freq = varsfreq[key]
-        if key[0] == 154:
+    for keys in varsprefixes.get(154, {}).values():
+        for key in keys:
+            freq = varsfreq[key]
             if spvar is None or spvar[1] >= freq:
                 spvar = (154, freq, fname)
-        if key[0] == 134:
+    for keys in varsprefixes.get(134, {}).values():
+        for key in keys:
+            freq = varsfreq[key]
             if spvar is None or spvar[1] > freq:
                 spvar = (134, freq, fname)
 
 
-def initialize(gpfile, shfile, tmpdir):
-    global gridpoint_file, prev_gridpoint_file, spectral_file, prev_spectral_file, temp_dir, varsfreq, accum_codes
+def initialize(gpfile, shfile, tmpdir, expname=None):
+    global gridpoint_file, prev_gridpoint_file, spectral_file, prev_spectral_file, temp_dir, varsfreq, accum_codes, \
+        spvar, varsprefixes, varsgridsizes
+    varsfreq, varsprefixes, varsgridsizes, spvar = {}, {}, {}, None
     gridpoint_file = gpfile
     spectral_file = shfile
     temp_dir = tmpdir
     accum_codes = load_accum_codes(
         os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "grib_codes.json"))
-    prev_gridpoint_file, prev_spectral_file = get_prev_files(gridpoint_file)
-    with open(gpfile) as gpf, open(shfile) as shf:
-        varsfreq.update(inspect_day(grib_file.create_grib_file(gpf), grid=cmor_source.ifs_grid.point))
-        update_sp_key(gpfile)
-        varsfreq.update(inspect_day(grib_file.create_grib_file(shf), grid=cmor_source.ifs_grid.spec))
-        update_sp_key(shfile)
+    prev_gridpoint_file, prev_spectral_file = [boundary_files.get(os.path.abspath(f), f) if f else f
+                                              for f in get_prev_files(gridpoint_file)]
+    for f in [prev_gridpoint_file, prev_spectral_file]:
+        if f in boundary_files.values():
+            log.info("Taking previous month records from carried boundary file %s" % f)
+    catalogue = load_catalogue(expname) if use_catalogue and expname else None
+    entries = len(catalogue) if catalogue is not None else 0
+    for path, grid in [(gpfile, cmor_source.ifs_grid.point), (shfile, cmor_source.ifs_grid.spec)]:
+        with open(path) as fin:
+            varsfreq.update(get_frequencies(fin, grid, catalogue))
+        varsprefixes = index_frequencies(varsfreq)
+        update_sp_key(path)
+    if catalogue is not None and len(catalogue) > entries:
+        save_catalogue(expname, catalogue)
+
+
+# Returns the output frequencies of the fields in the file, taken from the catalogue if it contains the output
+# configuration of the first time step. Otherwise, the first day is inspected and the result is added to the catalogue.
+def get_frequencies(file_object, grid, catalogue=None):
+    if catalogue is None:
+        return inspect_day(create_reader(file_object), grid)
+    configuration = get_output_configuration(create_reader(file_object), grid)
+    if configuration in catalogue:
+        log.info("Taking field frequencies of %s from the frequency catalogue" % file_object.name)
+        return {tuple(entry[:-1]): entry[-1] for entry in catalogue[configuration]}
+    file_object.seek(0)
+    result = inspect_day(create_reader(file_object), grid)
+    catalogue[configuration] = sorted([list(key) + [int(freq)] for key, freq in result.iteritems()])
+    return result
+
+
+# Returns the identifier of the IFS output configuration of the file: a hash of the codes, level types and levels of
+# the fields in the first time step
+def get_output_configuration(gribfile, grid):
+    fields, stamp = set(), None
+    while gribfile.read_next(headers_only=True):
+        header = gribfile.get_fields(grib_file.header_keys)
+        gribfile.release()
+        if stamp is None:
+            stamp = header[3:]
+        elif header[3:] != stamp:
+            break
+        fields.add(tuple(header[:3]))
+    return '.'.join([str(grid), hashlib.sha1(json.dumps(sorted(fields))).hexdigest()])
+
+
+# Builds the lookup of the frequency keys by code and by table and level type
+def index_frequencies(freqs):
+    result = {}
+    for key in sorted(freqs.keys()):
+        result.setdefault(key[0], {}).setdefault(key[1:3], []).append(key)
+    return result
+
+
+# Returns the frequency catalogue file of the experiment. It is stored in the parent of the temporary directories of
+# the months, unless the catalogue directory is set.
+def mkcataloguename(expname):
+    directory = catalogue_dir if catalogue_dir is not None else os.path.dirname(os.path.abspath(temp_dir))
+    return os.path.join(directory, expname + catalogue_extension)
+
+
+# Reads the frequency catalogue of the experiment, returns an empty catalogue if it does not exist or is outdated
+def load_catalogue(expname):
+    path = mkcataloguename(expname)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as fin:
+            data = json.load(fin)
+    except (IOError, ValueError) as e:
+        log.warning("Could not read frequency catalogue %s, reason: %s" % (path, str(e)))
+        return {}
+    if data.get("version") != catalogue_version:
+        log.info("Frequency catalogue %s has an outdated version, recreating it" % path)
+        return {}
+    return data.get("configurations", {})
+
+
+# Writes the frequency catalogue of the experiment
+def save_catalogue(expname, catalogue):
+    path = mkcataloguename(expname)
+    try:
+        with open(path + ".tmp", 'w') as fout:
+            json.dump({"version": catalogue_version, "configurations": catalogue}, fout)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        log.warning("Could not write frequency catalogue %s, reason: %s" % (path, str(e)))
+
+
+# Creates a reader for the grib file object, serving the message headers from the index if enabled
+def create_reader(file_object):
+    if use_index:
+        return grib_index.index_reader(file_object, grib_index.get_index(file_object.name))
+    return grib_file.create_grib_file(file_object)
+
+
+# Creates a reader for the messages of the previous month file that belong to the given month. These form the last
+# timestep of the file, which is selected from the index or located by scanning message boundaries from the end.
+def create_tail_reader(file_object, month):
+    if use_index:
+        return grib_index.index_reader(file_object, get_month_records(grib_index.get_index(file_object.name), month))
+    buf = grib_file.map_file(file_object)
+    offset = None
+    if buf is not None:
+        offset = grib_file.find_tail(buf, lambda h: (grib_file.get_grib1_field(h, grib_file.date_key) / 100) % 100
+                                     == month)
+        buf.close()
+    if offset is None:
+        log.info("Could not locate the last timestep in %s from the end of the file, scanning all messages" %
+                 file_object.name)
+        offset = 0
+    file_object.seek(offset)
+    return grib_file.create_grib_file(file_object)
+
+
+# Selects the index records of the given month
+def get_month_records(records, month):
+    return records[(records[grib_file.date_key] % 10 ** 4) / 10 ** 2 == month]
 
 
 # Function reading the file with grib-codes of accumulated fields
@@ -81,15 +228,15 @@ def inspect_day(gribfile, grid):
     inidate, initime = -99, -1
     records = {}
     while gribfile.read_next(headers_only=True):
-        date = gribfile.get_field(grib_file.date_key)
-        time = gribfile.get_field(grib_file.time_key) / 100
+        header = gribfile.get_fields(grib_file.header_keys)
+        date, time = header[3], header[4] / 100
         if date == inidate + 1 and time == initime:
             break
         if inidate < 0:
             inidate = date
         if initime < 0:
             initime = time
-        key = get_record_key(gribfile) + (grid,)
+        key = get_header_key(header) + (grid,)
         if key in records:
             if time not in records[key]:
                 records[key].append(time)
@@ -111,8 +258,13 @@ def inspect_day(gribfile, grid):
 
 # Creates a key (code + table + level type + level) for a grib message iterator
 def get_record_key(gribfile):
-    codevar, codetab = grib_tuple_from_int(gribfile.get_field(grib_file.param_key))
-    levtype, level = gribfile.get_field(grib_file.levtype_key), gribfile.get_field(grib_file.level_key)
+    return get_header_key(gribfile.get_fields(grib_file.header_keys[:3]))
+
+
+# Creates a key (code + table + level type + level) from the decoded message header
+def get_header_key(header):
+    codevar, codetab = grib_tuple_from_int(header[0])
+    levtype, level = header[1], header[2]
     if levtype == grib_file.pressure_level_hPa_code:
         level *= 100
         levtype = grib_file.pressure_level_Pa_code
@@ -179,50 +331,409 @@ def mkfname(key):
     return '.'.join([str(key[0]), str(key[1]), str(key[2])])
 
 
-# Construct files for keys and tasks
+# Construct the field streams for keys and tasks. Every (code, table, level type) field is written once per frequency
+# and time selection, and the input of a task is the ordered list of the streams of its source codes.
 def cluster_files(valid_tasks):
-    global varstasks, varsfiles
+    global varstasks, varsfiles, varsselections, varsaggregations, varsclusters
     task2files, task2freqs = {}, {}
+    varsselections, varsaggregations, varsclusters = {}, {}, {}
+    task2keys = {}
+    for key, tsklist in varstasks.iteritems():
+        for task in tsklist:
+            task2keys.setdefault(task, []).append(key)
     for task in valid_tasks:
-        task2files[task] = set()
+        task2files[task] = {}
         task2freqs[task] = set()
-        for key, tsklist in varstasks.iteritems():
-            if task in tsklist:
-                task2files[task].add(mkfname(key))
-                if key[3] == -1:
-                    task2freqs[task].update([varsfreq[k] for k in varsfreq.keys() if
-                                             (k[0], k[1], k[2]) == (key[0], key[1], key[2])])
-                else:
-                    task2freqs[task].add(varsfreq[key])
-    for task, fnames in task2files.iteritems():
-        codes = {(int(f.split('.')[0]), int(f.split('.')[1])): f for f in sorted(list(fnames))}
-        cum_file = '_'.join([codes[k] for k in codes if k in accum_codes])
-        inst_file = '_'.join([codes[k] for k in codes if k not in accum_codes])
-        task2files[task] = filter(None, [cum_file, inst_file])
+        for key in task2keys.get(task, []):
+            task2files[task][(key[0], key[1])] = mkfname(key)
+            if key[3] == -1:
+                task2freqs[task].update([varsfreq[k] for k in varsprefixes.get(key[0], {}).get(key[1:3], [])])
+            else:
+                task2freqs[task].add(varsfreq[key])
+    task2streams, footprints = {}, {}
     for task, freqset in task2freqs.iteritems():
         maxfreq = max(freqset)
         if any([f for f in freqset if maxfreq % f != 0]):
             log.error("Task depends on input fields with incompatible time steps")
             task.status = cmor_task.status_failed
             task2files.pop(task, None)
+            continue
         task2freqs[task] = maxfreq
-        task2files[task] = ['.'.join([p, str(maxfreq)]) for p in task2files[task]]
+        suffix = str(maxfreq)
+        selection = postproc.get_time_selection(task) if select_times else None
+        if selection is not None and selection[1] is None and set(range(0, 24, maxfreq)) <= set(selection[0]):
+            selection = None
+        if selection is not None:
+            suffix = '.'.join([suffix, mkselname(selection)])
+        aggregation = postproc.get_time_aggregation(task) if aggregate_times and not use_parallel() else None
+        if aggregation is not None:
+            required = get_footprints(task2keys.get(task, []), '.'.join([suffix, mkaggname(aggregation)]))
+            required = {f: n for f, n in required.iteritems() if f not in footprints}
+            if sum(footprints.values()) + sum(required.values()) > grib_aggregator.max_memory_gb * 1.e9:
+                log.info("Time aggregation of variable %s in table %s exceeds the aggregator memory, leaving it to "
+                         "cdo" % (task.target.variable, task.target.table))
+                aggregation = None
+            else:
+                footprints.update(required)
+        if aggregation is not None:
+            suffix = '.'.join([suffix, mkaggname(aggregation)])
+        fnames = task2files[task]
+        streams = {code: '.'.join([fname, suffix]) for code, fname in fnames.iteritems()}
+        for code, stream in streams.iteritems():
+            if selection is not None:
+                varsselections[stream] = selection
+            if aggregation is not None:
+                varsaggregations[stream] = aggregation
+            cluster = sorted([f for c, f in fnames.iteritems() if (c in accum_codes) == (code in accum_codes)])
+            varsclusters.setdefault(stream, set()).add('_'.join(cluster))
+        codes = [(c.var_id, c.tab_id) for c in task.source.get_root_codes()]
+        order = sorted(streams.keys(), key=lambda c: (codes.index(c) if c in codes else len(codes), c))
+        task2streams[task] = streams
+        task2files[task] = [streams[c] for c in order]
     varsfiles = {key: set() for key in varstasks}
     for key in varsfiles:
         for t in varstasks[key]:
-            f = task2files[t][0]
-            if len(task2files[t]) == 2 and (key[0], key[1]) not in accum_codes:
-                f = task2files[t][1]
-            varsfiles[key].add((f, task2freqs[t]))
+            if t in task2streams:
+                varsfiles[key].add((task2streams[t][(key[0], key[1])], task2freqs[t]))
+    compile_routes()
     return task2files, task2freqs
 
 
+# Creates the file name suffix for the time selection
+def mkselname(selection):
+    hours, days = selection
+    return ''.join(["h" + '_'.join([str(h) for h in hours]) if hours else "",
+                    "d" + '_'.join([str(d) for d in days]) if days else ""])
+
+
+# Creates the file name suffix for the time aggregation
+def mkaggname(aggregation):
+    return ''.join(aggregation)
+
+
+# Returns the memory footprints of aggregating the streams of the keys with the given suffix, by stream
+def get_footprints(keys, suffix):
+    result = {}
+    for key in keys:
+        nfields = len(varsprefixes.get(key[0], {}).get(key[1:3], [])) if key[3] == -1 else 1
+        stream = '.'.join([mkfname(key), suffix])
+        result[stream] = result.get(stream, 0) + grib_aggregator.get_footprint(nfields, get_grid_size(key[4]))
+    return result
+
+
+# Returns the number of values of the first message in the input file of the grid, zero if it cannot be read
+def get_grid_size(grid):
+    if grid not in varsgridsizes:
+        path = gridpoint_file if grid == cmor_source.ifs_grid.point else spectral_file
+        varsgridsizes[grid] = 0
+        try:
+            with open(path) as fin:
+                gribfile = grib_file.create_library_file(fin)
+                if gribfile.read_next(headers_only=True):
+                    varsgridsizes[grid] = gribfile.get_field("numberOfValues")
+                    gribfile.release()
+        except Exception as e:
+            log.warning("Could not determine the grid size of %s, reason: %s" % (path, str(e)))
+    return varsgridsizes[grid]
+
+
+# Returns the sink wrappers that average the records of the streams with a time aggregation
+def get_aggregators():
+    return {f: lambda output, a=a: grib_aggregator.aggregator(output, *a) for f, a in varsaggregations.iteritems()}
+
+
+# Returns whether the record at the given (shifted) date and time stamp is kept by the time selection of the output file
+def is_selected(date, timestamp, selection):
+    hours, days = selection
+    if hours is not None and timestamp / 100 not in hours:
+        return False
+    return days is None or date % 100 in days
+
+
+# Compiles the routing table, mapping record keys (code, table, level type, level) to the tuple of output file infos
+# and the record frequency. Model levels seen in the first day are expanded, other model levels are routed through
+# the wildcard level -1.
+def compile_routes():
+    global varsroutes
+    varsroutes = make_routes(varsfiles)
+
+
+# Creates the routing table for the given output files per key
+def make_routes(keyfiles):
+    files = {}
+    for key, fileset in keyfiles.iteritems():
+        route_key = get_route_key(key)
+        if route_key in files:
+            files[route_key].update(fileset)
+        else:
+            files[route_key] = set(fileset)
+    routes = {k: (tuple(v), 0) for k, v in files.iteritems()}
+    expanded = set()
+    for key, freq in varsfreq.iteritems():
+        route_key = get_route_key(key)
+        if route_key in files and key[:4] not in expanded:
+            routes[key[:4]] = (tuple(files[route_key]), freq)
+            expanded.add(key[:4])
+    return routes
+
+
+# Returns the key in the routing table for the given field key
+def get_route_key(key):
+    if key[2] == grib_file.hybrid_level_code:
+        return key[0], key[1], key[2], -1
+    return key[:4]
+
+
+# Returns the output file infos and frequency for the record key, or None if the record is not filtered
+def get_route(key, routes=None):
+    if routes is None:
+        routes = varsroutes
+    route = routes.get(key, None)
+    if route is None:
+        return routes.get(get_route_key(key), None)
+    return route
+
+
 # Main execution loop
 def execute(tasks, month, multi_threaded=False):
     global varsfiles
     valid_tasks = validate_tasks(tasks)
     task2files, task2freqs = cluster_files(valid_tasks)
-    filehandles = open_files(varsfiles)
+    signatures, stamps = get_output_signatures(), get_input_stamps()
+    reuse_files(month, signatures, stamps)
+    select_pipes(task2files)
+    stats = {}
+    if any(get_output_files()):
+        if use_parallel():
+            stats = proc_parallel(month, processes)
+        else:
+            stats = proc_serial(month, multi_threaded)
+    output_sinks.report(stats)
+    report_savings(stats)
+    save_manifest(month, signatures, stamps)
+    update_boundaries()
+    start_pipes(month)
+    for task in task2files:
+        if not task.status == cmor_task.status_failed:
+            setattr(task, cmor_task.filter_output_key, [os.path.join(temp_dir, p) for p in task2files[task]])
+            aggregations = [varsaggregations[p] for p in task2files[task] if p in varsaggregations]
+            if any(aggregations):
+                setattr(task, cmor_task.time_aggregation_key, aggregations[0])
+    for task in task2freqs:
+        if not task.status == cmor_task.status_failed:
+            setattr(task, cmor_task.output_frequency_key, task2freqs[task])
+    return valid_tasks
+
+
+# Takes the streams that are the single input of a single task whose post-processing reads its input once, out of the
+# filter administration. These streams are served through named pipes after the regular filter pass, which requires
+# the message index. All other streams are written to files.
+def select_pipes(task2files):
+    global varspipes
+    varspipes = {}
+    if not pipe_streams or not use_index:
+        return
+    consumers = {}
+    for task, files in task2files.iteritems():
+        for f in files:
+            consumers.setdefault(f, []).append(task)
+    streamable = set([f for f, tasks in consumers.iteritems() if len(tasks) == 1 and len(task2files[tasks[0]]) == 1
+                      and f not in varsaggregations and postproc.is_streamable(tasks[0])])
+    pipes = {}
+    for key in varsfiles.keys():
+        for t in [t for t in varsfiles[key] if t[0] in streamable]:
+            pipes.setdefault(t[0], {})[key] = {t}
+            varsfiles[key].remove(t)
+        if not any(varsfiles[key]):
+            varsfiles.pop(key)
+    varspipes = {f: (make_routes(keyfiles), keyfiles.keys()[0][4]) for f, keyfiles in pipes.iteritems()}
+    log.info("Serving %d filter output streams through named pipes" % len(varspipes))
+    compile_routes()
+
+
+# Creates the named pipes and starts a writer thread per pipe. Every writer waits for its reader and filters the
+# records of its stream from the indexed input files of its grid.
+def start_pipes(month):
+    global pipe_threads
+    pipe_threads = []
+    pipe_stop.clear()
+    for f, (routes, grid) in varspipes.iteritems():
+        path = os.path.join(temp_dir, f)
+        if os.path.exists(path):
+            os.remove(path)
+        os.mkfifo(path)
+        thread = threading.Thread(target=serve_pipe, name=f, args=(month, f, routes, grid))
+        thread.setDaemon(True)
+        thread.start()
+        pipe_threads.append(thread)
+
+
+# Writes the records of the stream to its named pipe, stops when the reader closes the pipe
+def serve_pipe(month, fname, routes, grid):
+    paths = (gridpoint_file, prev_gridpoint_file) if grid == cmor_source.ifs_grid.point else \
+        (spectral_file, prev_spectral_file)
+    fd = open_pipe(os.path.join(temp_dir, fname))
+    if fd is None:
+        log.warning("Named pipe %s has not been read" % fname)
+        return
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            proc_mon(month, paths[0], paths[1], {fname: fout}, routes)
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        log.info("Reader of named pipe %s stopped before the end of the stream" % fname)
+
+
+# Opens the write end of the named pipe once a reader has opened it, returns None if the pipes are closed before
+def open_pipe(path):
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            if pipe_stop.wait(pipe_poll_interval):
+                return None
+            continue
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return fd
+
+
+# Stops the writers of the named pipes that have not been read and removes the pipes
+def close_pipes():
+    global varspipes, pipe_threads
+    pipe_stop.set()
+    for thread in pipe_threads:
+        thread.join(pipe_join_timeout)
+        if thread.is_alive():
+            log.error("Writer of named pipe %s did not finish within %d seconds" % (thread.name, pipe_join_timeout))
+    for f in varspipes:
+        path = os.path.join(temp_dir, f)
+        if os.path.exists(path):
+            os.remove(path)
+    varspipes, pipe_threads = {}, []
+
+
+# Returns the size and modification time of the input files, as stored in the manifest
+def get_input_stamps():
+    result = {}
+    for path in [gridpoint_file, spectral_file, prev_gridpoint_file, prev_spectral_file]:
+        if path:
+            stat = os.stat(path)
+            result[os.path.abspath(path)] = [stat.st_size, stat.st_mtime]
+    return json.loads(json.dumps(result))
+
+
+# Returns the keys, frequencies and time selection of the records written to every output file, as stored in the
+# manifest
+def get_output_signatures():
+    result = {}
+    for key, fileset in varsfiles.iteritems():
+        for f, freq in fileset:
+            if f not in result:
+                result[f] = {"keys": [], "selection": varsselections.get(f, None)}
+            result[f]["keys"].append(list(key) + [freq])
+    for signature in result.values():
+        signature["keys"].sort()
+    return json.loads(json.dumps(result))
+
+
+# Takes the output files of a previous run that are listed in the manifest in the temporary directory, with the same
+# input files, keys and file size, out of the filter administration. The manifest is removed until the filter has
+# finished.
+def reuse_files(month, signatures, stamps):
+    path = os.path.join(temp_dir, manifest_name)
+    if not os.path.isfile(path):
+        return
+    manifest = None
+    try:
+        with open(path, 'r') as fin:
+            manifest = json.load(fin)
+    except (IOError, ValueError) as e:
+        log.warning("Could not read filter manifest %s, reason: %s" % (path, str(e)))
+    os.remove(path)
+    if not reuse_output or carry_boundary or manifest is None:
+        return
+    if manifest.get("version") != manifest_version or manifest.get("month") != month or \
+            manifest.get("inputs") != stamps:
+        log.info("Filter manifest %s does not match the input files, filtering all fields" % path)
+        return
+    reused = set()
+    for f, entry in manifest.get("files", {}).iteritems():
+        fpath = os.path.join(temp_dir, f)
+        if signatures.get(f, None) == entry.get("signature", None) and os.path.isfile(fpath) and \
+                os.path.getsize(fpath) == entry.get("size", -1):
+            reused.add(f)
+    log.info("Reusing %d of %d filter output files listed in manifest %s" % (len(reused), len(signatures), path))
+    for key in varsfiles.keys():
+        varsfiles[key] = set([t for t in varsfiles[key] if t[0] not in reused])
+        if not any(varsfiles[key]):
+            varsfiles.pop(key)
+    compile_routes()
+
+
+# Writes the manifest of the filter output files
+def save_manifest(month, signatures, stamps):
+    path = os.path.join(temp_dir, manifest_name)
+    files = {}
+    for f, signature in signatures.iteritems():
+        fpath = os.path.join(temp_dir, f)
+        if os.path.isfile(fpath):
+            files[f] = {"signature": signature, "size": os.path.getsize(fpath)}
+    try:
+        with open(path + ".tmp", 'w') as fout:
+            json.dump({"version": manifest_version, "month": month, "inputs": stamps, "files": files}, fout,
+                      indent=1)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        log.warning("Could not write filter manifest %s, reason: %s" % (path, str(e)))
+
+
+# Logs the number of bytes saved by writing every field stream once instead of once per cluster of task inputs
+def report_savings(stats):
+    saved = sum([stats[f][1] * (len(clusters) - 1) for f, clusters in varsclusters.iteritems() if f in stats])
+    log.info("Field streams are shared by %d task input clusters, saving %d bytes of duplicate output" %
+             (sum([len(c) for c in varsclusters.values()]), saved))
+
+
+# Replaces the consumed boundary files by the ones extracted from the current files
+def update_boundaries():
+    global boundary_files
+    for path in [prev_gridpoint_file, prev_spectral_file]:
+        if path in boundary_files.values():
+            remove_boundary(path)
+    boundary_files = {}
+    if carry_boundary:
+        for path in [gridpoint_file, spectral_file]:
+            boundary_files[os.path.abspath(path)] = os.path.join(temp_dir, mkboundaryname(path))
+
+
+# Removes all carried boundary files, to be called after the last month
+def clear_boundaries():
+    global boundary_files
+    for path in boundary_files.values():
+        remove_boundary(path)
+    boundary_files = {}
+
+
+# Removes the boundary file and its message index
+def remove_boundary(path):
+    for f in [path, grib_index.get_index_path(path)]:
+        if os.path.exists(f):
+            os.remove(f)
+    grib_index.indices_.pop(path, None)
+
+
+# Returns the name of the file collecting the next month records of the given input file
+def mkboundaryname(path):
+    return os.path.basename(path) + boundary_extension
+
+
+# Processes the gridpoint and spectral files in this process, optionally in one thread per file. Returns the sink
+# statistics.
+def proc_serial(month, multi_threaded=False):
+    filehandles = output_sinks.sink_manager(temp_dir, wrappers=get_aggregators())
     if multi_threaded:
         threads = []
         for path, prev_path in [(gridpoint_file, prev_gridpoint_file), (spectral_file, prev_spectral_file)]:
@@ -234,15 +745,91 @@ def execute(tasks, month, multi_threaded=False):
     else:
         for path, prev_path in [(gridpoint_file, prev_gridpoint_file), (spectral_file, prev_spectral_file)]:
             proc_mon(month, path, prev_path, filehandles)
-    for handle in filehandles.values():
-        handle.close()
-    for task in task2files:
-        if not task.status == cmor_task.status_failed:
-            setattr(task, cmor_task.filter_output_key, [os.path.join(temp_dir, p) for p in task2files[task]])
-    for task in task2freqs:
-        if not task.status == cmor_task.status_failed:
-            setattr(task, cmor_task.output_frequency_key, task2freqs[task])
-    return valid_tasks
+    filehandles.close()
+    for f in get_output_files():
+        if f not in filehandles.created:
+            open(os.path.join(temp_dir, f), 'w').close()
+    return filehandles.stats
+
+
+# Returns whether the filter runs in a pool of processes, which requires the message index
+def use_parallel():
+    return processes > 1 and use_index
+
+
+# Processes the input files with a pool of processes. Every current month file is split into message-aligned ranges
+# that are filtered into part files, which are concatenated in the original message order afterwards. The last
+# timestep of the previous month files is filtered by a single job. Returns the sink statistics summed over the jobs.
+def proc_parallel(month, nprocs):
+    jobs = []
+    for path, prev_path in [(gridpoint_file, prev_gridpoint_file), (spectral_file, prev_spectral_file)]:
+        for grib_path, prev in [(prev_path, True), (path, False)]:
+            if not grib_path:
+                continue
+            records = grib_index.get_index(grib_path)
+            for start, stop in [(0, len(records))] if prev else get_ranges(records, nprocs):
+                jobs.append((len(jobs), month, grib_path, start, stop, prev))
+    log.info("Filtering %d message ranges with %d processes" % (len(jobs), nprocs))
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        results = pool.map(proc_range, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    merge_parts(len(jobs))
+    stats = {}
+    for job_stats in results:
+        for f, counts in job_stats.iteritems():
+            total = stats.setdefault(f, [0, 0])
+            total[0] += counts[0]
+            total[1] += counts[1]
+    return stats
+
+
+# Partitions the indexed messages into at most n contiguous ranges of roughly equal byte size
+def get_ranges(records, n):
+    if len(records) == 0:
+        return []
+    offsets = records[grib_file.offset_key]
+    total = offsets[-1] + records[-1][grib_file.length_key]
+    bounds = numpy.searchsorted(offsets, numpy.arange(1, n) * (total / n))
+    edges = sorted(set([0, len(records)] + [int(b) for b in bounds]))
+    return zip(edges[:-1], edges[1:])
+
+
+# Returns the part file name for the given output file and job
+def mkpartname(fname, job_index):
+    return '.'.join([fname, "part" + str(job_index)])
+
+
+# Filters a range of messages into part files, executed by the worker processes. Returns the sink statistics.
+def proc_range(job):
+    job_index, month, path, start, stop, prev = job
+    records = grib_index.get_index(path)[start:stop]
+    if prev:
+        records = get_month_records(records, month)
+    sinks = output_sinks.sink_manager(temp_dir, suffix=mkpartname("", job_index))
+    with open(path, 'r') as fin:
+        try:
+            if prev:
+                proc_prev_month(month, grib_index.index_reader(fin, records), sinks)
+            else:
+                proc_next_month(month, grib_index.index_reader(fin, records), sinks)
+        finally:
+            sinks.close()
+    return sinks.stats
+
+
+# Concatenates the part files of all jobs into the output files
+def merge_parts(njobs):
+    for f in get_output_files():
+        with open(os.path.join(temp_dir, f), 'w') as fout:
+            for i in range(njobs):
+                partpath = os.path.join(temp_dir, mkpartname(f, i))
+                if os.path.exists(partpath):
+                    with open(partpath, 'r') as fin:
+                        shutil.copyfileobj(fin, fout, 16 * 1024 * 1024)
+                    os.remove(partpath)
 
 
 # Checks tasks that are compatible with the variables listed in grib_vars and
@@ -257,18 +844,18 @@ def validate_tasks(tasks):
         codes = task.source.get_root_codes()
         target_freq = cmor_target.get_freq(task.target)
         grid_key = task.source.grid_
-        for c in codes:
-            levtype, levels = get_levels(task, c)
+        codelevels = [(c, get_levels(task, c)) for c in codes]
+        for c, (levtype, levels) in codelevels:
             for l in levels:
                 if task.status == cmor_task.status_failed:
                     break
                 key = (c.var_id, c.tab_id, levtype, l, task.source.grid_)
                 match_key = key
                 if levtype == grib_file.hybrid_level_code:
-                    matches = [k for k in varsfreq.keys() if k[:3] == key[:3] and k[4] == key[4]]
+                    matches = [k for k in varsprefixes.get(key[0], {}).get(key[1:3], []) if k[4] == key[4]]
                     match_key = key if not any(matches) else matches[0]
                 if c.var_id == 134 and len(codes) == 1:
-                    matches = [k for k in varsfreq.keys() if k[:3] == key[:3]]
+                    matches = varsprefixes.get(key[0], {}).get(key[1:3], [])
                     match_key = key if not any(matches) else matches[0]
                     if any(matches):
                         grid_key = match_key[4]
@@ -286,8 +873,7 @@ def validate_tasks(tasks):
                     task.set_failed()
                     break
         if task.status != cmor_task.status_failed:
-            for c in codes:
-                levtype, levels = get_levels(task, c)
+            for c, (levtype, levels) in codelevels:
                 for l in levels:
                     key = (c.var_id, c.tab_id, levtype, l, grid_key)
                     if key in varstasks:
@@ -298,27 +884,23 @@ def validate_tasks(tasks):
     return valid_tasks
 
 
-def open_files(vars2files):
+# Returns the names of all filter output files
+def get_output_files():
     files = set()
-    for fileset in vars2files.values():
-        files.update(set([t[0] for t in fileset]))
-    numreq = len(files)
-    softlim = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
-    if numreq > softlim + 1:
-        try:
-            resource.setrlimit(resource.RLIMIT_NOFILE, (numreq + 1, -1))
-        except ValueError:
-            return {}
-    return {f: open(os.path.join(temp_dir, f), 'w') for f in files}
+    for fileset in varsfiles.values():
+        files.update([t[0] for t in fileset])
+    if carry_boundary:
+        files.update([mkboundaryname(f) for f in [gridpoint_file, spectral_file]])
+    return files
 
 
 # Processes month of grib data, including 0-hour fields in the previous month file.
-def proc_mon(month, cur_grib_file, prev_grib_file, handles=None):
+def proc_mon(month, cur_grib_file, prev_grib_file, handles=None, routes=None):
     if prev_grib_file:
         with open(prev_grib_file, 'r') as fin:
-            proc_prev_month(month, grib_file.create_grib_file(fin), handles)
+            proc_prev_month(month, create_tail_reader(fin, month), handles, routes)
     with open(cur_grib_file, 'r') as fin:
-        proc_next_month(month, grib_file.create_grib_file(fin), handles)
+        proc_next_month(month, create_reader(fin), handles, routes)
 
 
 # Converts cmor-levels to grib levels code
@@ -353,67 +935,78 @@ def fix_date_time(date, time):
     return timestamp.year * 10 ** 4 + timestamp.month * 10 ** 2 + timestamp.day, timestamp.hour
 
 
-# Writes the grib messages
-def write_record(gribfile, shift=0, handles=None):
-    key = get_record_key(gribfile)
-    if key[2] == grib_file.hybrid_level_code:
-        matches = [varsfiles[k] for k in varsfiles if k[:3] == key[:3]]
-    else:
-        matches = [varsfiles[k] for k in varsfiles if k[:4] == key[:4]]
-    var_infos = set()
-    for match in matches:
-        var_infos.update(match)
-    if not any(var_infos):
+# Writes the grib messages, taking the routing keys from the decoded header if given
+def write_record(gribfile, shift=0, handles=None, header=None, routes=None):
+    if header is None:
+        header = gribfile.get_fields(grib_file.header_keys)
+    route = get_route(get_header_key(header), routes)
+    if route is None:
         return
-    timestamp = gribfile.get_field(grib_file.time_key)
+    var_infos, freq = route
+    date, timestamp = header[3], header[4]
     if shift:
-        matches = [k for k in varsfreq.keys() if k[:-1] == key]
-        freq = varsfreq[matches[0]] if any(matches) else 0
         shifttime = timestamp + shift * freq * 100
         if shifttime < 0 or shifttime >= 2400:
-            newdate, hours = fix_date_time(gribfile.get_field(grib_file.date_key), shifttime / 100)
-            gribfile.set_field(grib_file.date_key, newdate)
+            date, hours = fix_date_time(date, shifttime / 100)
+            gribfile.set_field(grib_file.date_key, date)
             shifttime = 100 * hours
         timestamp = int(shifttime)
         gribfile.set_field(grib_file.time_key, timestamp)
-    levtype = gribfile.get_field(grib_file.levtype_key)
-    if levtype == 210:
-        gribfile.set_field(grib_file.levtype_key, 99)
+    if header[1] == grib_file.pressure_level_Pa_code:
+        gribfile.set_field(grib_file.levtype_key, grib_file.pressure_level_Pa_grib1_code)
     for var_info in var_infos:
         if timestamp / 100 % var_info[1] != 0:
             continue
+        selection = varsselections.get(var_info[0], None)
+        if selection is not None and not is_selected(date, timestamp, selection):
+            continue
         handle = handles.get(var_info[0], None) if handles else None
         if handle:
             gribfile.write(handle)
         else:
-            with open(var_info[0], 'a') as ofile:
+            with open(os.path.join(temp_dir, var_info[0]), 'a') as ofile:
                 gribfile.write(ofile)
 
 
 # Function writing data from previous monthly file, writing the 0-hour fields
-def proc_prev_month(month, gribfile, handles):
+def proc_prev_month(month, gribfile, handles, routes=None):
     while gribfile.read_next():
-        if get_mon(gribfile) == month:
-            code = grib_tuple_from_int(gribfile.get_field(grib_file.param_key))
+        header = gribfile.get_fields(grib_file.header_keys)
+        if get_header_mon(header) == month:
+            code = grib_tuple_from_int(header[0])
             if code not in accum_codes:
-                write_record(gribfile, handles=handles)
+                write_record(gribfile, handles=handles, header=header, routes=routes)
         gribfile.release()
 
 
-# Function writing data from previous monthly file, writing the 0-hour fields
-def proc_next_month(month, gribfile, handles):
+# Function writing data from current monthly file, optionally carrying the next month records to the boundary file.
+# The boundary is only written by the regular filter pass, not by the writers of the named pipes with their own routes.
+def proc_next_month(month, gribfile, handles, routes=None):
     while gribfile.read_next():
-        mon = get_mon(gribfile)
-        code = grib_tuple_from_int(gribfile.get_field(grib_file.param_key))
+        header = gribfile.get_fields(grib_file.header_keys)
+        mon = get_header_mon(header)
+        code = grib_tuple_from_int(header[0])
         cumvar = code in accum_codes
         if mon == month:
-            write_record(gribfile, shift=-1 if cumvar else 0, handles=handles)
-        elif mon == (month + 1) % 12:
+            write_record(gribfile, shift=-1 if cumvar else 0, handles=handles, header=header, routes=routes)
+        elif mon == month % 12 + 1:
             if cumvar:
-                write_record(gribfile, shift=-1, handles=handles)
+                write_record(gribfile, shift=-1, handles=handles, header=header, routes=routes)
+            elif carry_boundary and routes is None:
+                write_boundary(gribfile, handles)
         gribfile.release()
 
 
-def get_mon(gribfile):
-    date = gribfile.get_field(grib_file.date_key)
-    return (date % 10 ** 4) / 10 ** 2
+# Writes the unmodified message to the boundary file of its input file
+def write_boundary(gribfile, handles=None):
+    fname = mkboundaryname(gribfile.file_object.name)
+    handle = handles.get(fname, None) if handles else None
+    if handle:
+        gribfile.write(handle)
+    else:
+        with open(os.path.join(temp_dir, fname), 'a') as ofile:
+            gribfile.write(ofile)
+
+
+def get_header_mon(header):
+    return (header[3] % 10 ** 4) / 10 ** 2
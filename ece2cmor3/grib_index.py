@@ -0,0 +1,184 @@
+import logging
+import os
+
+import numpy
+
+from ece2cmor3 import grib_file
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Directory for the index files. If None, the index is stored next to the grib file.
+index_dir = None
+
+# Extension of the index sidecar files
+index_extension = ".idx"
+
+# Version of the index file layout, bump when the record layout changes
+index_version = 1
+
+# Record layout: byte offset and length of the message, followed by the header fields used for routing.
+index_dtype = numpy.dtype([(grib_file.offset_key, numpy.int64),
+                           (grib_file.length_key, numpy.int64),
+                           (grib_file.param_key, numpy.int32),
+                           (grib_file.levtype_key, numpy.int16),
+                           (grib_file.level_key, numpy.int32),
+                           (grib_file.date_key, numpy.int32),
+                           (grib_file.time_key, numpy.int16)])
+
+# Positions of the fields in the index records
+index_positions = {name: i for i, name in enumerate(index_dtype.names)}
+
+# Indices loaded in this session, by file path
+indices_ = {}
+
+
+# Returns the path of the index file for the given grib file
+def get_index_path(path):
+    fname = os.path.basename(path) + index_extension
+    if index_dir is not None:
+        return os.path.join(index_dir, fname)
+    return os.path.join(os.path.dirname(os.path.abspath(path)), fname)
+
+
+# Returns the file identity (size and modification time) that is stored with the index
+def get_file_stamp(path):
+    stat = os.stat(path)
+    return numpy.array([index_version, stat.st_size, stat.st_mtime], dtype=numpy.float64)
+
+
+# Returns the index records for the given grib file, reading the index file or scanning the grib file if necessary
+def get_index(path):
+    global indices_
+    stamp = get_file_stamp(path)
+    if path in indices_ and numpy.array_equal(indices_[path][0], stamp):
+        return indices_[path][1]
+    records = load_index(path, stamp)
+    if records is None:
+        records = create_index(path)
+        save_index(path, stamp, records)
+    indices_[path] = (stamp, records)
+    return records
+
+
+# Scans all message headers in the grib file and returns the index records
+def create_index(path):
+    log.info("Creating message index for file %s" % path)
+    fields = index_dtype.names
+    rows = []
+    with open(path, 'r') as fin:
+        gribfile = grib_file.create_header_file(fin)
+        while gribfile.read_next(headers_only=True):
+            rows.append(tuple(gribfile.get_field(f) for f in fields))
+            gribfile.release()
+    return numpy.array(rows, dtype=index_dtype)
+
+
+# Reads the index file for the given grib file, returns None if absent or outdated
+def load_index(path, stamp):
+    idxpath = get_index_path(path)
+    if not os.path.isfile(idxpath):
+        return None
+    try:
+        with open(idxpath, 'rb') as fin:
+            data = numpy.load(fin)
+            if not numpy.array_equal(data["stamp"], stamp):
+                log.info("Message index %s is outdated, rebuilding it" % idxpath)
+                return None
+            records = data["records"]
+    except (IOError, ValueError, KeyError) as e:
+        log.warning("Could not read message index %s, reason: %s" % (idxpath, str(e)))
+        return None
+    if records.dtype != index_dtype:
+        return None
+    log.info("Using message index %s" % idxpath)
+    return records
+
+
+# Writes the index file for the given grib file
+def save_index(path, stamp, records):
+    idxpath = get_index_path(path)
+    try:
+        with open(idxpath, 'wb') as fout:
+            numpy.savez(fout, stamp=stamp, records=records)
+    except (IOError, OSError) as e:
+        log.warning("Could not write message index %s, reason: %s" % (idxpath, str(e)))
+
+
+# Grib file implementation that serves the header fields from the message index. Unmodified messages are written as
+# raw bytes from the memory-mapped file and header changes are patched into a copy of these bytes where possible.
+# Messages are only decoded by the underlying grib file for fields or layouts that cannot be patched.
+class index_reader(grib_file.grib_file):
+
+    def __init__(self, file_object_, records):
+        super(index_reader, self).__init__(file_object_)
+        self.records = records
+        self.pos = -1
+        self.message = grib_file.create_grib_file(file_object_)
+        self.buffer = grib_file.map_file(file_object_)
+        self.loaded = False
+        self.modified = False
+        self.patched = None
+        self.patched_fields = {}
+
+    def read_next(self, headers_only=False):
+        self.release()
+        self.pos += 1
+        return self.pos < len(self.records)
+
+    def load(self):
+        if not self.loaded:
+            self.file_object.seek(int(self.records[self.pos][grib_file.offset_key]))
+            self.loaded = self.message.read_next()
+            for name, value in self.patched_fields.iteritems():
+                self.message.set_field(name, value)
+                self.modified = True
+            self.patched, self.patched_fields = None, {}
+
+    def write(self, file_object_):
+        if self.patched is not None:
+            file_object_.write(self.patched)
+        elif self.modified or self.buffer is None:
+            self.load()
+            self.message.write(file_object_)
+        else:
+            record = self.records[self.pos]
+            grib_file.write_raw(self.buffer, int(record[grib_file.offset_key]), int(record[grib_file.length_key]),
+                                file_object_)
+
+    def set_field(self, name, value):
+        if not self.loaded and self.buffer is not None:
+            if self.patched is None:
+                record = self.records[self.pos]
+                offset = int(record[grib_file.offset_key])
+                self.patched = bytearray(self.buffer[offset:offset + int(record[grib_file.length_key])])
+            if grib_file.patch_grib1_field(self.patched, name, value):
+                self.patched_fields[name] = value
+                return
+        self.load()
+        self.message.set_field(name, value)
+        self.modified = True
+
+    def get_field(self, name):
+        if name in self.patched_fields:
+            return self.patched_fields[name]
+        if self.loaded or name not in index_dtype.names:
+            self.load()
+            return self.message.get_field(name)
+        return int(self.records[self.pos][name])
+
+    def get_fields(self, names):
+        if self.loaded or self.patched_fields or any([name not in index_positions for name in names]):
+            return super(index_reader, self).get_fields(names)
+        values = self.records[self.pos].item()
+        return [int(values[index_positions[name]]) for name in names]
+
+    def release(self):
+        if self.loaded:
+            self.message.release()
+            self.loaded = False
+        self.modified = False
+        self.patched, self.patched_fields = None, {}
+
+    def eof(self):
+        return self.pos >= len(self.records)
@@ -0,0 +1,269 @@
+import datetime
+import logging
+import os
+
+import netCDF4
+import numpy
+
+from ece2cmor3 import grib_file
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Grid types that are converted, their grid points are the product of a latitude and a longitude axis
+regular_grids = ["regular_gg", "regular_ll"]
+
+# Number of bytes of the time steps that are buffered per variable before they are written to the netcdf file at once
+buffer_size = 256 * 1024 * 1024
+
+# Fill value of missing grid point values, as written by cdo
+fill_value = -9.e+33
+
+# Validity time keys, the time axis of the netcdf file is the time axis of cdo
+validity_date_key = "validityDate"
+validity_time_key = "validityTime"
+
+# Header keys of the message selection
+selection_keys = [grib_file.param_key, grib_file.levtype_key, grib_file.level_key, validity_date_key,
+                  validity_time_key]
+
+# Vertical axes of the level types: dimension name, units, factor of the grib levels and standard name. Surface fields
+# have no vertical axis and model levels are not converted, because cdo adds the hybrid coefficients to these.
+level_axes = {grib_file.pressure_level_hPa_code: ("plev", "Pa", 100., "air_pressure"),
+              grib_file.pressure_level_Pa_code: ("plev", "Pa", 1., "air_pressure"),
+              grib_file.pressure_level_Pa_grib1_code: ("plev", "Pa", 1., "air_pressure"),
+              grib_file.height_level_code: ("height", "m", 1., "height"),
+              grib_file.depth_level_code: ("depth", "cm", 1., "depth"),
+              112: ("depth", "cm", 1., "depth")}
+
+# Surface fields of the ECMWF table at 10 and 2 meters, that cdo places on a height axis
+surface_heights = {165: 10., 166: 10., 167: 2., 168: 2.}
+
+
+# Converts the selected fields of the grib files on a regular grid to the netcdf file, with the variable names, codes
+# and time axis that cdo writes. The selection consists of the codes, the level types, the levels (in the units of the
+# vertical axis) and the hours and days of the validity times. If code is given, all selected fields become levels of a
+# single variable with this code. Returns the output path, or None if the input cannot be converted this way, leaving
+# no output behind.
+def convert(ifiles, ofile, codes=None, code=None, levtypes=None, levels=None, hours=None, days=None):
+    if isinstance(ifiles, str):
+        ifiles = [ifiles]
+    if not all([os.path.isfile(f) for f in ifiles]):
+        return None
+    selection = select_messages(ifiles, codes, code, levtypes, levels, hours, days)
+    if not selection:
+        return None
+    variables = get_variables(selection)
+    if variables is None:
+        return None
+    try:
+        if not write_netcdf(ifiles, ofile, selection, variables):
+            if os.path.exists(ofile):
+                os.remove(ofile)
+            return None
+    except Exception as e:
+        log.error("Native conversion of %s to netcdf failed: %s" % (str(ifiles), str(e)))
+        if os.path.exists(ofile):
+            os.remove(ofile)
+        return None
+    return ofile
+
+
+# Scans the message headers of the files, returns the list of selected messages as (file index, offset, code, table,
+# level type, level and time) tuples
+def select_messages(ifiles, codes, code, levtypes, levels, hours, days):
+    result = []
+    for i, path in enumerate(ifiles):
+        with open(path, 'r') as fin:
+            gribfile = grib_file.create_library_file(fin)
+            while gribfile.read_next(headers_only=True):
+                param, levtype, level, date, time = gribfile.get_fields(selection_keys)
+                offset = int(gribfile.get_field(grib_file.offset_key))
+                gribfile.release()
+                table, var = (param / 1000, param % 1000) if param >= 1000 else (128, param)
+                if levtype == grib_file.surface_level_code and table == 128 and var in surface_heights:
+                    levtype, level = grib_file.height_level_code, surface_heights[var]
+                if codes is not None and var not in codes:
+                    continue
+                if levtypes is not None and levtype not in levtypes:
+                    continue
+                if levels is not None and get_level_value(levtype, level) not in levels:
+                    continue
+                if hours is not None and time / 100 not in hours:
+                    continue
+                if days is not None and date % 100 not in days:
+                    continue
+                timestamp = datetime.datetime(date / 10000, (date / 100) % 100, date % 100, time / 100, time % 100)
+                result.append((i, offset, var if code is None else code, table, levtype, level, timestamp))
+    return result
+
+
+# Returns the level value in the units of the vertical axis of the level type
+def get_level_value(levtype, level):
+    axis = level_axes.get(levtype, None)
+    return float(level) * (1. if axis is None else axis[2])
+
+
+# Returns the variables of the selected messages as an ordered list of (code, table, level type, levels) tuples, or
+# None if the fields cannot be written as cdo would
+def get_variables(selection):
+    variables = {}
+    for i, offset, code, table, levtype, level, timestamp in selection:
+        entry = variables.setdefault(code, [table, levtype, set()])
+        if level_axes.get(entry[1], (entry[1],))[0] != level_axes.get(levtype, (levtype,))[0]:
+            log.info("Variable var%d on multiple vertical axes is left to cdo" % code)
+            return None
+        if levtype not in level_axes and levtype != grib_file.surface_level_code:
+            log.info("Variable var%d on level type %d is left to cdo" % (code, levtype))
+            return None
+        entry[2].add(get_level_value(levtype, level))
+        if levtype == grib_file.surface_level_code and len(entry[2]) > 1:
+            log.info("Variable var%d on multiple surface levels is left to cdo" % code)
+            return None
+    return [(code, entry[0], entry[1], sorted(entry[2])) for code, entry in sorted(variables.items())]
+
+
+# Returns the grid latitudes and longitudes of the message handle, None if it is not a regular grid in the default
+# scanning mode
+def get_grid(record):
+    get_long, get_string, get_double_array = grib_file.get_message_functions(["get_long", "get_string",
+                                                                              "get_double_array"])
+    if get_string(record, "gridType") not in regular_grids:
+        return None
+    if get_long(record, "iScansNegatively") or get_long(record, "jPointsAreConsecutive"):
+        return None
+    nlat, nlon = get_long(record, "Nj"), get_long(record, "Ni")
+    lats = numpy.array(get_double_array(record, "latitudes")).reshape(nlat, nlon)[:, 0]
+    lons = numpy.array(get_double_array(record, "longitudes")).reshape(nlat, nlon)[0, :]
+    return lats, lons
+
+
+# Writes the selected messages to the netcdf file. The time steps of each variable are gathered in a buffer that is
+# written as a single hyperslab once a message falls outside of it, messages that precede the buffered time steps are
+# written directly. Returns False if the grid is not supported.
+def write_netcdf(ifiles, ofile, selection, variables):
+    times = sorted(set([entry[-1] for entry in selection]))
+    time_index = {t: i for i, t in enumerate(times)}
+    files = [open(path, 'r') for path in ifiles]
+    dataset = None
+    try:
+        readers = [grib_file.create_library_file(f) for f in files]
+        buffers = None
+        for i, offset, code, table, levtype, level, timestamp in selection:
+            files[i].seek(offset)
+            if not readers[i].read_next():
+                raise Exception("Could not read message at offset %d of %s" % (offset, ifiles[i]))
+            record = readers[i].record
+            try:
+                if dataset is None:
+                    grid = get_grid(record)
+                    if grid is None:
+                        log.info("Fields of %s on irregular grids are left to cdo" % str(ifiles))
+                        return False
+                    dataset = create_dataset(ofile, variables, times, grid[0], grid[1])
+                    buffers = create_buffers(dataset, variables, times, len(grid[0]) * len(grid[1]))
+                field, date, values = grib_file.decode_message(record)
+            finally:
+                readers[i].release()
+            buffers[code].put(time_index[timestamp], get_level_value(levtype, level), values)
+        for buf in buffers.values():
+            buf.flush()
+    finally:
+        for f in files:
+            f.close()
+        if dataset is not None:
+            dataset.close()
+    return True
+
+
+# Creates the netcdf file with the coordinates and variables as written by cdo, vertical axes with a single level become
+# scalar coordinates of their variables
+def create_dataset(ofile, variables, times, lats, lons):
+    dataset = netCDF4.Dataset(ofile, 'w')
+    dataset.createDimension("time", None)
+    dataset.createDimension("lon", len(lons))
+    dataset.createDimension("lat", len(lats))
+    timevar = dataset.createVariable("time", "f8", ("time",))
+    timevar.standard_name = "time"
+    timevar.units = "hours since " + times[0].strftime("%Y-%m-%d %H:%M:%S")
+    timevar.calendar = "proleptic_gregorian"
+    timevar.axis = "T"
+    timevar[:] = numpy.array([(t - times[0]).total_seconds() / 3600. for t in times])
+    lonvar = dataset.createVariable("lon", "f8", ("lon",))
+    lonvar.standard_name, lonvar.long_name, lonvar.units, lonvar.axis = "longitude", "longitude", "degrees_east", "X"
+    lonvar[:] = lons
+    latvar = dataset.createVariable("lat", "f8", ("lat",))
+    latvar.standard_name, latvar.long_name, latvar.units, latvar.axis = "latitude", "latitude", "degrees_north", "Y"
+    latvar[:] = lats
+    zdims = {}
+    for code, table, levtype, levels in variables:
+        if levtype not in level_axes:
+            continue
+        name, units, factor, standard_name = level_axes[levtype]
+        key = (name, tuple(levels))
+        if key in zdims:
+            continue
+        dimname = name if not any([k[0] == name for k in zdims]) else "%s_%d" % (name, len(zdims) + 1)
+        if len(levels) > 1:
+            dataset.createDimension(dimname, len(levels))
+        zvar = dataset.createVariable(dimname, "f8", (dimname,) if len(levels) > 1 else ())
+        zvar.standard_name, zvar.long_name, zvar.units, zvar.axis = standard_name, standard_name, units, "Z"
+        zvar.positive = "down" if standard_name in ["air_pressure", "depth"] else "up"
+        zvar[:] = numpy.array(levels)
+        zdims[key] = dimname
+    for code, table, levtype, levels in variables:
+        zdim = zdims.get((level_axes.get(levtype, (None,))[0], tuple(levels)), None)
+        dims = ("time", zdim, "lat", "lon") if zdim and len(levels) > 1 else ("time", "lat", "lon")
+        ncvar = dataset.createVariable("var%d" % code, "f4", dims, fill_value=fill_value)
+        if zdim and len(levels) == 1:
+            ncvar.coordinates = zdim
+        ncvar.code = code
+        ncvar.table = table
+        ncvar.missing_value = numpy.float32(fill_value)
+    return dataset
+
+
+# Creates the time step buffers of the variables
+def create_buffers(dataset, variables, times, npoints):
+    nlat, nlon = len(dataset.dimensions["lat"]), len(dataset.dimensions["lon"])
+    result = {}
+    for code, table, levtype, levels in variables:
+        steps = max(1, min(len(times), buffer_size / (4 * npoints * len(levels))))
+        result[code] = hyperslab(dataset.variables["var%d" % code], levels, steps, nlat, nlon)
+    return result
+
+
+# Buffer of consecutive time steps of a netcdf variable
+class hyperslab(object):
+
+    def __init__(self, ncvar, levels, steps, nlat, nlon):
+        self.ncvar = ncvar
+        self.levels = {level: i for i, level in enumerate(levels)}
+        self.data = numpy.full((steps, len(levels), nlat, nlon), fill_value, dtype=numpy.float32)
+        self.start, self.count = 0, 0
+
+    def put(self, step, level, values):
+        field = numpy.where(numpy.isnan(values), fill_value, values).reshape(self.data.shape[2:])
+        if step < self.start:
+            self.write(step, 1, field[numpy.newaxis, numpy.newaxis, :, :], self.levels[level])
+            return
+        if step >= self.start + self.data.shape[0]:
+            self.flush()
+            self.start = step
+        self.data[step - self.start, self.levels[level], :, :] = field
+        self.count = max(self.count, step - self.start + 1)
+
+    def flush(self):
+        if self.count > 0:
+            self.write(self.start, self.count, self.data[:self.count, :, :, :])
+            self.data.fill(fill_value)
+        self.start += self.count
+        self.count = 0
+
+    def write(self, start, count, data, level=None):
+        if len(self.ncvar.dimensions) == 3:
+            self.ncvar[start:start + count, :, :] = data[:, 0, :, :]
+        elif level is None:
+            self.ncvar[start:start + count, :, :, :] = data
+        else:
+            self.ncvar[start:start + count, level:level + 1, :, :] = data
@@ -5,13 +5,12 @@ import tempfile
 import os
 import threading
 
-import cdo
 import cmor
 
 import dateutil.relativedelta
 import netCDF4
 import numpy
-from ece2cmor3 import grib_filter, cdoapi, cmor_source, cmor_target, cmor_task, cmor_utils, postproc
+from ece2cmor3 import grib_filter, cmor_source, cmor_target, cmor_task, cmor_utils, postproc, file_catalogue
 
 
 # Logger construction
@@ -89,14 +88,19 @@ def initialize(path, expname, tableroot, start, length, refdate, interval=dateut
     dirname = exp_name_ + start_date_.strftime("-ifs-%Y%m")
     temp_dir_ = os.path.join(tmpdir_parent, dirname)
     if os.path.exists(temp_dir_) and any(os.listdir(temp_dir_)):
-        log.warning("Requested temporary directory %s already exists and is nonempty..." % temp_dir_)
-        temp_dir_ = tempfile.mkdtemp(prefix=dirname, dir=tmpdir_parent)
-        log.warning("generated new temporary directory %s" % temp_dir_)
+        if autofilter and grib_filter.reuse_output and \
+                os.path.isfile(os.path.join(temp_dir_, grib_filter.manifest_name)):
+            log.info("Requested temporary directory %s contains filter output of a previous run, "
+                     "reusing it" % temp_dir_)
+        else:
+            log.warning("Requested temporary directory %s already exists and is nonempty..." % temp_dir_)
+            temp_dir_ = tempfile.mkdtemp(prefix=dirname, dir=tmpdir_parent)
+            log.warning("generated new temporary directory %s" % temp_dir_)
     else:
         os.makedirs(temp_dir_)
     max_size_ = maxsizegb
     if autofilter:
-        grib_filter.initialize(ifs_gridpoint_file_, ifs_spectral_file_, temp_dir_)
+        grib_filter.initialize(ifs_gridpoint_file_, ifs_spectral_file_, temp_dir_, expname=exp_name_)
     return True
 
 
@@ -114,10 +118,13 @@ def execute(tasks, cleanup=True, autofilter=True):
         tasks_todo = grib_filter.execute(tasks_todo, start_date_.month)
         for t in tasks_todo:
             if getattr(t.source, "grid_", None) == cmor_source.ifs_grid.point:
-                filepaths = getattr(t, cmor_task.filter_output_key, [])
+                filepaths = [f for f in getattr(t, cmor_task.filter_output_key, []) if
+                             os.path.basename(f) not in grib_filter.varspipes]
                 if any(filepaths):
                     grid_descr_file = filepaths[0]
                     break
+        if grid_descr_file is None and any(grib_filter.varspipes):
+            grid_descr_file = ifs_gridpoint_file_
     else:
         for task in tasks_todo:
             grid = getattr(task.source, "grid_")
@@ -132,13 +139,22 @@ def execute(tasks, cleanup=True, autofilter=True):
             setattr(task, cmor_task.output_frequency_key, output_frequency_)
         grid_descr_file = ifs_gridpoint_file_
     log.info("Fetching grid description from %s ..." % grid_descr_file)
-    ifs_grid_descr_ = cdoapi.cdo_command().get_grid_descr(grid_descr_file) if os.path.exists(grid_descr_file) else {}
+    ifs_grid_descr_ = file_catalogue.get_grid_descr(grid_descr_file) if os.path.exists(grid_descr_file) else {}
     processed_tasks = []
+
+    def flush(tasks):
+        cmorize([t for t in tasks if t in supported_tasks])
+        if cleanup:
+            clean_tmp_data(tasks, False)
+
     try:
         log.info("Post-processing tasks...")
-        processed_tasks = postprocess([t for t in tasks_todo if t.status == cmor_task.status_initialized])
+        processed_tasks = postprocess([t for t in tasks_todo if t.status == cmor_task.status_initialized and
+                                       (t in mask_tasks or t in surf_pressure_tasks)])
         for task in [t for t in processed_tasks if t in mask_tasks]:
             read_mask(task.target.variable, getattr(task, cmor_task.output_path_key))
+        processed_tasks.extend(postprocess([t for t in tasks_todo if t.status == cmor_task.status_initialized and
+                                            t not in mask_tasks and t not in surf_pressure_tasks], flush))
         cmorize([t for t in processed_tasks if t in supported_tasks])
     except Exception:
         if cleanup:
@@ -146,8 +162,11 @@ def execute(tasks, cleanup=True, autofilter=True):
             processed_tasks = []
         raise
     finally:
+        if autofilter:
+            grib_filter.close_pipes()
         if cleanup:
             clean_tmp_data(processed_tasks, False)
+        file_catalogue.clear()
 
 
 # Converts the masks that are needed into a set of tasks
@@ -277,11 +296,11 @@ def get_sp_tasks(tasks, autofilter):
     return result
 
 
-# Postprocessing of IFS tasks
-def postprocess(tasks):
+# Postprocessing of IFS tasks, the flush function consumes finished tasks when the temporary directory is full
+def postprocess(tasks, flush=None):
     global log, temp_dir_, max_size_, ifs_grid_descr_, surface_pressure
     log.info("Post-processing %d IFS tasks..." % len(tasks))
-    tasks_done = postproc.post_process(tasks, temp_dir_, max_size_, ifs_grid_descr_)
+    tasks_done = postproc.post_process(tasks, temp_dir_, max_size_, ifs_grid_descr_, flush)
     log.info("Post-processed batch of %d tasks." % len(tasks_done))
     return tasks_done
 
@@ -300,9 +319,7 @@ def find_sp_variable(task, autofilter):
         task.source.grid_ = 1 if grib_filter.spvar[2] == ifs_spectral_file_ else 0
         return
     log.info("Looking for surface pressure variable in input files...")
-    command = cdoapi.cdo_command()
-    code_string = command.show_code(ifs_spectral_file_)
-    codes = [cmor_source.grib_code(int(c)) for c in code_string[0].split()]
+    codes = [cmor_source.grib_code(c) for c in file_catalogue.get_codes(ifs_spectral_file_)]
     if surface_pressure in codes:
         log.info("Found surface pressure in spectral file")
         setattr(task, cmor_task.filter_output_key, [ifs_spectral_file_])
@@ -641,9 +658,7 @@ def create_soil_depth_axis(name, filepath):
 # Makes a time axis for the given table
 def create_time_axis(freq, path, name, has_bounds):
     global log, start_date_, ref_date_
-    command = cdo.Cdo()
-    times = command.showtimestamp(input=path)[0].split()
-    datetimes = sorted(set(map(lambda s: datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S"), times)))
+    datetimes = file_catalogue.get_timestamps(path)
     if len(datetimes) == 0:
         log.error("Empty time step list encountered at time axis creation for files %s" % str(path))
         return
@@ -656,7 +671,7 @@ def create_time_axis(freq, path, name, has_bounds):
         bounds[:, 0] = rounded_times[:]
         bounds[0:n - 1, 1] = rounded_times[1:n]
         bounds[n - 1, 1] = (cmor_utils.get_rounded_time(freq, datetimes[n - 1], 1) - refdate).total_seconds() / 3600.
-        times[:] = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) / 2
+        times = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) / 2
         return cmor.axis(table_entry=str(name), units="hours since " + str(ref_date_), coord_vals=times,
                          cell_bounds=bounds)
     times = numpy.array([(d - refdate).total_seconds() / 3600 for d in datetimes])
@@ -695,8 +710,7 @@ def select_files(path, expname, start, length):
 # Creates the regular gaussian grids from the postprocessed file argument.
 def create_grid_from_grib(filepath):
     global log
-    command = cdoapi.cdo_command()
-    grid_descr = command.get_grid_descr(filepath)
+    grid_descr = file_catalogue.get_grid_descr(filepath)
     gridtype = grid_descr.get("gridtype", "unknown")
     if gridtype != "gaussian":
         log.error("Cannot read other grids then regular gaussian grids, current grid type read from file %s was % s" % (
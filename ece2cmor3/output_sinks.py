@@ -0,0 +1,164 @@
+import collections
+import logging
+import os
+import Queue
+import threading
+
+# Log object.
+log = logging.getLogger(__name__)
+
+# Maximal number of output files that are open simultaneously
+max_open_files = 256
+
+# Size (in bytes) of the blocks in which buffered records are written to an output file
+block_size = 4 * 1024 ** 2
+
+# Maximal number of bytes buffered over all outputs. Beyond this size, the least recently written buffers are flushed.
+max_buffer_size = 256 * 1024 ** 2
+
+# Write the blocks from a background thread
+background_writer = False
+
+
+# File-like object appending to an output of the sink manager
+class sink(object):
+
+    def __init__(self, manager, name):
+        self.manager = manager
+        self.name = name
+
+    def write(self, data):
+        self.manager.write(self.name, data)
+
+    def close(self):
+        pass
+
+
+# Manager of buffered output files. Records are collected per output and written in large blocks, keeping a bounded
+# number of least recently used file handles open. The number of records and bytes per output is kept in stats. The
+# sinks of the outputs in wrappers are passed through the wrapper factory, whose objects are closed before the outputs.
+# An error of the background writer is raised by the next write, flush or close.
+class sink_manager(object):
+
+    def __init__(self, directory, suffix="", wrappers=None):
+        self.directory = directory
+        self.suffix = suffix
+        self.wrappers = {} if wrappers is None else wrappers
+        self.sinks = {}
+        self.buffers = collections.OrderedDict()
+        self.buffered = 0
+        self.handles = collections.OrderedDict()
+        self.created = set()
+        self.stats = {}
+        self.lock = threading.RLock()
+        self.queue, self.writer = None, None
+        self.error = None
+        if background_writer:
+            self.queue = Queue.Queue(maxsize=max(1, max_buffer_size / block_size))
+            self.writer = threading.Thread(target=self.write_blocks)
+            self.writer.setDaemon(True)
+            self.writer.start()
+
+    # Returns the sink for the given output name
+    def get(self, name, default=None):
+        result = self.sinks.get(name, None)
+        if result is None:
+            result = sink(self, name)
+            if name in self.wrappers:
+                result = self.wrappers[name](result)
+            self.sinks[name] = result
+        return result
+
+    # Returns the file path for the given output name
+    def get_path(self, name):
+        return os.path.join(self.directory, name + self.suffix)
+
+    # Appends a record to the buffer of the output
+    def write(self, name, data):
+        self.check_error()
+        data = str(data)
+        with self.lock:
+            entry = self.buffers.pop(name, None)
+            if entry is None:
+                entry = [[], 0]
+            entry[0].append(data)
+            entry[1] += len(data)
+            self.buffers[name] = entry
+            self.buffered += len(data)
+            stats = self.stats.setdefault(name, [0, 0])
+            stats[0] += 1
+            stats[1] += len(data)
+            if entry[1] >= block_size:
+                self.flush(name)
+            while self.buffered > max_buffer_size:
+                self.flush(next(iter(self.buffers)))
+
+    # Writes the buffered records of the output as a single block
+    def flush(self, name):
+        self.check_error()
+        with self.lock:
+            entry = self.buffers.pop(name, None)
+            if entry is None:
+                return
+            self.buffered -= entry[1]
+            block = ''.join(entry[0])
+            if self.queue is None:
+                self.write_block(name, block)
+            else:
+                self.queue.put((name, block))
+
+    # Writes the block to the output file, opening it if necessary
+    def write_block(self, name, block):
+        handle = self.handles.pop(name, None)
+        if handle is None:
+            if len(self.handles) >= max_open_files:
+                self.handles.popitem(last=False)[1].close()
+            handle = open(self.get_path(name), 'a' if name in self.created else 'w')
+            self.created.add(name)
+        self.handles[name] = handle
+        handle.write(block)
+
+    # Background writer loop. After an error, the remaining blocks are discarded to keep the queue draining.
+    def write_blocks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write_block(*item)
+            except Exception as e:
+                log.error("Background writing of %s failed: %s" % (item[0], str(e)))
+                self.error = e
+
+    # Raises the error of the background writer, if any
+    def check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    # Flushes all buffers and closes the output files
+    def close(self):
+        try:
+            for result in self.sinks.values():
+                result.close()
+            with self.lock:
+                for name in list(self.buffers.keys()):
+                    self.flush(name)
+        finally:
+            if self.writer is not None:
+                self.queue.put(None)
+                self.writer.join()
+                self.writer = None
+            for handle in self.handles.values():
+                handle.close()
+            self.handles.clear()
+        self.check_error()
+
+
+# Logs the number of records and bytes written per output
+def report(stats):
+    for name in sorted(stats.keys()):
+        log.info("Wrote %d records (%d bytes) to %s" % (stats[name][0], stats[name][1], name))
+    log.info("Wrote %d records (%d bytes) to %d outputs" % (sum([s[0] for s in stats.values()]),
+                                                             sum([s[1] for s in stats.values()]), len(stats)))
@@ -1,5 +1,8 @@
+import collections
+import functools
+import hashlib
 import logging
-import threading
+import multiprocessing.pool
 import re
 import Queue
 import os
@@ -7,8 +10,11 @@ import os
 from ece2cmor3 import cmor_task
 
 import grib_file
+import grib_netcdf
 import cdoapi
+import cdo_cache
 import cmor_source
+import file_catalogue
 import cmor_target
 
 # Log object
@@ -27,18 +33,46 @@ modes = [skip, append, recreate]
 # Mode for post-processing
 mode = 3
 
+# Whether filtered grib files on regular grids are converted to netcdf in-process, for commands that only select
+# fields and for the final conversion of merge expressions
+native_conversion = True
+
+# Level types of the cdo vertical axes that are selected by the in-process conversion
+native_zaxes = {cdoapi.cdo_command.pressure: [grib_file.pressure_level_hPa_code, grib_file.pressure_level_Pa_code,
+                                              grib_file.pressure_level_Pa_grib1_code],
+                cdoapi.cdo_command.height: [grib_file.height_level_code],
+                cdoapi.cdo_command.surf_level: [grib_file.surface_level_code]}
+
+# Whether the leading operators that the cdo commands over the same input have in common are computed once, into an
+# intermediate grib file that is consumed by the remaining operators of these commands
+share_prefixes = True
+
+# Operators that make a shared chain of leading operators worth computing once, cheaper chains are repeated per command
+cached_operators = [cdoapi.cdo_command.spectral_operator, cdoapi.cdo_command.gridtype_operator,
+                    cdoapi.cdo_command.ml2pl_operator, cdoapi.cdo_command.ml2hl_operator,
+                    cdoapi.cdo_command.expression_operator, cdoapi.cdo_command.add_expression_operator,
+                    cdoapi.cdo_command.timselmean_operator, cdoapi.cdo_command.timselmin_operator,
+                    cdoapi.cdo_command.timselmax_operator] + cdoapi.cdo_command.mean_time_operators.values() + \
+                   cdoapi.cdo_command.min_time_operators.values() + cdoapi.cdo_command.max_time_operators.values()
+
+# Number of bits per value of the intermediate grib files
+intermediate_bits = 24
+
+# Relative cost per level of the operators that dominate the run time of a cdo command, with respect to reading the
+# input once. The scheduler dispatches the most expensive commands first.
+operator_costs = {cdoapi.cdo_command.spectral_operator: 4., cdoapi.cdo_command.ml2pl_operator: 8.,
+                  cdoapi.cdo_command.ml2hl_operator: 8.}
+
 # Output frequency of IFS (in hours)
 output_frequency_ = 3
 
-# Helper list of tasks
-finished_tasks_ = []
 
-
-# Post-processes a list of tasks
-def post_process(tasks, path, max_size_gb=float("inf"), grid_descr=None):
+# Post-processes a list of tasks. When the temporary files exceed the maximal size, the finished tasks are handed over
+# to the flush function, that should consume and delete their output. Returns the finished tasks that were not flushed.
+def post_process(tasks, path, max_size_gb=float("inf"), grid_descr=None, flush=None):
     if grid_descr is None:
         grid_descr = {}
-    global finished_tasks_, task_threads
+    global task_threads
     comm_dict = {}
     comm_buf = {}
     max_size = 1000000000. * max_size_gb
@@ -62,26 +96,319 @@ def post_process(tasks, path, max_size_gb=float("inf"), grid_descr=None):
         for t in comm_dict[comm]:
             t.set_failed()
         comm_dict.pop(comm)
-    finished_tasks_ = []
-    if task_threads <= 2:
-        tmp_size = 0.
+    cache_keys, cached = None, set()
+    if cdo_cache.cache_dir is not None and path and mode != skip:
+        cache_keys = {}
         for comm, task_list in comm_dict.iteritems():
-            if tmp_size >= max_size:
-                break
-            f = apply_command(comm, task_list, path)
-            if os.path.exists(f):
-                tmp_size += float(os.path.getsize(f))
-            finished_tasks_.extend(task_list)
-    else:
-        q = Queue.Queue()
-        for i in range(task_threads):
-            worker = threading.Thread(target=cdo_worker, args=(q, path, max_size))
-            worker.setDaemon(True)
-            worker.start()
-        for (comm, task_list) in comm_dict.iteritems():
-            q.put((comm, task_list))
-        q.join()
-    return [t for t in list(finished_tasks_) if t.status >= 0]
+            input_files, comm_string = get_input_files(task_list), comm.create_command()
+            key = cdo_cache.get_key(input_files, comm_string, get_cache_settings(), compute=False)
+            if key is None:
+                cache_keys[task_list[0]] = functools.partial(cdo_cache.get_key, input_files, comm_string,
+                                                             get_cache_settings())
+            else:
+                cache_keys[task_list[0]] = key
+                if cdo_cache.contains(key):
+                    cached.add(comm)
+        deferred = len([k for k in cache_keys.values() if callable(k)])
+        log.info("Found %d of %d cdo results in the cache, the inputs of %d commands are hashed while "
+                 "post-processing" % (len(cached), len(comm_dict), deferred))
+    intermediates, parents = {}, {}
+    if share_prefixes and path and mode == recreate:
+        intermediates, parents = plan_intermediates(comm_dict, path, cached)
+    jobs = [(comm, task_list, parents.get(comm, None)) for comm, task_list in comm_dict.iteritems()
+            if parents.get(comm, None) is None]
+    jobs.extend([node for node in intermediates.values() if node.parent is None])
+    costs = estimate_costs(comm_dict, intermediates)
+    costs.update({comm: 0. for comm in cached})
+    finished_tasks = run_jobs(jobs, costs, path, tmp_budget(max_size, flush), comm_dict, cache_keys)
+    if cache_keys is not None:
+        cdo_cache.save_identities()
+    return [t for t in finished_tasks if t.status >= 0]
+
+
+# Returns the settings that change the result of a cdo command on the same input: the in-process netcdf conversion and
+# the repacked grib intermediates of shared prefixes
+def get_cache_settings():
+    return {"native_conversion": native_conversion, "share_prefixes": share_prefixes and mode == recreate,
+            "intermediate_bits": intermediate_bits}
+
+
+# Estimates the cost of every command and intermediate from the size of its input, the number of levels and its
+# expensive operators. The cost of an intermediate includes the most expensive chain of its consumers, to start long
+# chains first.
+def estimate_costs(comm_dict, intermediates):
+    result = {}
+    for comm, task_list in comm_dict.iteritems():
+        result[comm] = estimate_cost(comm, get_input_files(task_list))
+    for node in sorted(intermediates.values(), key=lambda n: len(n.chain), reverse=True):
+        consumers = [result[c] for c in node.children + node.commands]
+        result[node] = estimate_cost(node.command, node.input_files) + max(consumers + [0.])
+    return result
+
+
+# Estimates the cost of the command on the input files, in bytes read
+def estimate_cost(command, input_files):
+    size = sum([float(os.path.getsize(f)) for f in input_files if os.path.isfile(f)])
+    levels = [command.operators[op] for op in [cdoapi.cdo_command.select_lev_operator,
+                                               cdoapi.cdo_command.ml2pl_operator,
+                                               cdoapi.cdo_command.ml2hl_operator] if op in command.operators]
+    nlevels = max([len(args) for args in levels] + [1])
+    factor = sum([operator_costs.get(op, 0.) for op in command.operators])
+    return size * (1. + factor * nlevels)
+
+
+# Runs the jobs, commands and intermediates, with the most expensive ones first and the consumers of an intermediate
+# directly after it. With more than two task threads, the jobs are dispatched to a pool of threads running cdo,
+# otherwise they run one after the other. Cache keys that are given as functions are computed by the jobs, so the input
+# files are hashed in parallel. No jobs are dispatched while the temporary files exceed the budget: once the running
+# jobs have finished, the budget is flushed and the jobs resume. Returns the finished tasks that were not flushed.
+def run_jobs(jobs, costs, path, budget, comm_dict, cache_keys=None):
+    get_cost = lambda j: costs.get(j if isinstance(j, intermediate) else j[0], 0.)
+
+    def finish(job, outcome):
+        parent = job.parent if isinstance(job, intermediate) else job[2]
+        if parent is not None and parent.release():
+            budget.remove(parent.path)
+        if isinstance(job, intermediate):
+            consumers, failed_tasks = outcome
+            budget.finish(failed_tasks)
+            if any(consumers):
+                budget.add(job.path)
+            return sorted(consumers, key=get_cost, reverse=True)
+        output_path, task_list = outcome
+        for task in task_list:
+            if getattr(task, cmor_task.output_path_key, None) is None:
+                log.error("Task %s in table %s has not produced any output... "
+                          "setting it to failed status." % (task.target.variable, task.target.table))
+                task.set_failed()
+        budget.finish(task_list, output_path)
+        return []
+
+    def execute(job):
+        try:
+            if isinstance(job, intermediate):
+                return run_intermediate(job, comm_dict)
+            comm, task_list, parent = job
+            cache_key = cache_keys.get(task_list[0], None) if cache_keys else None
+            if callable(cache_key):
+                cache_key = cache_key()
+            return apply_command(comm, task_list, path, parent.path if parent else None, cache_key), task_list
+        except Exception as e:
+            log.error("Post-processing job failed: %s" % str(e))
+            return fail_job(job, comm_dict)
+
+    done = Queue.Queue()
+    pool = multiprocessing.pool.ThreadPool(task_threads) if task_threads > 2 else None
+    slots = task_threads if pool else 1
+    waiting, running = sorted(jobs, key=get_cost, reverse=True), 0
+    try:
+        while any(waiting) or running > 0:
+            if running == 0 and budget.exceeded():
+                budget.flush()
+            while any(waiting) and running < slots and (running == 0 or not budget.exceeded()):
+                job = waiting.pop(0)
+                if pool is None:
+                    done.put((job, execute(job)))
+                else:
+                    pool.apply_async(execute, (job,), callback=lambda outcome, j=job: done.put((j, outcome)))
+                running += 1
+            job, outcome = done.get()
+            running -= 1
+            waiting[:0] = finish(job, outcome)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return budget.tasks
+
+
+# Budget of the temporary space taken by the intermediates and outputs of the post-processing. The finished tasks are
+# collected until the budget is flushed: the flush function consumes their output and deletes it. Without flush
+# function the budget cannot be freed, and the post-processing continues beyond it.
+class tmp_budget(object):
+
+    def __init__(self, max_size, flush=None):
+        self.max_size = max_size
+        self.flush_func = flush
+        self.sizes = {}
+        self.tasks = []
+
+    def add(self, path):
+        if path and os.path.isfile(path):
+            self.sizes[path] = float(os.path.getsize(path))
+
+    def remove(self, path):
+        self.sizes.pop(path, None)
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def exceeded(self):
+        return self.size() >= self.max_size
+
+    def finish(self, tasks, output_path=None):
+        self.add(output_path)
+        self.tasks.extend(tasks)
+
+    def flush(self):
+        tasks = [t for t in self.tasks if t.status >= 0]
+        if self.flush_func is None or not any(tasks):
+            if self.flush_func is None:
+                log.warning("Temporary files of %.1f GB exceed the maximal size, continuing without flushing" %
+                            (self.size() / 1.e9))
+                self.max_size = float("inf")
+            return
+        log.info("Temporary files of %.1f GB exceed the maximal size, flushing %d finished tasks" %
+                 (self.size() / 1.e9, len(tasks)))
+        size = self.size()
+        self.flush_func(tasks)
+        self.tasks = []
+        for path in [p for p in self.sizes if not os.path.exists(p)]:
+            self.sizes.pop(path)
+        if self.size() >= size:
+            log.warning("Flushing did not free temporary files, continuing without flushing")
+            self.max_size = float("inf")
+
+
+# Sets the tasks of the job to failed, returns the outcome of the job
+def fail_job(job, comm_dict):
+    if isinstance(job, intermediate):
+        return [], fail_intermediate(job, comm_dict)
+    for task in job[1]:
+        task.set_failed()
+    return None, job[1]
+
+
+# Intermediate result of a chain of leading operators that several cdo commands over the same input have in common.
+# The command holds the operators that follow the parent intermediate, if any. The intermediate file is deleted when
+# its last consumer, a child intermediate or command, has finished.
+class intermediate(object):
+
+    def __init__(self, input_files, chain, path):
+        self.input_files = input_files
+        self.chain = chain
+        self.path = path
+        self.parent = None
+        self.command = None
+        self.children = []
+        self.commands = []
+        self.consumers = 0
+
+    def release(self):
+        self.consumers -= 1
+        if self.consumers == 0 and os.path.exists(self.path):
+            os.remove(self.path)
+            return True
+        return False
+
+
+# Creates a cdo command for the chain of operators, None if cdo would not apply the operators in the given order
+def make_command(chain):
+    if not any(chain):
+        return None
+    result = cdoapi.cdo_command()
+    for operator, args in chain:
+        result.operators[operator] = list(args)
+    return result if result.get_chain() == list(chain) else None
+
+
+# Returns the input files of the task list
+def get_input_files(task_list):
+    input_files = getattr(task_list[0], cmor_task.filter_output_key, [])
+    return [input_files] if isinstance(input_files, str) else list(input_files)
+
+
+# Plans the intermediates of the commands: the chains of leading operators over the same input that are shared by
+# several commands and contain a costly operator. Only chains where the commands branch off are kept, each intermediate
+# is computed from its longest kept leading chain. Returns the intermediates by input and chain, and the intermediate
+# from which every command continues, replacing the operators of these commands by the remaining ones. The excluded
+# commands, such as cached results, do not take part.
+def plan_intermediates(comm_dict, path, excluded=()):
+    chains = {}
+    counts = collections.defaultdict(int)
+    for comm, task_list in comm_dict.iteritems():
+        input_files = tuple(get_input_files(task_list))
+        if not any(input_files) or comm in excluded:
+            continue
+        chain = tuple(comm.get_chain())
+        chains[comm] = (input_files, chain)
+        for i in range(1, len(chain)):
+            counts[(input_files, chain[:i])] += 1
+    shared = set()
+    for (input_files, prefix), count in counts.iteritems():
+        if count < 2 or not any([op in cached_operators for op, args in prefix]):
+            continue
+        if any([counts.get((input_files, c[1][:len(prefix) + 1]), 0) == count for c in chains.values()
+                if c[0] == input_files and len(c[1]) > len(prefix) + 1 and c[1][:len(prefix)] == prefix]):
+            continue
+        shared.add((input_files, prefix))
+
+    def get_parent(input_files, chain):
+        for i in range(len(chain) - 1, 0, -1):
+            if (input_files, chain[:i]) in shared:
+                return input_files, chain[:i]
+        return None
+
+    intermediates = {}
+    for key in sorted(shared, key=lambda k: len(k[1])):
+        parent = get_parent(*key)
+        command = make_command(key[1][len(parent[1]) if parent else 0:])
+        if command is None:
+            shared.discard(key)
+            continue
+        name = "cdo_" + hashlib.sha1(repr(key)).hexdigest()[:16] + ".grib"
+        node = intermediate(list(key[0]), key[1], os.path.join(path, name))
+        node.command = command
+        if parent is not None:
+            node.parent = intermediates[parent]
+            node.parent.children.append(node)
+        intermediates[key] = node
+    parents = {}
+    for comm, (input_files, chain) in chains.iteritems():
+        parent = get_parent(input_files, chain)
+        while parent is not None and parent not in intermediates:
+            parent = get_parent(input_files, parent[1])
+        if parent is None:
+            continue
+        remainder = make_command(chain[len(parent[1]):])
+        if remainder is None:
+            continue
+        comm_dict[remainder] = comm_dict.pop(comm)
+        parents[remainder] = intermediates[parent]
+        intermediates[parent].commands.append(remainder)
+    for node in intermediates.values():
+        node.consumers = len(node.children) + len(node.commands)
+    return intermediates, parents
+
+
+# Computes the intermediate file from its input or parent intermediate. Returns the jobs that consume it, its child
+# intermediates and the remaining commands, and the failed tasks. If the computation fails, the tasks of all consuming
+# commands fail.
+def run_intermediate(node, comm_dict):
+    input_files = [node.parent.path] if node.parent else node.input_files
+    input_file = input_files[0] if len(input_files) == 1 else \
+        ' '.join(["-" + cdoapi.cdo_command.merge_operator] + input_files)
+    log.info("Computing intermediate %s for %d consumers from %s with cdo command %s" % (
+        node.path, node.consumers, input_file, node.command.create_command()))
+    output_path = node.command.apply(input_file, node.path, cdo_threads, grib_output=True, bits=intermediate_bits)
+    if output_path and os.path.exists(node.path):
+        return node.children + [(comm, comm_dict[comm], node) for comm in node.commands], []
+    log.error("Computing intermediate %s failed, skipping its %d consumers" % (node.path, node.consumers))
+    return [], fail_intermediate(node, comm_dict)
+
+
+# Sets the tasks of all commands that consume the intermediate or its children to failed, returns these tasks
+def fail_intermediate(node, comm_dict):
+    result = []
+    for comm in node.commands:
+        for task in comm_dict[comm]:
+            task.set_failed()
+        result.extend(comm_dict[comm])
+    for child in node.children:
+        result.extend(fail_intermediate(child, comm_dict))
+    if os.path.exists(node.path):
+        os.remove(node.path)
+    return result
 
 
 # Checks whether the task grouping makes sense: only tasks for the same variable and frequency can be safely grouped.
@@ -154,45 +481,25 @@ def add_expr_operators(cdo, task):
     cdo.add_operator(cdoapi.cdo_command.select_code_operator, *[c.var_id for c in task.source.get_root_codes()])
 
 
-# Multi-thread function wrapper.
-def cdo_worker(q, base_path, maxsize):
-    global finished_tasks_
-    while True:
-        args = q.get()
-        for task in finished_tasks_:
-            if getattr(task, cmor_task.output_path_key, None) is None:
-                log.error("Task %s in table %s has not produced any output... "
-                          "setting it to failed status." % (task.target.variable, task.target.table))
-                task.set_failed()
-        files = list(set(map(lambda t: getattr(t, cmor_task.output_path_key, ""), finished_tasks_)))
-        if sum(map(lambda fname: os.path.getsize(fname), [f for f in files if os.path.exists(f)])) < maxsize:
-            tasks = args[1]
-            apply_command(command=args[0], task_list=tasks, base_path=base_path)
-            finished_tasks_.extend(tasks)
-        q.task_done()
-
-
 # Executes the command and replaces the path attribute for all tasks in the tasklist
-# to the output of cdo. This path is constructed from the basepath and the first task.
-def apply_command(command, task_list, base_path=None):
+# to the output of cdo. This path is constructed from the basepath and the first task. The input is the filter output
+# of the first task, unless an input path (of an intermediate) is given. With a cache key, the output is taken from the
+# cdo result cache if present and added to it otherwise.
+def apply_command(command, task_list, base_path=None, input_path=None, cache_key=None):
     global log, cdo_threads, skip, append, recreate, mode
     if not task_list:
         log.warning("Encountered empty task list for post-processing command %s" % command.create_command())
     if base_path is None and mode in [skip, append]:
         log.warning(
             "Executing post-processing in skip/append mode without directory given: this will skip the entire task.")
-    input_files = getattr(task_list[0], cmor_task.filter_output_key, [])
-    if isinstance(input_files, str):
-        input_files = [input_files]
+    input_files = [input_path] if input_path else get_input_files(task_list)
     if not any(input_files):
         log.error("Cannot execute cdo command %s for given task because it has no model "
                   "output attribute" % command.create_command())
         return None
     input_file = input_files[0]
     if len(input_files) > 1:
-        directory = os.path.dirname(input_file)
-        input_file = os.path.join(directory, '_'.join([os.path.basename(f) for f in input_files]))
-        command.merge(input_files, input_file)
+        input_file = ' '.join(["-" + cdoapi.cdo_command.merge_operator] + input_files)
     output_file = task_list[0].target.variable + "_" + task_list[0].target.table + ".nc"
     ofile = os.path.join(base_path, output_file) if base_path else None
     for task in task_list:
@@ -204,11 +511,28 @@ def apply_command(command, task_list, base_path=None):
     result = ofile
     if mode != skip:
         if mode == recreate or (mode == append and not os.path.exists(ofile)):
-            merge_expr = (cdoapi.cdo_command.set_code_operator in command.operators)
-            output_path = command.apply(input_file, ofile, cdo_threads, grib_first=merge_expr)
+            output_path = None
+            if cache_key is not None and ofile:
+                if cdo_cache.fetch(cache_key, ofile):
+                    output_path = ofile
+                elif os.path.exists(ofile):
+                    os.remove(ofile)
+            fetched = output_path is not None
+            selection = get_native_selection(command) if native_conversion and ofile and not fetched else None
+            if selection is not None:
+                output_path = grib_netcdf.convert(input_files, ofile, **selection)
+                if output_path:
+                    log.info("Converted %s to netcdf without cdo" % input_file)
+            if output_path is None:
+                merge_expr = (cdoapi.cdo_command.set_code_operator in command.operators)
+                converter = grib_netcdf.convert if native_conversion else None
+                output_path = command.apply(input_file, ofile, cdo_threads, grib_first=merge_expr,
+                                            converter=converter)
             if not output_path:
                 for task in task_list:
                     task.set_failed()
+            elif cache_key is not None and not fetched:
+                cdo_cache.store(cache_key, output_path)
             if output_path and not base_path:
                 tmp_path = os.path.dirname(output_path)
                 ofile = os.path.join(tmp_path, output_file)
@@ -221,6 +545,40 @@ def apply_command(command, task_list, base_path=None):
     return result
 
 
+# Returns the field selection of the in-process netcdf conversion that is equivalent to the cdo command, None if the
+# command contains other operators than field selections
+def get_native_selection(command):
+    operators = command.operators
+    selections = [cdoapi.cdo_command.select_code_operator, cdoapi.cdo_command.set_code_operator,
+                  cdoapi.cdo_command.select_z_operator, cdoapi.cdo_command.select_lev_operator,
+                  cdoapi.cdo_command.select_hour_operator, cdoapi.cdo_command.select_day_operator]
+    if any([op not in selections for op in operators]):
+        return None
+    result = {}
+    if cdoapi.cdo_command.select_code_operator in operators:
+        result["codes"] = [int(c) for c in operators[cdoapi.cdo_command.select_code_operator]]
+    if cdoapi.cdo_command.set_code_operator in operators:
+        result["code"] = int(operators[cdoapi.cdo_command.set_code_operator][0])
+    if cdoapi.cdo_command.select_z_operator in operators:
+        zaxes = operators[cdoapi.cdo_command.select_z_operator]
+        if any([z not in native_zaxes for z in zaxes]):
+            return None
+        result["levtypes"] = sum([native_zaxes[z] for z in zaxes], [])
+    if cdoapi.cdo_command.select_lev_operator in operators:
+        result["levels"] = [float(l) for l in operators[cdoapi.cdo_command.select_lev_operator]]
+    if cdoapi.cdo_command.select_hour_operator in operators:
+        result["hours"] = [int(h) for h in operators[cdoapi.cdo_command.select_hour_operator]]
+    if cdoapi.cdo_command.select_day_operator in operators:
+        result["days"] = [int(d) for d in operators[cdoapi.cdo_command.select_day_operator]]
+    return result
+
+
+# Returns whether the cdo command of the task reads its input once from start to end, so that the input can be served
+# through a named pipe. Commands with vertical level operators probe the levels of the input file beforehand.
+def is_streamable(task):
+    return task.source.spatial_dims == 2 or not any(getattr(task.target, "z_dims", []))
+
+
 # Adds grid remapping operators to the cdo commands for the given task
 def add_grid_operators(cdo, task, grid_descr):
     grid = task.source.grid_id()
@@ -235,12 +593,15 @@ def add_grid_operators(cdo, task, grid_descr):
 # Adds time averaging operators to the cdo command for the given task
 def add_time_operators(cdo, task):
     global output_frequency_
+    if getattr(task, cmor_task.time_aggregation_key, None) is not None:
+        return
     freq = getattr(task.target, cmor_target.freq_key, None)
     operators = getattr(task.target, "time_operator", ["point"])
     if freq == "mon":
         if operators == ["point"]:
-            cdo.add_operator(cdoapi.cdo_command.select_hour_operator, 12)
-            cdo.add_operator(cdoapi.cdo_command.select_day_operator, 15)
+            hours, days = get_time_selection(task)
+            cdo.add_operator(cdoapi.cdo_command.select_hour_operator, *hours)
+            cdo.add_operator(cdoapi.cdo_command.select_day_operator, *days)
         elif operators == ["mean"]:
             cdo.add_operator(cdoapi.cdo_command.mean_time_operators[cdoapi.cdo_command.month])
         elif operators == ["mean within years", "mean over years"]:
@@ -261,7 +622,7 @@ def add_time_operators(cdo, task):
             task.set_failed()
     elif freq == "day":
         if operators == ["point"]:
-            cdo.add_operator(cdoapi.cdo_command.select_hour_operator, 12)
+            cdo.add_operator(cdoapi.cdo_command.select_hour_operator, *get_time_selection(task)[0])
         elif operators == ["mean"]:
             cdo.add_operator(cdoapi.cdo_command.mean_time_operators[cdoapi.cdo_command.day])
         elif operators == ["mean within years", "mean over years"]:
@@ -285,6 +646,37 @@ def add_time_operators(cdo, task):
         task.set_failed()
 
 
+# Returns the hours and days of the time steps that are sampled by the time operators of the task, where None denotes
+# all hours or days. Returns None if the task needs all time steps.
+def get_time_selection(task):
+    freq = getattr(task.target, cmor_target.freq_key, None)
+    operators = getattr(task.target, "time_operator", ["point"])
+    if operators != ["point"]:
+        return None
+    if freq == "mon":
+        return [12], [15]
+    if freq == "day":
+        return [12], None
+    if freq in ["6hr", "6hrPt"]:
+        return range(0, 24, 6), None
+    if freq in ["3hr", "3hrPt"]:
+        return range(0, 24, 3), None
+    return None
+
+
+# Returns the time window and reduction of the time operators of the task if these can be computed while filtering,
+# None otherwise. Only means of single fields qualify: they commute with the linear spectral transform, grid
+# interpolation and level selection that are applied afterwards, whereas expressions, minima and maxima do not.
+def get_time_aggregation(task):
+    if getattr(task.source, cmor_source.expression_key, None):
+        return None
+    freq = getattr(task.target, cmor_target.freq_key, None)
+    operators = getattr(task.target, "time_operator", ["point"])
+    if freq in ["day", "mon"] and operators in [["mean"], ["mean within years", "mean over years"]]:
+        return freq, "mean"
+    return None
+
+
 def add_high_freq_operator(cdo_command, target_freq, operator, task):
     timestamps = [i*target_freq for i in range(24/target_freq)]
     aggregators = {"mean":(cmor_source.ifs_source.grib_codes_accum, cdoapi.cdo_command.timselmean_operator),
@@ -360,7 +752,7 @@ def add_level_operators(cdo, task):
     level_types = [grib_file.hybrid_level_code, grib_file.pressure_level_hPa_code, grib_file.height_level_code]
     input_files = getattr(task, cmor_task.filter_output_key, [])
     if any(input_files):
-        level_types = cdo.get_z_axes(input_files[0], task.source.get_root_codes()[0].var_id)
+        level_types = file_catalogue.get_z_axes(input_files[0], task.source.get_root_codes()[0].var_id)
     name = axisinfo.get("standard_name", None)
     if name == "air_pressure":
         add_zaxis_operators(cdo, task, level_types, levels, cdoapi.cdo_command.pressure,
@@ -387,7 +779,7 @@ def add_zaxis_operators(cdo, task, lev_types, req_levs, axis_type, axis_code):
             levels = [float(s) for s in req_levs]
             input_files = getattr(task, cmor_task.filter_output_key, [])
             if any(input_files):
-                levels = cdo.get_levels(input_files[0], task.source.get_root_codes()[0].var_id, axis_type)
+                levels = file_catalogue.get_levels(input_files[0], task.source.get_root_codes()[0].var_id, axis_type)
             if set([float(s) for s in req_levs]) <= set(levels):
                 cdo.add_operator(cdoapi.cdo_command.select_z_operator, axis_type)
                 cdo.add_operator(cdoapi.cdo_command.select_lev_operator, *req_levs)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import argparse
+import os
+import tempfile
+import time
+
+import gribapi
+import numpy
+
+from ece2cmor3 import grib_file
+
+
+# Writes a synthetic GRIB1 file with 3-hourly surface and model level fields on a regular lat-lon grid
+def make_grib_file(path, nmsg, nlat):
+    record = gribapi.grib_new_from_samples("GRIB1")
+    gribapi.grib_set(record, "Ni", 2 * nlat)
+    gribapi.grib_set(record, "Nj", nlat)
+    gribapi.grib_set(record, "iDirectionIncrement", 180000 / nlat)
+    gribapi.grib_set(record, "jDirectionIncrement", 180000 / nlat)
+    gribapi.grib_set(record, "latitudeOfFirstGridPoint", 90000 - 90000 / nlat)
+    gribapi.grib_set(record, "latitudeOfLastGridPoint", -90000 + 90000 / nlat)
+    gribapi.grib_set(record, "longitudeOfFirstGridPoint", 0)
+    gribapi.grib_set(record, "longitudeOfLastGridPoint", 360000 - 180000 / nlat)
+    fields = [(167, 1, 0), (165, 1, 0), (166, 1, 0), (142, 1, 0)] + [(130, 109, l) for l in range(1, 13)]
+    values = numpy.random.random_sample(2 * nlat * nlat)
+    with open(path, 'w') as fout:
+        for i in range(nmsg):
+            step, j = divmod(i, len(fields))
+            code, levtype, level = fields[j]
+            gribapi.grib_set(record, "indicatorOfParameter", code)
+            gribapi.grib_set(record, "indicatorOfTypeOfLevel", levtype)
+            gribapi.grib_set(record, "level", level)
+            gribapi.grib_set(record, "dataDate", 19900101 + (3 * step / 24) % 28)
+            gribapi.grib_set(record, "dataTime", 100 * ((3 * step) % 24))
+            gribapi.grib_set_values(record, values)
+            gribapi.grib_write(record, fout)
+    gribapi.grib_release(record)
+
+
+# Iterates over all messages, decoding the routing header
+def scan_headers(gribfile, devnull):
+    while gribfile.read_next(headers_only=True):
+        gribfile.get_fields(grib_file.header_keys)
+        gribfile.release()
+
+
+# Iterates over all messages, reading the full messages and decoding the routing header
+def read_messages(gribfile, devnull):
+    while gribfile.read_next():
+        gribfile.get_fields(grib_file.header_keys)
+        gribfile.release()
+
+
+# Iterates over all messages, writing every message
+def write_messages(gribfile, devnull):
+    while gribfile.read_next():
+        gribfile.write(devnull)
+        gribfile.release()
+
+
+# Returns the elapsed time of the operation over the file for the given backend
+def measure(path, backend, operation, repeat):
+    grib_file.backend = backend
+    best = float("inf")
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            with open(path, 'r') as fin:
+                start = time.time()
+                operation(grib_file.create_grib_file(fin), devnull)
+                best = min(best, time.time() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the grib file backends on a synthetic grib file")
+    parser.add_argument("--messages", metavar="N", type=int, default=2000, help="Number of grib messages")
+    parser.add_argument("--nlat", metavar="N", type=int, default=64, help="Number of latitudes of the grid")
+    parser.add_argument("--repeat", metavar="N", type=int, default=3, help="Number of passes, the best is reported")
+    parser.add_argument("--backends", metavar="NAME", type=str, nargs="+", default=["gribapi", "eccodes", "grib1"],
+                        help="Backends to compare")
+    args = parser.parse_args()
+    path = tempfile.mktemp(suffix=".grb")
+    try:
+        make_grib_file(path, args.messages, args.nlat)
+        print "Synthetic file: %d messages, %d bytes" % (args.messages, os.path.getsize(path))
+        for name, operation in [("header scan", scan_headers), ("full read", read_messages),
+                                ("write", write_messages)]:
+            for backend in args.backends:
+                elapsed = measure(path, backend, operation, args.repeat)
+                print "%-12s %-10s %8.0f msg/s" % (name, backend, args.messages / elapsed)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+import argparse
+import copy
+import logging
+import os
+import time
+
+from ece2cmor3 import ece2cmorlib, taskloader, components, grib_filter, grib_file, cmor_source, cmor_target
+
+# Number of model levels of the synthetic field catalogue
+num_model_levels = 91
+
+# Codes without tasks that are added to the synthetic field catalogue, as in a full IFS output configuration
+filler_codes = range(1, 256)
+
+
+# Creates the IFS tasks for all targets of the CMIP6 tables, the full data request
+def create_tasks(copies):
+    ece2cmorlib.initialize_without_cmor()
+    active = {m: m == "ifs" for m in components.models}
+    targets = [t for t in ece2cmorlib.targets if getattr(t, cmor_target.realm_key, None)]
+    taskloader.create_tasks(targets, active_components=active, silent=True)
+    tasks = [t for t in ece2cmorlib.tasks if t.source.model_component() == "ifs"]
+    result = list(tasks)
+    for i in range(copies - 1):
+        result.extend([copy.copy(t) for t in tasks])
+    return result
+
+
+# Creates the field frequencies of an output configuration that contains the fields of all tasks
+def create_frequencies(tasks):
+    result = {}
+    for task in tasks:
+        for code in task.source.get_root_codes():
+            levtype, levels = grib_filter.get_levels(task, code)
+            if levtype == grib_file.hybrid_level_code:
+                levels = range(1, num_model_levels + 1)
+            for level in levels:
+                for grid in [cmor_source.ifs_grid.point, cmor_source.ifs_grid.spec]:
+                    result[(code.var_id, code.tab_id, levtype, level, grid)] = 3
+    for code in filler_codes:
+        for level in range(1, num_model_levels + 1):
+            result[(code, 210, grib_file.hybrid_level_code, level, cmor_source.ifs_grid.point)] = 6
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the task planning of the grib filter")
+    parser.add_argument("--copies", metavar="N", type=int, default=1, help="Number of copies of the request tasks")
+    parser.add_argument("--repeat", metavar="N", type=int, default=3, help="Number of passes, the best is reported")
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+    tasks = create_tasks(args.copies)
+    grib_filter.varsfreq = create_frequencies(tasks)
+    grib_filter.varsprefixes = grib_filter.index_frequencies(grib_filter.varsfreq)
+    grib_filter.accum_codes = grib_filter.load_accum_codes(
+        os.path.join(os.path.dirname(grib_filter.__file__), "resources", "grib_codes.json"))
+    print "Tasks: %d, field keys: %d" % (len(tasks), len(grib_filter.varsfreq))
+    validate, cluster = float("inf"), float("inf")
+    for i in range(args.repeat):
+        start = time.time()
+        valid_tasks = grib_filter.validate_tasks([copy.copy(t) for t in tasks])
+        validate = min(validate, time.time() - start)
+        start = time.time()
+        grib_filter.cluster_files(valid_tasks)
+        cluster = min(cluster, time.time() - start)
+    print "Valid tasks: %d, output files: %d" % (len(valid_tasks), len(grib_filter.get_output_files()))
+    print "validate_tasks: %.3f s, cluster_files: %.3f s" % (validate, cluster)
+
+
+if __name__ == "__main__":
+    main()
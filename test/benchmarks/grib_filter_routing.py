@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import argparse
+import os
+import time
+import StringIO
+
+from ece2cmor3 import grib_file, grib_filter
+
+
+# Creates the field frequencies for the given number of surface, pressure level and model level codes
+def make_fields(ncodes, nlevels):
+    result = {}
+    for i in range(ncodes):
+        code = 1 + i % 255
+        table = 128 + 100 * (i / 255)
+        levtype = [grib_file.surface_level_code, grib_file.pressure_level_Pa_code, grib_file.hybrid_level_code][i % 3]
+        levels = [0] if levtype == grib_file.surface_level_code else range(1, nlevels + 1)
+        for level in levels:
+            lev = 100 * level if levtype == grib_file.pressure_level_Pa_code else level
+            result[(code, table, levtype, lev, 0)] = 6 if levtype == grib_file.hybrid_level_code else 3
+    return result
+
+
+# Registers every other field as filter output, with model levels by wildcard
+def make_files(fields):
+    result = {}
+    for key in sorted(fields.keys())[::2]:
+        varkey = key[:3] + (-1,) + key[4:] if key[2] == grib_file.hybrid_level_code else key
+        result.setdefault(varkey, set()).add(('.'.join([str(k) for k in key[:3]]) + ".3", 3))
+    return result
+
+
+# Creates csv records for one day of output of all fields
+def make_records(fields):
+    rows = []
+    for hour in range(3, 24, 3):
+        for key in sorted(fields.keys()):
+            if hour % fields[key] != 0:
+                continue
+            param = key[0] if key[1] == 128 else key[1] * 1000 + key[0]
+            levtype = grib_file.pressure_level_hPa_code if key[2] == grib_file.pressure_level_Pa_code else key[2]
+            level = key[3] / 100 if key[2] == grib_file.pressure_level_Pa_code else key[3]
+            rows.append(','.join([str(v) for v in [19900101, hour * 100, param, levtype, level]]))
+    return '\n'.join(rows) + '\n'
+
+
+# Reference implementation of the record routing by scanning all registered keys
+def scan_write_record(gribfile, shift=0, handles=None):
+    key = grib_filter.get_record_key(gribfile)
+    if key[2] == grib_file.hybrid_level_code:
+        matches = [grib_filter.varsfiles[k] for k in grib_filter.varsfiles if k[:3] == key[:3]]
+    else:
+        matches = [grib_filter.varsfiles[k] for k in grib_filter.varsfiles if k[:4] == key[:4]]
+    var_infos = set()
+    for match in matches:
+        var_infos.update(match)
+    if not any(var_infos):
+        return
+    timestamp = gribfile.get_field(grib_file.time_key)
+    if shift:
+        matches = [k for k in grib_filter.varsfreq.keys() if k[:-1] == key]
+        freq = grib_filter.varsfreq[matches[0]] if any(matches) else 0
+        timestamp = int(timestamp + shift * freq * 100) % 2400
+        gribfile.set_field(grib_file.time_key, timestamp)
+    for var_info in var_infos:
+        if timestamp / 100 % var_info[1] == 0:
+            gribfile.write(handles[var_info[0]])
+
+
+# Returns the number of processed messages per second for the write function
+def measure(write_func, text, handles, shift):
+    nmsg = 0
+    gribfile = grib_file.csv_grib_mock(StringIO.StringIO(text))
+    start = time.time()
+    while gribfile.read_next():
+        write_func(gribfile, shift=shift, handles=handles)
+        gribfile.release()
+        nmsg += 1
+    return nmsg / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the grib filter record routing (csv backend)")
+    parser.add_argument("--codes", metavar="N", type=int, default=600, help="Number of grib codes")
+    parser.add_argument("--levels", metavar="N", type=int, default=19, help="Number of levels per 3D code")
+    args = parser.parse_args()
+    grib_filter.varsfreq = make_fields(args.codes, args.levels)
+    grib_filter.varsfiles = make_files(grib_filter.varsfreq)
+    grib_filter.compile_routes()
+    text = make_records(grib_filter.varsfreq)
+    with open(os.devnull, 'w') as devnull:
+        handles = {info[0]: devnull for infos in grib_filter.varsfiles.values() for info in infos}
+        print "Registered keys: %d, field keys: %d" % (len(grib_filter.varsfiles), len(grib_filter.varsfreq))
+        for shift in [0, -1]:
+            before = measure(scan_write_record, text, handles, shift)
+            after = measure(grib_filter.write_record, text, handles, shift)
+            print "shift=%d: key scan %.0f msg/s, routing table %.0f msg/s (x%.1f)" % (shift, before, after,
+                                                                                        after / before)
+
+
+if __name__ == "__main__":
+    main()
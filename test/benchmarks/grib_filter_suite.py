@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+import argparse
+import copy
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+from ece2cmor3 import grib_file, grib_filter, grib_index
+
+import grib_month
+from grib_filter_planning import create_tasks
+
+# Version of the layout of the machine-readable results, bump when fields change meaning
+results_version = 1
+
+
+# Returns the peak resident set size of the process in kilobytes
+def get_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+# Returns the number of messages in the grib file
+def count_messages(path):
+    nmsg = 0
+    with open(path, 'r') as fin:
+        gribfile = grib_file.grib1_scanner(fin)
+        while gribfile.read_next(headers_only=True):
+            nmsg += 1
+        gribfile.release()
+    return nmsg
+
+
+# Returns the installed ece2cmor3 version, None if it is not installed
+def get_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution("ece2cmor3").version
+    except Exception:
+        return None
+
+
+# Runs the filter stages for the backend, in a separate process to measure the peak memory of the configuration.
+# Every stage reports its elapsed time and the peak resident memory so far; the stages that read the grib files also
+# report the throughput with respect to the month files.
+def run_configuration(backend, use_index, processes, files, tasks, month, queue):
+    grib_file.backend = backend
+    grib_filter.use_index = use_index
+    grib_filter.use_catalogue = False
+    grib_filter.reuse_output = False
+    grib_filter.processes = processes
+    tmpdir = tempfile.mkdtemp(prefix="grib_filter_suite")
+    grib_index.index_dir = tmpdir
+    results = []
+
+    def measure(stage, func, nmsg=None, nbytes=None, ntasks=None):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        entry = {"backend": backend, "index": use_index, "processes": processes, "stage": stage, "seconds": elapsed,
+                 "messages": nmsg, "bytes": nbytes, "tasks": ntasks, "peak_rss_kb": get_peak_rss()}
+        if nmsg is not None:
+            entry["messages_per_s"] = nmsg / elapsed
+            entry["mb_per_s"] = nbytes / (1.e6 * elapsed)
+        results.append(entry)
+        return result
+
+    try:
+        nmsg, nbytes = sum([f[1] for f in files]), sum([f[2] for f in files])
+        measure("inspect", lambda: grib_filter.initialize(files[0][0], files[1][0], tmpdir), nmsg, nbytes)
+        valid_tasks = measure("validate", lambda: grib_filter.validate_tasks([copy.copy(t) for t in tasks]),
+                              ntasks=len(tasks))
+        measure("cluster", lambda: grib_filter.cluster_files(valid_tasks), ntasks=len(valid_tasks))
+        if grib_filter.use_parallel():
+            measure("proc_mon", lambda: grib_filter.proc_parallel(month, processes), nmsg, nbytes)
+        else:
+            measure("proc_mon", lambda: grib_filter.proc_serial(month), nmsg, nbytes)
+    finally:
+        shutil.rmtree(tmpdir)
+    queue.put(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark suite of the grib filter on synthetic IFS output")
+    parser.add_argument("--data", metavar="DIR", type=str, default=None,
+                        help="Directory with generated output (see grib_month.py), generated in a temporary "
+                             "directory by default")
+    parser.add_argument("--resolution", metavar="RES", type=str, default="T255",
+                        choices=sorted(grib_month.resolutions.keys()), help="Spectral resolution of generated data")
+    parser.add_argument("--codes", metavar="N", type=int, default=40, help="Number of surface physics codes")
+    parser.add_argument("--levels", metavar="N", type=int, default=10, help="Number of model levels")
+    parser.add_argument("--plevels", metavar="N", type=int, default=8, help="Number of pressure levels")
+    parser.add_argument("--accum", metavar="FRAC", type=float, default=0.35,
+                        help="Fraction of accumulated fields among the physics codes")
+    parser.add_argument("--interval", metavar="HRS", type=int, default=3, help="Output interval of surface fields")
+    parser.add_argument("--days", metavar="N", type=int, default=2, help="Number of days written per month")
+    parser.add_argument("--backends", metavar="NAME", type=str, nargs="+", default=["gribapi", "eccodes", "grib1"],
+                        help="Backends to compare")
+    parser.add_argument("--index", type=str, default="both", choices=["on", "off", "both"],
+                        help="Filter with or without the message index")
+    parser.add_argument("--processes", metavar="N", type=int, default=1, help="Number of filter processes")
+    parser.add_argument("--json", metavar="FILE", type=str, default=None, help="Write the results to this json file")
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+    parameters = {"resolution": args.resolution, "codes": args.codes, "levels": args.levels,
+                  "plevels": args.plevels, "accum": args.accum, "interval": args.interval, "days": args.days}
+    datadir = args.data if args.data else tempfile.mkdtemp(prefix="grib_month")
+    try:
+        if not args.data:
+            grib_month.generate(datadir, start=datetime.datetime(1990, 1, 1), months=2, resolution=args.resolution,
+                                codes=args.codes, levels=args.levels, plevels=args.plevels, accum=args.accum,
+                                interval=args.interval, days=args.days)
+            parameters["data"] = None
+        else:
+            parameters = {"data": os.path.abspath(args.data)}
+        legs = sorted([d for d in os.listdir(datadir) if os.path.isdir(os.path.join(datadir, d))])
+        legdir = os.path.join(datadir, legs[-1])
+        files = []
+        for prefix in ["ICMGG", "ICMSH"]:
+            path = [os.path.join(legdir, f) for f in os.listdir(legdir) if f.startswith(prefix) and
+                    not f.endswith("+000000") and not f.endswith(grib_index.index_extension)][0]
+            files.append((path, count_messages(path), os.path.getsize(path)))
+        month = int(files[0][0][-2:])
+        tasks = create_tasks(1)
+        results = []
+        indices = {"on": [True], "off": [False], "both": [True, False]}[args.index]
+        for backend in args.backends:
+            for use_index in indices:
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=run_configuration,
+                                                  args=(backend, use_index, args.processes, files, tasks, month,
+                                                        queue))
+                process.start()
+                entries = queue.get()
+                process.join()
+                for entry in entries:
+                    throughput = "%8.1f MB/s %9.0f msg/s" % (entry["mb_per_s"], entry["messages_per_s"]) \
+                        if entry["messages"] is not None else " " * 27
+                    print "%-8s index=%-5s %-9s %8.3f s %s %8d kB" % (backend, use_index, entry["stage"],
+                                                                      entry["seconds"], throughput,
+                                                                      entry["peak_rss_kb"])
+                results.extend(entries)
+    finally:
+        if not args.data:
+            shutil.rmtree(datadir)
+    if args.json:
+        output = {"benchmark": "grib_filter", "version": results_version, "ece2cmor3": get_version(),
+                  "date": datetime.datetime.now().isoformat(), "host": platform.node(),
+                  "python": platform.python_version(), "parameters": parameters, "tasks": len(tasks),
+                  "results": results}
+        with open(args.json, 'w') as fout:
+            json.dump(output, fout, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
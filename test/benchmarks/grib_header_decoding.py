@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import argparse
+import os
+import time
+
+from ece2cmor3 import grib_file, grib_index
+
+grib_data_path = os.path.join(os.path.dirname(__file__), "..", "test_data", "ifsdata", "3hr", "ICMSHECE3+199001")
+
+# Field accesses per message of the filter loop before the bulk header decoding: month, code, routing key, time
+# stamp and level type
+field_accesses = [grib_file.date_key, grib_file.param_key, grib_file.param_key, grib_file.levtype_key,
+                  grib_file.level_key, grib_file.time_key, grib_file.levtype_key]
+
+
+# Decodes the fields of the message one by one
+def read_fields(gribfile):
+    return [gribfile.get_field(name) for name in field_accesses]
+
+
+# Decodes the routing header of the message at once
+def read_header(gribfile):
+    return gribfile.get_fields(grib_file.header_keys)
+
+
+# Returns the time per message (in microseconds) of the reader and decoding function over the whole file
+def measure(path, create_reader, decode, repeat):
+    nmsg, elapsed = 0, 0.
+    for i in range(repeat):
+        with open(path, 'r') as fin:
+            gribfile = create_reader(fin)
+            start = time.time()
+            while gribfile.read_next(headers_only=True):
+                decode(gribfile)
+                gribfile.release()
+                nmsg += 1
+            elapsed += time.time() - start
+    return 1.e6 * elapsed / nmsg
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the per-message header decoding of the grib filter")
+    parser.add_argument("path", metavar="FILE", type=str, nargs="?", default=grib_data_path, help="Grib file")
+    parser.add_argument("--repeat", metavar="N", type=int, default=3, help="Number of passes over the file")
+    args = parser.parse_args()
+    grib_index.index_dir = os.path.dirname(os.path.abspath(__file__))
+    index = grib_index.get_index(args.path)
+    backends = [("ecmwf_grib_api", grib_file.ecmwf_grib_api),
+                ("index_reader", lambda fin: grib_index.index_reader(fin, index))]
+    print "Messages: %d" % len(index)
+    for name, create_reader in backends:
+        before = measure(args.path, create_reader, read_fields, args.repeat)
+        after = measure(args.path, create_reader, read_header, args.repeat)
+        print "%s: get_field %.1f us/msg, get_fields %.1f us/msg (x%.1f)" % (name, before, after, before / after)
+    os.remove(grib_index.get_index_path(args.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+import argparse
+import datetime
+import os
+
+import gribapi
+import numpy
+from dateutil import relativedelta
+
+from ece2cmor3 import cmor_source, grib_file
+
+# Spectral truncation and reduced gaussian grid number (latitudes between pole and equator) of the resolutions
+resolutions = {"T255": (255, 128), "T511": (511, 256)}
+
+# Pressure levels (hPa) of the 3D fields, the CMIP6 plev19 levels
+pressure_levels = [1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 70, 50, 30, 20, 10, 5, 1]
+
+# Soil codes of the ECMWF table, written on depth layers (top and bottom in cm, bounded by the octet) as by IFS
+soil_layers = {39: (0, 7), 40: (7, 28), 41: (28, 100), 42: (100, 255), 139: (0, 7), 170: (7, 28), 183: (28, 100),
+               236: (100, 255)}
+
+# Number of bits per packed value, as in the IFS output
+packing_bits = 16
+
+
+# Returns the ICMSH and ICMGG fields of the output configuration as lists of (code, table, level type, level, interval)
+# tuples. The physics codes are a mix of accumulated and instantaneous fields with the given fraction of accumulations.
+def make_fields(ncodes, nlevels, nplevels, accum, interval, interval3d):
+    codes3d = [c for c in cmor_source.ifs_source.grib_codes_3D if c.tab_id == 128]
+    sh3d = [c for c in codes3d if c in cmor_source.ifs_source.grib_codes_sh]
+    gg3d = [c for c in codes3d if c not in cmor_source.ifs_source.grib_codes_sh]
+    physics = [c for c in cmor_source.ifs_source.grib_codes_2D_phy if c not in cmor_source.ifs_source.grib_codes_3D]
+    accumulated = [c for c in physics if c in cmor_source.ifs_source.grib_codes_accum]
+    instantaneous = [c for c in physics if c not in cmor_source.ifs_source.grib_codes_accum]
+    naccum = min(len(accumulated), int(round(accum * ncodes)))
+    codes2d = accumulated[:naccum] + instantaneous[:ncodes - naccum]
+    levels3d = [(grib_file.hybrid_level_code, l) for l in range(1, nlevels + 1)] + \
+               [(grib_file.pressure_level_hPa_code, p) for p in pressure_levels[:nplevels]]
+    shfields = [(c.var_id, c.tab_id, levtype, level, interval3d) for c in sh3d for levtype, level in levels3d]
+    shfields += [(134, 128, grib_file.surface_level_code, 0, interval), (129, 128, grib_file.surface_level_code, 0,
+                                                                        interval),
+                 (152, 128, grib_file.hybrid_level_code, 1, interval)]
+    ggfields = [(c.var_id, c.tab_id, 112 if c.var_id in soil_layers and c.tab_id == 128 else
+                 grib_file.surface_level_code, 0, interval) for c in codes2d]
+    ggfields += [(c.var_id, c.tab_id, levtype, level, interval3d) for c in gg3d for levtype, level in levels3d]
+    return shfields, ggfields
+
+
+# Creates the message template of the grid with random values, packed once
+def make_template(resolution, spectral, random_state):
+    truncation, gaussian = resolutions[resolution]
+    if spectral:
+        record = gribapi.grib_new_from_samples("sh_ml_grib1")
+        for key in ["J", "K", "M"]:
+            gribapi.grib_set(record, key, truncation)
+        scales = numpy.repeat(1. / (1. + numpy.arange(truncation + 1)), 2)
+        size = gribapi.grib_get_size(record, "values")
+        values = random_state.standard_normal(size) * numpy.resize(scales, size)
+    else:
+        record = gribapi.grib_new_from_samples("reduced_gg_pl_%d_grib1" % gaussian)
+        size = gribapi.grib_get_size(record, "values")
+        values = 250. + 50. * random_state.random_sample(size)
+    gribapi.grib_set(record, "bitsPerValue", packing_bits)
+    gribapi.grib_set_values(record, values)
+    return record
+
+
+# Writes the messages of the fields for the timestep to the file. The message header is set on the packed template,
+# which leaves the encoded values untouched.
+def write_timestep(fout, record, fields, timestamp, initial=False):
+    nmsg = 0
+    for code, table, levtype, level, interval in fields:
+        if not initial and timestamp.hour % interval != 0:
+            continue
+        gribapi.grib_set(record, "table2Version", table)
+        gribapi.grib_set(record, "indicatorOfParameter", code)
+        gribapi.grib_set(record, "indicatorOfTypeOfLevel", levtype)
+        if levtype == 112:
+            gribapi.grib_set(record, "topLevel", soil_layers[code][0])
+            gribapi.grib_set(record, "bottomLevel", soil_layers[code][1])
+        else:
+            gribapi.grib_set(record, "level", level)
+        gribapi.grib_set(record, "dataDate", int(timestamp.strftime("%Y%m%d")))
+        gribapi.grib_set(record, "dataTime", 100 * timestamp.hour)
+        gribapi.grib_write(record, fout)
+        nmsg += 1
+    return nmsg
+
+
+# Writes the month file starting at the given date, with the timesteps from the first output interval to the start of
+# the next month. If days is given, only the timesteps of the first days are written, followed by the last timestep.
+def write_month(path, record, fields, start, interval, days=None):
+    end = start + relativedelta.relativedelta(months=1)
+    timestamps = []
+    timestamp = start + datetime.timedelta(hours=interval)
+    while timestamp <= end:
+        if days is None or timestamp <= start + datetime.timedelta(days=days) or timestamp == end:
+            timestamps.append(timestamp)
+        timestamp += datetime.timedelta(hours=interval)
+    nmsg = 0
+    with open(path, 'w') as fout:
+        for timestamp in timestamps:
+            nmsg += write_timestep(fout, record, fields, timestamp)
+    return nmsg
+
+
+# Generates the IFS output of an experiment: the initial state files and consecutive months, each month in its own leg
+# directory. Returns the list of generated (path, number of messages) pairs.
+def generate(directory, expname="ECE3", start=datetime.datetime(1990, 1, 1), months=2, resolution="T255", codes=40,
+             levels=10, plevels=8, accum=0.35, interval=3, interval3d=6, days=None, seed=0):
+    random_state = numpy.random.RandomState(seed)
+    shfields, ggfields = make_fields(codes, levels, plevels, accum, interval, interval3d)
+    result = []
+    for prefix, fields, spectral in [("ICMSH", shfields, True), ("ICMGG", ggfields, False)]:
+        record = make_template(resolution, spectral, random_state)
+        try:
+            legdir = os.path.join(directory, "001")
+            if not os.path.isdir(legdir):
+                os.makedirs(legdir)
+            path = os.path.join(legdir, prefix + expname + "+000000")
+            with open(path, 'w') as fout:
+                result.append((path, write_timestep(fout, record, fields, start, initial=True)))
+            for i in range(months):
+                legdir = os.path.join(directory, "%03d" % (i + 1))
+                if not os.path.isdir(legdir):
+                    os.makedirs(legdir)
+                month = start + relativedelta.relativedelta(months=i)
+                path = os.path.join(legdir, prefix + expname + month.strftime("+%Y%m"))
+                result.append((path, write_month(path, record, fields, month, interval, days)))
+        finally:
+            gribapi.grib_release(record)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generator of synthetic IFS grib output months")
+    parser.add_argument("directory", metavar="DIR", type=str, help="Output directory")
+    parser.add_argument("--exp", metavar="NAME", type=str, default="ECE3", help="Experiment name (4 characters)")
+    parser.add_argument("--start", metavar="YYYYMM", type=str, default="199001", help="First month")
+    parser.add_argument("--months", metavar="N", type=int, default=2, help="Number of months")
+    parser.add_argument("--resolution", metavar="RES", type=str, default="T255", choices=sorted(resolutions.keys()),
+                        help="Spectral resolution")
+    parser.add_argument("--codes", metavar="N", type=int, default=40, help="Number of surface physics codes")
+    parser.add_argument("--levels", metavar="N", type=int, default=10, help="Number of model levels")
+    parser.add_argument("--plevels", metavar="N", type=int, default=8, help="Number of pressure levels")
+    parser.add_argument("--accum", metavar="FRAC", type=float, default=0.35,
+                        help="Fraction of accumulated fields among the physics codes")
+    parser.add_argument("--interval", metavar="HRS", type=int, default=3, help="Output interval of surface fields")
+    parser.add_argument("--interval3d", metavar="HRS", type=int, default=6, help="Output interval of 3D fields")
+    parser.add_argument("--days", metavar="N", type=int, default=None,
+                        help="Number of days written per month (followed by the last timestep), all by default")
+    parser.add_argument("--seed", metavar="N", type=int, default=0, help="Seed of the random field values")
+    args = parser.parse_args()
+    start = datetime.datetime.strptime(args.start, "%Y%m")
+    files = generate(args.directory, args.exp, start, args.months, args.resolution, args.codes, args.levels,
+                     args.plevels, args.accum, args.interval, args.interval3d, args.days, args.seed)
+    for path, nmsg in files:
+        print "%s: %d messages, %d bytes" % (path, nmsg, os.path.getsize(path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from nose.tools import eq_, ok_
+
+from ece2cmor3 import cdo_cache
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class cdo_cache_test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        cdo_cache.cache_dir = os.path.join(self.tmpdir, "cache")
+        cdo_cache.cdo_version = "1.9.8"
+        cdo_cache.clear()
+        self.input = os.path.join(self.tmpdir, "ICMGGECE3+199001")
+        with open(self.input, 'w') as fout:
+            fout.write("GRIB" * 100)
+
+    def tearDown(self):
+        cdo_cache.cache_dir, cdo_cache.cdo_version, cdo_cache.max_size_gb = None, None, 100.
+        cdo_cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def write_output(self, name, nbytes):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as fout:
+            fout.write("x" * nbytes)
+        return path
+
+    def test_key(self):
+        key = cdo_cache.get_key([self.input], "-monmean -selcode,167")
+        eq_(cdo_cache.get_key([self.input], "-monmean -selcode,167"), key)
+        ok_(cdo_cache.get_key([self.input], "-daymean -selcode,167") != key)
+        ok_(cdo_cache.get_key([self.input], "-monmean -selcode,167", {"native_conversion": True}) != key)
+        cdo_cache.cdo_version = "2.0.0"
+        ok_(cdo_cache.get_key([self.input], "-monmean -selcode,167") != key)
+        eq_(cdo_cache.get_key([self.input + ".missing"], "-monmean -selcode,167"), None)
+        cdo_cache.cache_dir = None
+        eq_(cdo_cache.get_key([self.input], "-monmean -selcode,167"), None)
+
+    def test_saved_identities(self):
+        eq_(cdo_cache.get_key([self.input], "-monmean -selcode,167", compute=False), None)
+        key = cdo_cache.get_key([self.input], "-monmean -selcode,167")
+        cdo_cache.save_identities()
+        cdo_cache.clear()
+        eq_(cdo_cache.get_key([self.input], "-monmean -selcode,167", compute=False), key)
+        with open(self.input, 'a') as fout:
+            fout.write("GRIB")
+        eq_(cdo_cache.get_key([self.input], "-monmean -selcode,167", compute=False), None)
+        ok_(cdo_cache.get_key([self.input], "-monmean -selcode,167") != key)
+
+    def test_store_and_fetch(self):
+        key = cdo_cache.get_key([self.input], "-monmean -selcode,167")
+        ok_(not cdo_cache.contains(key))
+        ofile = self.write_output("tas_Amon.nc", 100)
+        cdo_cache.store(key, ofile)
+        ok_(cdo_cache.contains(key))
+        os.remove(ofile)
+        ok_(cdo_cache.fetch(key, ofile))
+        eq_(os.path.getsize(ofile), 100)
+        ok_(not cdo_cache.fetch(cdo_cache.get_key([self.input], "-daymean -selcode,167"), ofile))
+
+    def test_evict(self):
+        cdo_cache.max_size_gb = 250.e-9
+        keys = [cdo_cache.get_key([self.input], "-selcode,%d" % code) for code in [165, 166, 167]]
+        start = time.time() - 10.
+        for i, key in enumerate(keys):
+            path = self.write_output("var%d.nc" % i, 100)
+            os.utime(path, (start + i, start + i))
+            cdo_cache.store(key, path)
+        ok_(not cdo_cache.contains(keys[0]))
+        ok_(cdo_cache.contains(keys[1]) and cdo_cache.contains(keys[2]))
+        eq_(cdo_cache.size_, 200)
+        cdo_cache.store(keys[2], self.write_output("var3.nc", 50))
+        eq_(cdo_cache.size_, 150)
@@ -0,0 +1,60 @@
+import datetime
+import logging
+import os
+import tempfile
+import unittest
+
+import numpy
+from nose.tools import eq_, ok_
+
+from ece2cmor3 import file_catalogue, grib_netcdf
+from test_utils import write_grib_file
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class file_catalogue_test(unittest.TestCase):
+
+    def setUp(self):
+        self.gribpath = tempfile.mktemp(suffix=".grb")
+        self.ncpath = tempfile.mktemp(suffix=".nc")
+        write_grib_file(self.gribpath)
+
+    def tearDown(self):
+        file_catalogue.clear()
+        for path in [self.gribpath, self.ncpath]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_grib_metadata(self):
+        eq_(file_catalogue.get_codes(self.gribpath), [131, 167])
+        eq_(file_catalogue.get_z_axes(self.gribpath, 131), [100])
+        eq_(file_catalogue.get_z_axes(self.gribpath, 167), [105])
+        eq_(file_catalogue.get_levels(self.gribpath, 131, "pressure"), [50000., 85000.])
+        eq_(file_catalogue.get_levels(self.gribpath, 131, "height"), [])
+        eq_(file_catalogue.get_z_axes(self.gribpath, 130), [])
+        grid = file_catalogue.get_grid_descr(self.gribpath)
+        eq_((grid["gridtype"], grid["xsize"], grid["ysize"], grid["gridsize"]), ("lonlat", 8, 4, 32))
+        timestamps = file_catalogue.get_timestamps(self.gribpath)
+        eq_(len(timestamps), 16)
+        eq_(timestamps[9], datetime.datetime(1990, 1, 2, 3))
+
+    def test_mixed_pressure_levels(self):
+        write_grib_file(self.gribpath, fields=[(130, 100, 1), (130, 100, 850), (130, 99, 40), (130, 99, 10)])
+        eq_(file_catalogue.get_z_axes(self.gribpath, 130), [99, 100])
+        eq_(file_catalogue.get_levels(self.gribpath, 130, "pressure"), [10., 40., 100., 85000.])
+
+    def test_netcdf_metadata(self):
+        grib_netcdf.convert(self.gribpath, self.ncpath, codes=[167], hours=[0, 12])
+        grid = file_catalogue.get_grid_descr(self.ncpath)
+        eq_((grid["gridtype"], grid["xsize"], grid["xfirst"]), ("lonlat", 8, 0.))
+        eq_(list(grid["yvals"]), [67.5, 22.5, -22.5, -67.5])
+        eq_(file_catalogue.get_timestamps(self.ncpath), [datetime.datetime(1990, 1, d, h) for d in [1, 2]
+                                                         for h in [0, 12]])
+
+    def test_gaussian_grid(self):
+        lats = numpy.degrees(numpy.arcsin(numpy.polynomial.legendre.leggauss(64)[0]))[::-1]
+        grid = file_catalogue.get_netcdf_grid(lats, numpy.arange(0., 360., 2.8125))
+        eq_(grid["gridtype"], "gaussian")
+        eq_(grid["xsize"], 128)
+        ok_(file_catalogue.get_netcdf_grid(numpy.array([80., 10., -5.]), numpy.arange(0., 360., 90.)) is None)
@@ -0,0 +1,54 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import gribapi
+import numpy
+from nose.tools import eq_, ok_
+
+import test_utils
+from ece2cmor3 import grib_aggregator, grib_file
+
+logging.basicConfig(level=logging.DEBUG)
+
+grib_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifsdata", "3hr", "ICMSHECE3+199001")
+
+
+# Returns the field, date and values of all messages in the grib file
+def read_messages(file_object):
+    result = []
+    while True:
+        record = gribapi.grib_new_from_file(file_object)
+        if record is None:
+            break
+        field = tuple([gribapi.grib_get_long(record, k) for k in [grib_file.param_key, grib_file.level_key]])
+        result.append((field, gribapi.grib_get_long(record, grib_file.date_key), gribapi.grib_get_values(record),
+                       gribapi.grib_get_message(record)))
+        gribapi.grib_release(record)
+    return result
+
+
+class grib_aggregator_test(unittest.TestCase):
+
+    def test_daily_means(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_daily_means, download test data from lfs first")
+            return
+        with open(grib_data_path) as fin:
+            messages = read_messages(fin)
+        expected = {}
+        for field, date, values, message in messages:
+            expected.setdefault((field, date), []).append(values)
+        output = tempfile.TemporaryFile()
+        aggregator = grib_aggregator.aggregator(output, "day")
+        for field, date, values, message in messages:
+            aggregator.write(message)
+        aggregator.close()
+        output.seek(0)
+        results = read_messages(output)
+        eq_(len(results), len(expected))
+        ok_(len(results) < len(messages))
+        for field, date, values, message in results:
+            means = numpy.mean(expected[(field, date)], axis=0)
+            ok_(numpy.allclose(values, means, rtol=1.e-5, atol=1.e-5 * numpy.max(numpy.abs(means))))
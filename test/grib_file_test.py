@@ -0,0 +1,126 @@
+import logging
+import os
+import StringIO
+import unittest
+
+import gribapi
+from nose.tools import eq_, ok_
+
+import test_utils
+from ece2cmor3 import grib_file
+
+logging.basicConfig(level=logging.DEBUG)
+
+grib_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifsdata", "3hr", "ICMSHECE3+199001")
+
+
+class grib_file_test(unittest.TestCase):
+
+    def test_patch_grib1_fields(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_patch_grib1_fields, download test data from lfs first")
+            return
+        fields = [(grib_file.date_key, 19891231), (grib_file.date_key, 20000229), (grib_file.time_key, 2100),
+                  (grib_file.levtype_key, 99)]
+        with open(grib_data_path) as fin:
+            for i in range(10):
+                record = gribapi.grib_new_from_file(fin)
+                buf = bytearray(gribapi.grib_get_message(record))
+                for name, value in fields:
+                    ok_(grib_file.patch_grib1_field(buf, name, value))
+                    eq_(grib_file.get_grib1_field(buf, name), value)
+                    gribapi.grib_set(record, name, value)
+                eq_(str(buf), gribapi.grib_get_message(record))
+                gribapi.grib_release(record)
+
+    def test_patch_unsupported(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_patch_unsupported, download test data from lfs first")
+            return
+        with open(grib_data_path) as fin:
+            buf = bytearray(fin.read(2050))
+        original = bytearray(buf)
+        ok_(not grib_file.patch_grib1_field(buf, grib_file.level_key, 500))
+        ok_(not grib_file.patch_grib1_field(buf, grib_file.time_key, 2400))
+        ok_(not grib_file.patch_grib1_field(buf, grib_file.date_key, 19901301))
+        ok_(not grib_file.patch_grib1_field(buf, grib_file.levtype_key, 112))
+        eq_(buf, original)
+        buf[7] = 2
+        ok_(not grib_file.patch_grib1_field(buf, grib_file.time_key, 600))
+        ok_(not grib_file.patch_grib1_field(bytearray("19900101,300,8,1,0\n"), grib_file.time_key, 600))
+
+    def test_find_tail(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_find_tail, download test data from lfs first")
+            return
+        with open(grib_data_path) as fin:
+            buf = bytearray(fin.read())
+        dates = []
+        pos = 0
+        while pos < len(buf):
+            dates.append(grib_file.get_grib1_field(buf[pos:pos + 64], grib_file.date_key))
+            pos += (buf[pos + 4] << 16) + (buf[pos + 5] << 8) + buf[pos + 6]
+        last = dates[-1]
+        ntail = len(dates) - max([i for i, d in enumerate(dates) if d != last] + [-1]) - 1
+        eq_(grib_file.find_tail(buf, lambda h: grib_file.get_grib1_field(h, grib_file.date_key) == last),
+            len(buf) - 2050 * ntail)
+        eq_(grib_file.find_tail(buf, lambda h: True), 0)
+        eq_(grib_file.find_tail(buf, lambda h: False), len(buf))
+        eq_(grib_file.find_tail(buf[:-1], lambda h: False), None)
+
+    def test_eccodes_backend(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_eccodes_backend, download test data from lfs first")
+            return
+        try:
+            import eccodes
+        except ImportError:
+            logging.info("Skipping test_eccodes_backend, eccodes python bindings are not installed")
+            return
+        keys = grib_file.header_keys + [grib_file.offset_key, grib_file.length_key]
+        with open(grib_data_path) as fin1, open(grib_data_path) as fin2:
+            reader1, reader2 = grib_file.ecmwf_grib_api(fin1), grib_file.eccodes_grib(fin2)
+            for i in range(10):
+                ok_(reader1.read_next() and reader2.read_next())
+                eq_(reader1.get_fields(keys), reader2.get_fields(keys))
+                eq_([reader2.get_field(k) for k in keys], reader2.get_fields(keys))
+                reader1.set_field(grib_file.date_key, 19891231)
+                reader2.set_field(grib_file.date_key, 19891231)
+                eq_(gribapi.grib_get_message(reader1.record), eccodes.codes_get_message(reader2.record))
+                reader1.release()
+                reader2.release()
+
+    def test_grib1_scanner(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_grib1_scanner, download test data from lfs first")
+            return
+        keys = grib_file.header_keys + [grib_file.offset_key, grib_file.length_key]
+        with open(grib_data_path) as fin1, open(grib_data_path) as fin2:
+            reader1, reader2 = grib_file.ecmwf_grib_api(fin1), grib_file.grib1_scanner(fin2)
+            nmsg = 0
+            while reader1.read_next(headers_only=True):
+                ok_(reader2.read_next(headers_only=True))
+                eq_(reader1.get_fields(keys), reader2.get_fields(keys))
+                eq_(reader1.get_field("step"), reader2.get_field("step"))
+                reader1.release()
+                reader2.release()
+                nmsg += 1
+            ok_(not reader2.read_next())
+            ok_(nmsg > 0)
+        with open(grib_data_path) as fin1, open(grib_data_path) as fin2:
+            reader1, reader2 = grib_file.ecmwf_grib_api(fin1), grib_file.grib1_scanner(fin2)
+            ok_(reader1.read_next() and reader2.read_next())
+            eq_(gribapi.grib_get_message(reader1.record), get_message(reader2))
+            reader1.set_field(grib_file.date_key, 19891231)
+            reader2.set_field(grib_file.date_key, 19891231)
+            eq_(reader2.get_field(grib_file.date_key), 19891231)
+            eq_(gribapi.grib_get_message(reader1.record), get_message(reader2))
+            reader1.release()
+            reader2.release()
+
+
+# Returns the message written by the grib file object
+def get_message(gribfile):
+    output = StringIO.StringIO()
+    gribfile.write(output)
+    return output.getvalue()
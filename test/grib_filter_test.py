@@ -1,9 +1,13 @@
+import copy
+import json
 import logging
+import stat
 import unittest
 
 import os
+import numpy
 
-from ece2cmor3 import grib_filter, grib_file, ece2cmorlib, cmor_source, cmor_task, cmor_target
+from ece2cmor3 import grib_aggregator, grib_filter, grib_file, grib_index, ece2cmorlib, cmor_source, cmor_task, cmor_target
 from nose.tools import eq_, ok_, with_setup
 
 logging.basicConfig(level=logging.DEBUG)
@@ -16,6 +20,7 @@ def setup():
     grib_file.test_mode = grib_filter_test.test_mode
     if not os.path.exists(tmp_path):
         os.makedirs(tmp_path)
+    grib_index.index_dir = tmp_path
 
 
 class grib_filter_test(unittest.TestCase):
@@ -92,24 +97,41 @@ class grib_filter_test(unittest.TestCase):
         src = cmor_source.ifs_source.read("var214=sqrt(sqr(var165)+sqr(var166))")
         tsk = cmor_task.cmor_task(src, tgt)
         grib_filter.execute([tsk], 1)
-        filepath = os.path.join(tmp_path, "166.128.105_165.128.105.3")
-        ok_(os.path.isfile(filepath))
-        ok_(getattr(tsk, cmor_task.filter_output_key), [filepath])
-        with open(filepath) as fin:
-            reader = grib_file.create_grib_file(fin)
-            date, time = 0, 0
-            while reader.read_next():
-                param = reader.get_field(grib_file.param_key)
-                ok_(param in [165, 166])
-                newdate = reader.get_field(grib_file.date_key)
-                if date != 0 and newdate != date:
-                    eq_(newdate, date + 1)
-                    date = newdate
-                newtime = reader.get_field(grib_file.time_key)
-                if newtime != time:
-                    eq_(newtime, (time + 300) % 2400)
-                    time = newtime
-        os.remove(filepath)
+        filepaths = [os.path.join(tmp_path, "165.128.105.3"), os.path.join(tmp_path, "166.128.105.3")]
+        eq_(sorted(getattr(tsk, cmor_task.filter_output_key)), filepaths)
+        for filepath, code in zip(filepaths, [165, 166]):
+            ok_(os.path.isfile(filepath))
+            with open(filepath) as fin:
+                reader = grib_file.create_grib_file(fin)
+                date, time = 0, 0
+                while reader.read_next():
+                    param = reader.get_field(grib_file.param_key)
+                    eq_(param, code)
+                    newdate = reader.get_field(grib_file.date_key)
+                    if date != 0 and newdate != date:
+                        eq_(newdate, date + 1)
+                        date = newdate
+                    newtime = reader.get_field(grib_file.time_key)
+                    if newtime != time:
+                        eq_(newtime, (time + 300) % 2400)
+                        time = newtime
+            os.remove(filepath)
+
+    @staticmethod
+    @with_setup(setup)
+    def test_shared_streams():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tsk1 = cmor_task.cmor_task(cmor_source.ifs_source.read("var214=sqrt(sqr(var165)+sqr(var166))"),
+                                   ece2cmorlib.get_cmor_target("sfcWind", "Amon"))
+        tsk2 = cmor_task.cmor_task(cmor_source.ifs_source.read("165.128"), ece2cmorlib.get_cmor_target("uas", "Amon"))
+        grib_filter.execute([tsk1, tsk2], 1)
+        filepath = os.path.join(tmp_path, "165.128.105.3")
+        ok_(filepath in getattr(tsk1, cmor_task.filter_output_key))
+        eq_(getattr(tsk2, cmor_task.filter_output_key), [filepath])
+        eq_(len(grib_filter.varsclusters["165.128.105.3"]), 2)
+        for f in getattr(tsk1, cmor_task.filter_output_key):
+            os.remove(f)
 
     @staticmethod
     @with_setup(setup)
@@ -138,3 +160,241 @@ class grib_filter_test(unittest.TestCase):
                     eq_(newtime, (time + 600) % 2400)
                     time = newtime
         os.remove(filepath)
+
+    @staticmethod
+    def test_compile_routes():
+        grib_filter.varsfreq = {(130, 128, grib_file.hybrid_level_code, 1, cmor_source.ifs_grid.spec): 6,
+                                (130, 128, grib_file.hybrid_level_code, 2, cmor_source.ifs_grid.spec): 6,
+                                (167, 128, grib_file.height_level_code, 2, cmor_source.ifs_grid.point): 3}
+        grib_filter.varsfiles = {(130, 128, grib_file.hybrid_level_code, -1, cmor_source.ifs_grid.spec):
+                                     {("130.128.109.6", 6)},
+                                 (167, 128, grib_file.height_level_code, 2, cmor_source.ifs_grid.point):
+                                     {("167.128.105.3", 3), ("167.128.105_165.128.105.3", 3)}}
+        grib_filter.compile_routes()
+        eq_(grib_filter.varsroutes[(130, 128, grib_file.hybrid_level_code, 2)], ((("130.128.109.6", 6),), 6))
+        eq_(grib_filter.varsroutes[(130, 128, grib_file.hybrid_level_code, -1)], ((("130.128.109.6", 6),), 0))
+        eq_(sorted(grib_filter.varsroutes[(167, 128, grib_file.height_level_code, 2)][0]),
+            [("167.128.105.3", 3), ("167.128.105_165.128.105.3", 3)])
+        ok_((165, 128, grib_file.height_level_code, 10) not in grib_filter.varsroutes)
+
+    @staticmethod
+    @with_setup(setup)
+    def test_parallel_filter():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt = ece2cmorlib.get_cmor_target("sfcWind", "Amon")
+        src = cmor_source.ifs_source.read("var214=sqrt(sqr(var165)+sqr(var166))")
+        filepath = os.path.join(tmp_path, "166.128.105.3")
+        contents = []
+        for n in [1, 3]:
+            grib_filter.processes = n
+            try:
+                grib_filter.execute([cmor_task.cmor_task(src, tgt)], 1)
+            finally:
+                grib_filter.processes = 1
+            ok_(os.path.isfile(filepath))
+            with open(filepath) as fin:
+                contents.append(fin.read())
+            os.remove(filepath)
+        ok_(len(contents[0]) > 0)
+        eq_(contents[0], contents[1])
+        eq_([f for f in os.listdir(tmp_path) if ".part" in f], [])
+
+    @staticmethod
+    def test_get_ranges():
+        records = numpy.zeros(10, dtype=grib_index.index_dtype)
+        records[grib_file.offset_key] = numpy.arange(0, 1000, 100)
+        records[grib_file.length_key] = 100
+        eq_(grib_filter.get_ranges(records, 3), [(0, 4), (4, 7), (7, 10)])
+        eq_(grib_filter.get_ranges(records, 20), [(i, i + 1) for i in range(10)])
+        eq_(grib_filter.get_ranges(records[:0], 3), [])
+
+    @staticmethod
+    @with_setup(setup)
+    def test_carry_boundary():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt = ece2cmorlib.get_cmor_target("clwvi", "CFday")
+        src = cmor_source.ifs_source.read("79.128")
+        filepath = os.path.join(tmp_path, "79.128.1.3")
+        grib_filter.execute([cmor_task.cmor_task(src, tgt)], 1)
+        with open(filepath) as fin:
+            expected = fin.read()
+        grib_filter.carry_boundary = True
+        try:
+            grib_filter.execute([cmor_task.cmor_task(src, tgt)], 1)
+            boundary = grib_filter.boundary_files[os.path.abspath(grib_filter_test.gg_path)]
+            ok_(os.path.isfile(boundary))
+            with open(boundary) as fin:
+                reader = grib_file.create_grib_file(fin)
+                count = 0
+                while reader.read_next():
+                    eq_(reader.get_field(grib_file.date_key), 19900201)
+                    code = grib_filter.grib_tuple_from_int(reader.get_field(grib_file.param_key))
+                    ok_(code not in grib_filter.accum_codes)
+                    count += 1
+                ok_(count > 0)
+        finally:
+            grib_filter.clear_boundaries()
+            grib_filter.carry_boundary = False
+        ok_(not os.path.exists(boundary))
+        with open(filepath) as fin:
+            eq_(fin.read(), expected)
+        os.remove(filepath)
+
+    @staticmethod
+    @with_setup(setup)
+    def test_time_selection():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt = copy.copy(ece2cmorlib.get_cmor_target("tas", "Amon"))
+        setattr(tgt, "time_operator", ["point"])
+        src = cmor_source.ifs_source.read("167.128")
+        tsk = cmor_task.cmor_task(src, tgt)
+        grib_filter.execute([tsk], 1)
+        filepath = os.path.join(tmp_path, "167.128.105.3.h12d15")
+        eq_(getattr(tsk, cmor_task.filter_output_key), [filepath])
+        with open(filepath) as fin:
+            reader = grib_file.create_grib_file(fin)
+            count = 0
+            while reader.read_next():
+                eq_(reader.get_field(grib_file.date_key), 19900115)
+                eq_(reader.get_field(grib_file.time_key), 1200)
+                count += 1
+            eq_(count, 1)
+        os.remove(filepath)
+
+    @staticmethod
+    @with_setup(setup)
+    def test_time_aggregation():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt1, tgt2 = ece2cmorlib.get_cmor_target("tas", "Amon"), ece2cmorlib.get_cmor_target("tas", "3hr")
+        src1, src2 = cmor_source.ifs_source.read("167.128"), cmor_source.ifs_source.read("167.128")
+        tsk1, tsk2 = cmor_task.cmor_task(src1, tgt1), cmor_task.cmor_task(src2, tgt2)
+        grib_filter.aggregate_times = True
+        try:
+            task2files, task2freqs = grib_filter.cluster_files(grib_filter.validate_tasks([tsk1, tsk2]))
+        finally:
+            grib_filter.aggregate_times = False
+        eq_(task2files[tsk1], ["167.128.105.3.monmean"])
+        eq_(task2files[tsk2], ["167.128.105.3"])
+        eq_(grib_filter.varsaggregations, {"167.128.105.3.monmean": ("mon", "mean")})
+        eq_(grib_filter.get_output_files(), {"167.128.105.3", "167.128.105.3.monmean"})
+
+    @staticmethod
+    @with_setup(setup)
+    def test_time_aggregation_memory():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt, src = ece2cmorlib.get_cmor_target("tas", "Amon"), cmor_source.ifs_source.read("167.128")
+        tsk = cmor_task.cmor_task(src, tgt)
+        grib_filter.varsgridsizes[cmor_source.ifs_grid.point] = 1000
+        grib_filter.aggregate_times, max_memory_gb = True, grib_aggregator.max_memory_gb
+        grib_aggregator.max_memory_gb = 1.e-6
+        try:
+            task2files, task2freqs = grib_filter.cluster_files(grib_filter.validate_tasks([tsk]))
+        finally:
+            grib_filter.aggregate_times, grib_aggregator.max_memory_gb = False, max_memory_gb
+        eq_(task2files[tsk], ["167.128.105.3"])
+        eq_(grib_filter.varsaggregations, {})
+
+    @staticmethod
+    @with_setup(setup)
+    def test_named_pipes():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt1, tgt2 = ece2cmorlib.get_cmor_target("clwvi", "CFday"), ece2cmorlib.get_cmor_target("ua", "Amon")
+        src1, src2 = cmor_source.ifs_source.read("79.128"), cmor_source.ifs_source.read("131.128")
+        filepath1, filepath2 = os.path.join(tmp_path, "79.128.1.3"), os.path.join(tmp_path, "131.128.210.6")
+        grib_filter.execute([cmor_task.cmor_task(src1, tgt1)], 1)
+        with open(filepath1) as fin:
+            contents = fin.read()
+        os.remove(filepath1)
+        grib_filter.pipe_streams = True
+        try:
+            tsk1, tsk2 = cmor_task.cmor_task(src1, tgt1), cmor_task.cmor_task(src2, tgt2)
+            grib_filter.execute([tsk1, tsk2], 1)
+            eq_(grib_filter.varspipes.keys(), ["79.128.1.3"])
+            ok_(stat.S_ISFIFO(os.stat(filepath1).st_mode))
+            ok_(os.path.isfile(filepath2))
+            with open(getattr(tsk1, cmor_task.filter_output_key)[0]) as fin:
+                eq_(fin.read(), contents)
+        finally:
+            grib_filter.pipe_streams = False
+            grib_filter.close_pipes()
+        ok_(not os.path.exists(filepath1))
+        os.remove(filepath2)
+
+    @staticmethod
+    @with_setup(setup)
+    def test_unread_pipes():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt, src = ece2cmorlib.get_cmor_target("clwvi", "CFday"), cmor_source.ifs_source.read("79.128")
+        filepath = os.path.join(tmp_path, "79.128.1.3")
+        grib_filter.pipe_streams = True
+        try:
+            grib_filter.execute([cmor_task.cmor_task(src, tgt)], 1)
+            ok_(stat.S_ISFIFO(os.stat(filepath).st_mode))
+            threads = grib_filter.pipe_threads
+        finally:
+            grib_filter.pipe_streams = False
+            grib_filter.close_pipes()
+        ok_(not any([t.is_alive() for t in threads]))
+        ok_(not os.path.exists(filepath))
+
+    @staticmethod
+    @with_setup(setup)
+    def test_reuse_output():
+        grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path)
+        ece2cmorlib.initialize()
+        tgt1, tgt2 = ece2cmorlib.get_cmor_target("clwvi", "CFday"), ece2cmorlib.get_cmor_target("uas", "Amon")
+        src1, src2 = cmor_source.ifs_source.read("79.128"), cmor_source.ifs_source.read("165.128")
+        filepath1, filepath2 = os.path.join(tmp_path, "79.128.1.3"), os.path.join(tmp_path, "165.128.105.3")
+        manifest = os.path.join(tmp_path, grib_filter.manifest_name)
+        try:
+            grib_filter.execute([cmor_task.cmor_task(src1, tgt1)], 1)
+            ok_(os.path.isfile(manifest))
+            with open(filepath1) as fin:
+                contents = fin.read()
+            grib_filter.execute([cmor_task.cmor_task(src1, tgt1), cmor_task.cmor_task(src2, tgt2)], 1)
+            eq_(grib_filter.get_output_files(), {"165.128.105.3"})
+            ok_(os.path.getsize(filepath2) > 0)
+            with open(filepath1) as fin:
+                eq_(fin.read(), contents)
+            grib_filter.execute([cmor_task.cmor_task(src1, tgt1), cmor_task.cmor_task(src2, tgt2)], 1)
+            eq_(grib_filter.get_output_files(), set())
+        finally:
+            for f in [filepath1, filepath2, manifest]:
+                if os.path.exists(f):
+                    os.remove(f)
+
+    @staticmethod
+    @with_setup(setup)
+    def test_frequency_catalogue():
+        grib_filter.catalogue_dir = tmp_path
+        catalogue = os.path.join(tmp_path, "ECE3" + grib_filter.catalogue_extension)
+        key = (164, 128, grib_file.surface_level_code, 0, cmor_source.ifs_grid.point)
+        try:
+            grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path, expname="ECE3")
+            ok_(os.path.isfile(catalogue))
+            freqs, spvar = grib_filter.varsfreq, grib_filter.spvar
+            grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path, expname="ECE3")
+            eq_(grib_filter.varsfreq, freqs)
+            eq_(grib_filter.spvar, spvar)
+            with open(catalogue) as fin:
+                data = json.load(fin)
+            eq_(len(data["configurations"]), 2)
+            for entries in data["configurations"].values():
+                for entry in entries:
+                    if tuple(entry[:-1]) == key:
+                        entry[-1] = 12
+            with open(catalogue, 'w') as fout:
+                json.dump(data, fout)
+            grib_filter.initialize(grib_filter_test.gg_path, grib_filter_test.sh_path, tmp_path, expname="ECE3")
+            eq_(grib_filter.varsfreq[key], 12)
+        finally:
+            grib_filter.catalogue_dir = None
+            if os.path.exists(catalogue):
+                os.remove(catalogue)
@@ -0,0 +1,143 @@
+import logging
+import os
+import unittest
+
+from nose.tools import eq_, ok_
+
+import test_utils
+from ece2cmor3 import grib_file, grib_index
+
+logging.basicConfig(level=logging.DEBUG)
+
+test_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifs", "001")
+grib_data_path = os.path.join(os.path.dirname(__file__), "test_data", "ifsdata", "3hr", "ICMSHECE3+199001")
+tmp_path = os.path.join(os.path.dirname(__file__), "tmp")
+
+
+def setup_csv():
+    grib_file.test_mode = True
+    grib_index.index_dir = tmp_path
+    grib_index.indices_ = {}
+    if not os.path.exists(tmp_path):
+        os.makedirs(tmp_path)
+
+
+def read_rows(path):
+    rows = []
+    with open(path) as fin:
+        gribfile = grib_file.create_grib_file(fin)
+        while gribfile.read_next(headers_only=True):
+            rows.append(tuple(gribfile.get_field(k) for k in grib_index.index_dtype.names))
+            gribfile.release()
+    return rows
+
+
+class grib_index_test(unittest.TestCase):
+
+    def test_create_index(self):
+        setup_csv()
+        path = os.path.join(test_data_path, "ICMGGECE3+199001.csv")
+        records = grib_index.create_index(path)
+        rows = read_rows(path)
+        eq_(len(records), len(rows))
+        eq_([tuple(r) for r in records[:100]], rows[:100])
+        eq_(records[0][grib_file.offset_key], 0)
+        eq_(records[-1][grib_file.offset_key] + records[-1][grib_file.length_key], os.path.getsize(path))
+
+    def test_index_file(self):
+        setup_csv()
+        path = os.path.join(test_data_path, "ICMSHECE3+199001.csv")
+        idxpath = grib_index.get_index_path(path)
+        if os.path.exists(idxpath):
+            os.remove(idxpath)
+        records = grib_index.get_index(path)
+        ok_(os.path.isfile(idxpath))
+        stamp = grib_index.get_file_stamp(path)
+        eq_(grib_index.load_index(path, stamp).tolist(), records.tolist())
+        stamp[2] += 1.
+        eq_(grib_index.load_index(path, stamp), None)
+        os.remove(idxpath)
+
+    def test_index_reader(self):
+        setup_csv()
+        path = os.path.join(test_data_path, "ICMGGECE3+199001.csv")
+        rows = read_rows(path)
+        with open(path) as fin:
+            reader = grib_index.index_reader(fin, grib_index.get_index(path))
+            i = 0
+            while reader.read_next() and i < 200:
+                eq_(reader.get_field(grib_file.param_key), rows[i][2])
+                eq_(reader.get_field(grib_file.time_key), rows[i][6])
+                eq_(reader.get_fields(grib_file.header_keys), [rows[i][2], rows[i][3], rows[i][4], rows[i][5],
+                                                               rows[i][6]])
+                if i % 7 == 0:
+                    reader.load()
+                    eq_(reader.get_field(grib_file.level_key), rows[i][4])
+                    eq_(reader.get_fields(grib_file.header_keys), reader.message.get_fields(grib_file.header_keys))
+                reader.release()
+                i += 1
+
+    def test_grib_index(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_grib_index, download test data from lfs first")
+            return
+        grib_file.test_mode = False
+        try:
+            records = grib_index.create_index(grib_data_path)
+            rows = read_rows(grib_data_path)
+        finally:
+            grib_file.test_mode = True
+        eq_([tuple(r) for r in records], rows)
+        eq_(int(records[-1][grib_file.offset_key] + records[-1][grib_file.length_key]),
+            os.path.getsize(grib_data_path))
+
+    def test_raw_write(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_raw_write, download test data from lfs first")
+            return
+        grib_file.test_mode = False
+        rawpath, decpath = os.path.join(tmp_path, "raw.grb"), os.path.join(tmp_path, "decoded.grb")
+        try:
+            with open(grib_data_path) as fin, open(rawpath, 'w') as fraw, open(decpath, 'w') as fdec:
+                reader = grib_index.index_reader(fin, grib_index.create_index(grib_data_path))
+                while reader.read_next():
+                    if reader.get_field(grib_file.param_key) == 131:
+                        reader.write(fraw)
+                        reader.load()
+                        reader.message.write(fdec)
+                    reader.release()
+        finally:
+            grib_file.test_mode = True
+        ok_(os.path.getsize(rawpath) > 0)
+        with open(rawpath) as fraw, open(decpath) as fdec:
+            eq_(fraw.read(), fdec.read())
+        os.remove(rawpath)
+        os.remove(decpath)
+
+    def test_patched_write(self):
+        if test_utils.is_lfs_ref(grib_data_path):
+            logging.info("Skipping test_patched_write, download test data from lfs first")
+            return
+        grib_file.test_mode = False
+        patchpath, decpath = os.path.join(tmp_path, "patched.grb"), os.path.join(tmp_path, "decoded.grb")
+        try:
+            with open(grib_data_path) as fin, open(patchpath, 'w') as fpatch, open(decpath, 'w') as fdec:
+                reader = grib_index.index_reader(fin, grib_index.create_index(grib_data_path))
+                decoder = grib_file.create_grib_file(fin)
+                while reader.read_next():
+                    time = (reader.get_field(grib_file.time_key) + 2100) % 2400
+                    reader.set_field(grib_file.time_key, time)
+                    eq_(reader.get_field(grib_file.time_key), time)
+                    ok_(not reader.loaded)
+                    reader.write(fpatch)
+                    fin.seek(int(reader.records[reader.pos][grib_file.offset_key]))
+                    decoder.read_next()
+                    decoder.set_field(grib_file.time_key, time)
+                    decoder.write(fdec)
+                    decoder.release()
+        finally:
+            grib_file.test_mode = True
+        with open(patchpath) as fpatch, open(decpath) as fdec:
+            eq_(fpatch.read(), fdec.read())
+        os.remove(patchpath)
+        os.remove(decpath)
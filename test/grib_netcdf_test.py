@@ -0,0 +1,78 @@
+import logging
+import os
+import tempfile
+import unittest
+
+import netCDF4
+import numpy
+from nose.tools import eq_, ok_
+
+from ece2cmor3 import grib_netcdf
+from test_utils import write_grib_file
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class grib_netcdf_test(unittest.TestCase):
+
+    def setUp(self):
+        self.gribpath = tempfile.mktemp(suffix=".grb")
+        self.ncpath = tempfile.mktemp(suffix=".nc")
+        self.values = write_grib_file(self.gribpath)
+
+    def tearDown(self):
+        for path in [self.gribpath, self.ncpath]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_surface_field(self):
+        eq_(grib_netcdf.convert([self.gribpath], self.ncpath, codes=[167], levtypes=[105], levels=[2.]), self.ncpath)
+        dataset = netCDF4.Dataset(self.ncpath, 'r')
+        try:
+            ncvar = dataset.variables["var167"]
+            eq_(ncvar.dimensions, ("time", "lat", "lon"))
+            eq_(ncvar.code, 167)
+            eq_(ncvar.coordinates, "height")
+            eq_(float(dataset.variables["height"][...]), 2.)
+            eq_(ncvar.shape, (16, 4, 8))
+            eq_(list(dataset.variables["time"][:]), [3. * i for i in range(16)])
+            eq_(dataset.variables["time"].units, "hours since 1990-01-01 00:00:00")
+            eq_(list(dataset.variables["lat"][:]), [67.5, 22.5, -22.5, -67.5])
+            ok_(numpy.allclose(ncvar[9, :, :].flatten(), self.values[(167, 0, 19900102, 300)], atol=1.e-4))
+            ok_("var131" not in dataset.variables)
+        finally:
+            dataset.close()
+
+    def test_level_and_hour_selection(self):
+        grib_netcdf.buffer_size = 4 * 32 * 3
+        try:
+            eq_(grib_netcdf.convert(self.gribpath, self.ncpath, codes=[131], levtypes=[100], levels=[85000., 50000.],
+                                    hours=[0, 12]), self.ncpath)
+        finally:
+            grib_netcdf.buffer_size = 256 * 1024 * 1024
+        dataset = netCDF4.Dataset(self.ncpath, 'r')
+        try:
+            ncvar = dataset.variables["var131"]
+            eq_(ncvar.dimensions, ("time", "plev", "lat", "lon"))
+            eq_(list(dataset.variables["plev"][:]), [50000., 85000.])
+            eq_(list(dataset.variables["time"][:]), [0., 12., 24., 36.])
+            ok_(numpy.allclose(ncvar[3, 1, :, :].flatten(), self.values[(131, 850, 19900102, 1200)], atol=1.e-4))
+            ok_(numpy.allclose(ncvar[2, 0, :, :].flatten(), self.values[(131, 500, 19900102, 0)], atol=1.e-4))
+        finally:
+            dataset.close()
+
+    def test_merged_code(self):
+        eq_(grib_netcdf.convert(self.gribpath, self.ncpath, codes=[131], code=130), self.ncpath)
+        dataset = netCDF4.Dataset(self.ncpath, 'r')
+        try:
+            eq_(dataset.variables["var130"].code, 130)
+            eq_(dataset.variables["var130"].shape, (16, 2, 4, 8))
+        finally:
+            dataset.close()
+
+    def test_unsupported_input(self):
+        eq_(grib_netcdf.convert(self.gribpath, self.ncpath, code=130), None)
+        ok_(not os.path.exists(self.ncpath))
+        write_grib_file(self.gribpath, gridtype="sh")
+        eq_(grib_netcdf.convert(self.gribpath, self.ncpath, codes=[131]), None)
+        ok_(not os.path.exists(self.ncpath))
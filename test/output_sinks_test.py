@@ -0,0 +1,70 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_, ok_
+
+from ece2cmor3 import output_sinks
+
+logging.basicConfig(level=logging.DEBUG)
+
+
+class output_sinks_test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = (output_sinks.max_open_files, output_sinks.block_size, output_sinks.max_buffer_size,
+                         output_sinks.background_writer)
+
+    def tearDown(self):
+        output_sinks.max_open_files, output_sinks.block_size, output_sinks.max_buffer_size, \
+            output_sinks.background_writer = self.settings
+        shutil.rmtree(self.tmpdir)
+
+    def write_records(self):
+        manager = output_sinks.sink_manager(self.tmpdir, suffix=".part0")
+        expected = {}
+        for i in range(200):
+            name = "out" + str(i % 7)
+            record = str(i) * (i % 13 + 1)
+            manager.get(name).write(bytearray(record))
+            expected[name] = expected.get(name, "") + record
+        manager.close()
+        for name, contents in expected.iteritems():
+            with open(os.path.join(self.tmpdir, name + ".part0")) as fin:
+                eq_(fin.read(), contents)
+        eq_(sum([s[0] for s in manager.stats.values()]), 200)
+        eq_(sum([s[1] for s in manager.stats.values()]), sum([len(c) for c in expected.values()]))
+        ok_(len(manager.handles) == 0)
+        return manager
+
+    def test_buffered_write(self):
+        manager = self.write_records()
+        eq_(len(manager.created), 7)
+
+    def test_evicted_handles(self):
+        output_sinks.max_open_files, output_sinks.block_size, output_sinks.max_buffer_size = 2, 16, 64
+        self.write_records()
+
+    def test_background_writer(self):
+        output_sinks.max_open_files, output_sinks.block_size, output_sinks.background_writer = 3, 32, True
+        self.write_records()
+
+    def test_background_writer_error(self):
+        output_sinks.max_open_files, output_sinks.block_size, output_sinks.background_writer = 3, 32, True
+        manager = output_sinks.sink_manager(os.path.join(self.tmpdir, "missing"), suffix=".part0")
+        try:
+            for i in range(200):
+                manager.get("out" + str(i % 7)).write(bytearray(str(i) * 16))
+        except IOError:
+            pass
+        raised = False
+        try:
+            manager.close()
+        except IOError:
+            raised = True
+        ok_(raised)
+        ok_(manager.writer is None)
+        ok_(len(manager.handles) == 0)
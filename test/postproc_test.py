@@ -1,10 +1,11 @@
 import logging
 import os
+import tempfile
 import unittest
 
 import nose.tools
 import test_utils
-from ece2cmor3 import cmor_source, cmor_target, cmor_task, postproc
+from ece2cmor3 import cdoapi, cmor_source, cmor_target, cmor_task, postproc
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -88,3 +89,77 @@ class ifs2cmor_tests(unittest.TestCase):
         task = cmor_task.cmor_task(source, target)
         command = postproc.create_command(task)
         nose.tools.eq_(command.create_command(), "-sp2gpl -daymean -sellevel,50000. -selzaxis,pressure -selcode,135")
+
+    @staticmethod
+    def test_postproc_native_selection():
+        abspath = test_utils.get_table_path()
+        targets = cmor_target.create_targets(abspath, "CMIP6")
+        source = cmor_source.ifs_source.create(167, 128)
+        target = [t for t in targets if t.variable == "tas" and t.table == "6hrPlevPt"][0]
+        task = cmor_task.cmor_task(source, target)
+        command = postproc.create_command(task, {"gridtype": "gaussian"})
+        selection = postproc.get_native_selection(command)
+        nose.tools.eq_(selection, {"codes": [167], "hours": [0, 6, 12, 18]})
+        command = postproc.create_command(task)
+        nose.tools.eq_(postproc.get_native_selection(command), None)
+
+    @staticmethod
+    def test_postproc_shared_prefix():
+        abspath = test_utils.get_table_path()
+        targets = cmor_target.create_targets(abspath, "CMIP6")
+        source = cmor_source.ifs_source.create(201, 128)
+        comm_dict = {}
+        for table in ["day", "Amon"]:
+            target = [t for t in targets if t.variable == "tasmax" and t.table == table][0]
+            task = cmor_task.cmor_task(source, target)
+            setattr(task, cmor_task.filter_output_key, ["ICMGGECE3+199001"])
+            comm_dict[postproc.create_command(task)] = [task]
+        intermediates, parents = postproc.plan_intermediates(comm_dict, "/tmp")
+        nose.tools.eq_(len(intermediates), 1)
+        node = intermediates.values()[0]
+        nose.tools.eq_(node.command.create_command(), "-setgridtype,regular -selcode,201")
+        nose.tools.eq_(node.consumers, 2)
+        nose.tools.eq_(sorted([c.create_command() for c in comm_dict]), ["-daymax", "-monmean -daymax"])
+        nose.tools.ok_(all([parents[c] is node for c in comm_dict]))
+
+    @staticmethod
+    def test_postproc_command_cost():
+        path = tempfile.mktemp(suffix=".grb")
+        with open(path, 'w') as fout:
+            fout.write("x" * 1000)
+        try:
+            command = cdoapi.cdo_command()
+            command.add_operator(cdoapi.cdo_command.select_code_operator, 167)
+            nose.tools.eq_(postproc.estimate_cost(command, [path]), 1000.)
+            command = cdoapi.cdo_command()
+            command.add_operator(cdoapi.cdo_command.select_code_operator, 130)
+            command.add_operator(cdoapi.cdo_command.ml2pl_operator, 85000., 50000., 25000.)
+            command.add_operator(cdoapi.cdo_command.spectral_operator)
+            nose.tools.eq_(postproc.estimate_cost(command, [path]), 1000. * (1. + 12. * 3))
+            nose.tools.eq_(postproc.estimate_cost(command, [path + ".missing"]), 0.)
+        finally:
+            os.remove(path)
+
+    @staticmethod
+    def test_postproc_tmp_budget():
+        abspath = test_utils.get_table_path()
+        targets = cmor_target.create_targets(abspath, "CMIP6")
+        target = [t for t in targets if t.variable == "tas" and t.table == "Amon"][0]
+        task = cmor_task.cmor_task(cmor_source.ifs_source.create(167, 128), target)
+        path = tempfile.mktemp(suffix=".nc")
+        with open(path, 'w') as fout:
+            fout.write("x" * 1000)
+        flushed = []
+
+        def flush(tasks):
+            flushed.extend(tasks)
+            os.remove(path)
+
+        budget = postproc.tmp_budget(500., flush)
+        budget.finish([task], path)
+        nose.tools.eq_(budget.size(), 1000.)
+        nose.tools.ok_(budget.exceeded())
+        budget.flush()
+        nose.tools.eq_(flushed, [task])
+        nose.tools.eq_(budget.tasks, [])
+        nose.tools.ok_(not budget.exceeded())
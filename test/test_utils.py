@@ -19,6 +19,35 @@ def is_lfs_ref(filename):
     return bytes35 == "version https://git-lfs.github.com/"
 
 
+# Writes 3-hourly surface temperature and pressure level wind fields (or the given code, level type and level fields) on
+# a regular lat-lon grid for two days, returns the values per field and time step
+def write_grib_file(path, gridtype="regular_ll", fields=((167, 1, 0), (131, 100, 850), (131, 100, 500))):
+    import gribapi
+    record = gribapi.grib_new_from_samples("GRIB1" if gridtype == "regular_ll" else "sh_ml_grib1")
+    if gridtype == "regular_ll":
+        for key, value in [("Ni", 8), ("Nj", 4), ("iDirectionIncrement", 45000), ("jDirectionIncrement", 45000),
+                           ("latitudeOfFirstGridPoint", 67500), ("latitudeOfLastGridPoint", -67500),
+                           ("longitudeOfFirstGridPoint", 0), ("longitudeOfLastGridPoint", 315000)]:
+            gribapi.grib_set(record, key, value)
+    size = gribapi.grib_get_size(record, "values")
+    result = {}
+    with open(path, 'w') as fout:
+        for step in range(16):
+            date, time = 19900101 + step / 8, 300 * (step % 8)
+            for code, levtype, level in fields:
+                gribapi.grib_set(record, "indicatorOfParameter", code)
+                gribapi.grib_set(record, "indicatorOfTypeOfLevel", levtype)
+                gribapi.grib_set(record, "level", level)
+                gribapi.grib_set(record, "dataDate", date)
+                gribapi.grib_set(record, "dataTime", time)
+                values = numpy.random.random_sample(size) + code
+                gribapi.grib_set_values(record, values)
+                gribapi.grib_write(record, fout)
+                result[(code, level, date, time)] = gribapi.grib_get_values(record)
+    gribapi.grib_release(record)
+    return result
+
+
 class nemo_output_factory(object):
 
     def __init__(self):